@@ -56,7 +56,6 @@ setup(
     install_requires=[
         "requests>=2.10.0",
         "attrs>=16.0.0",
-        "Delorean>=0.6.0",
         "argh>=0.25",
     ],
     extras_require={
@@ -73,6 +72,7 @@ setup(
             "flake8-double-quotes",
             "flake8-pep3101",
             "flake8-tuple",
+            "pytest",
         ],
     },
     classifiers=[
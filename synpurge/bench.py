@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Benchmarks for synpurge.
+
+Run with ``python -m synpurge.bench``. The ``db`` benchmark measures the
+database operations using a generated Synapse-like schema, and the ``http``
+one measures complete purge runs against the stand-in homeserver from
+:mod:`synpurge.standin`. Results are printed as JSON lines, one per measured
+operation and scale, so they can be compared between versions.
+"""
+
+import json
+import logging
+import time
+
+from argh import EntryPoint
+
+log = logging.getLogger(__name__)
+bench = EntryPoint("synpurge.bench", dict(
+    description="Measures the performance of synpurge",
+))
+
+
+def _skewed_counts(total, count, skew):
+    # Zipf-like distribution: the n-th room gets a share proportional to
+    # 1/n^skew. Each room gets at least the five initial state events.
+    weights = [1.0 / (n ** skew) for n in range(1, count + 1)]
+    scale = total / sum(weights)
+    return [max(5, int(w * scale)) for w in weights]
+
+
+_GENERATE = (
+    """
+    INSERT INTO rooms (room_id, is_public, creator)
+        SELECT '!room' || i || ':bench', i % 2 = 0, '@user' || i || ':bench'
+        FROM unnest($1::int[]) AS i
+    """,
+    """
+    INSERT INTO room_aliases (room_alias, room_id)
+        SELECT '#room' || i || '_' || j || ':bench', '!room' || i || ':bench'
+        FROM unnest($1::int[]) AS i, generate_series(1, $2::int) AS j
+    """,
+    """
+    INSERT INTO events (stream_ordering, topological_ordering, depth, event_id,
+                        type, room_id, content, sender, origin_server_ts)
+        SELECT row_number() OVER (ORDER BY $3::bigint - $5::bigint + (k::bigint * $5::bigint / r.n), r.i),
+               k, k,
+               '$e' || r.i || '_' || k || ':bench',
+               CASE k WHEN 1 THEN 'm.room.create'
+                      WHEN 2 THEN 'm.room.member'
+                      WHEN 3 THEN 'm.room.name'
+                      WHEN 4 THEN 'm.room.topic'
+                      ELSE 'm.room.message' END,
+               '!room' || r.i || ':bench',
+               CASE k WHEN 3 THEN json_build_object('name', 'Room ' || r.i)::text
+                      WHEN 4 THEN json_build_object('topic', 'Topic ' || r.i)::text
+                      ELSE json_build_object('msgtype', 'm.text',
+                                             'body', repeat('x', $4::int))::text END,
+               '@user' || r.i || ':bench',
+               $3::bigint - $5::bigint + (k::bigint * $5::bigint / r.n)
+        FROM unnest($1::int[], $2::int[]) AS r(i, n),
+             generate_series(1, r.n) AS k
+    """,
+    """
+    INSERT INTO event_json (event_id, room_id, internal_metadata, json)
+        SELECT event_id, room_id, '{}',
+               json_build_object('event_id', event_id, 'type', type,
+                                 'content', content::json)::text
+        FROM events
+    """,
+    """
+    INSERT INTO state_events (event_id, room_id, type, state_key)
+        SELECT event_id, room_id, type,
+               CASE type WHEN 'm.room.member' THEN sender ELSE '' END
+        FROM events WHERE topological_ordering <= 4
+    """,
+    """
+    INSERT INTO room_memberships (event_id, user_id, sender, room_id, membership)
+        SELECT event_id, sender, sender, room_id, 'join'
+        FROM events WHERE type = 'm.room.member'
+    """,
+    """
+    INSERT INTO event_edges (event_id, prev_event_id, room_id)
+        SELECT e.event_id, p.event_id, e.room_id
+        FROM events e
+        JOIN events p ON p.room_id = e.room_id
+                     AND p.topological_ordering = e.topological_ordering - 1
+    """,
+    """
+    INSERT INTO event_auth (event_id, auth_id, room_id)
+        SELECT e.event_id, c.event_id, e.room_id
+        FROM events e
+        JOIN events c ON c.room_id = e.room_id AND c.topological_ordering = 1
+        WHERE e.topological_ordering > 1
+    """,
+    """
+    INSERT INTO event_reference_hashes (event_id, algorithm, hash)
+        SELECT event_id, 'sha256', decode(md5(event_id), 'hex') FROM events
+    """,
+    """
+    INSERT INTO event_search (event_id, room_id, sender, key, vector,
+                              origin_server_ts, stream_ordering)
+        SELECT event_id, room_id, sender, 'content.body',
+               to_tsvector('english', 'message ' || stream_ordering),
+               origin_server_ts, stream_ordering
+        FROM events WHERE type = 'm.room.message'
+    """,
+    """
+    INSERT INTO state_groups (id, room_id, event_id)
+        SELECT stream_ordering, room_id, event_id
+        FROM events WHERE topological_ordering <= 4
+    """,
+    """
+    INSERT INTO state_group_edges (state_group, prev_state_group)
+        SELECT e.stream_ordering, p.stream_ordering
+        FROM events e
+        JOIN events p ON p.room_id = e.room_id
+                     AND p.topological_ordering = e.topological_ordering - 1
+        WHERE e.topological_ordering BETWEEN 2 AND 4
+    """,
+    """
+    INSERT INTO state_groups_state (state_group, room_id, type, state_key, event_id)
+        SELECT sg.id, s.room_id, s.type, s.state_key, s.event_id
+        FROM state_groups sg
+        JOIN state_events s ON s.event_id = sg.event_id
+    """,
+    """
+    INSERT INTO event_to_state_groups (event_id, state_group)
+        SELECT e.event_id, s.stream_ordering
+        FROM events e
+        JOIN events s ON s.room_id = e.room_id
+                     AND s.topological_ordering = least(e.topological_ordering, 4)
+    """,
+    """
+    INSERT INTO event_forward_extremities (event_id, room_id)
+        SELECT DISTINCT ON (room_id) event_id, room_id
+        FROM events ORDER BY room_id, topological_ordering DESC
+    """,
+)
+
+
+def generate(conn, rooms, aliases, events, skew=1.0, body_size=100, span_days=90):
+    """
+    Fills the tables of the synthetic schema in the current schema of
+    ``conn`` with ``rooms`` rooms, each with ``aliases`` aliases, and about
+    ``events`` events spread over the last ``span_days`` days.
+    """
+    from os import path
+    with open(path.join(path.dirname(__file__), "pglib", "synthetic.sql")) as f:
+        conn.execute(f.read())
+
+    room_indexes = list(range(1, rooms + 1))
+    counts = _skewed_counts(events, rooms, skew)
+    now_ms, span_ms = int(time.time() * 1000), span_days * 24 * 3600 * 1000
+    params = (
+        (room_indexes,),
+        (room_indexes, aliases),
+        (room_indexes, counts, now_ms, body_size, span_ms),
+    )
+    for i, statement in enumerate(_GENERATE):
+        started = time.monotonic()
+        conn.prepare(statement)(*(params[i] if i < len(params) else ()))
+        log.debug("Generation step %i/%i took %.2fs", i + 1, len(_GENERATE),
+                  time.monotonic() - started)
+    conn.execute("ANALYZE")
+    return sum(counts)
+
+
+def _measure(name, func, repeat=1):
+    timings = []
+    for _ in range(repeat):
+        started = time.monotonic()
+        func()
+        timings.append(time.monotonic() - started)
+    return dict(operation=name, runs=len(timings), min=min(timings),
+                mean=sum(timings) / len(timings), max=max(timings))
+
+
+def _repack_while_writing(db, writer, table_name="event_json"):
+    """
+    Compacts a table while rows are inserted into it and deleted using the
+    ``writer`` connection, and checks that no change gets lost.
+    """
+    import itertools
+    import threading
+
+    insert = writer.prepare("INSERT INTO event_json (event_id, room_id, internal_metadata, json)"
+                            " VALUES ($1, '!repack:bench', '{}', '{}')")
+    delete = writer.prepare("DELETE FROM event_json WHERE event_id = $1")
+    # Only used before and after writing.
+    count = writer.prepare("SELECT count(*) FROM event_json").first
+    stop = threading.Event()
+    written, errors = [0], []
+
+    def write():
+        try:
+            for i in itertools.count():
+                if stop.is_set():
+                    break
+                insert("$repack{}:bench".format(i))
+                if i % 2:
+                    delete("$repack{}:bench".format(i - 1))
+                written[0] = i + 1
+        except Exception as e:
+            errors.append(e)
+
+    rows_before = count()
+    thread = threading.Thread(target=write, name="synpurge-bench-writer")
+    thread.start()
+    try:
+        reclaimed = db.repack_table(table_name)
+    finally:
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+    if reclaimed is None:
+        raise RuntimeError("Table {} could not be repacked".format(table_name))
+    expected = rows_before + written[0] - written[0] // 2
+    if count() != expected:
+        raise RuntimeError("Repacked {} has {} rows, expected {}".format(table_name, count(),
+                                                                         expected))
+    log.info("Repacked %s with %i concurrent writes, %i bytes reclaimed",
+             table_name, written[0], reclaimed)
+
+
+def _bench_config(rooms):
+    from . import config
+    cfg = config.Config(homeserver="http://localhost", keep="30 days",
+                        token="bench", rooms=set())
+    # Patterns which match about a tenth of the rooms each.
+    for digit in range(1, 10):
+        cfg.rooms.add(config.Room(config=cfg, name="#room{}[0-9]*_1:bench".format(digit),
+                                  pattern=True))
+    return cfg
+
+
+def _run_db_scale(connect, schema, rooms, aliases, events, skew, repeat, samples):
+    from . import pg, purger
+    from .pglib import category
+
+    admin = connect()
+    admin.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}"
+                  .format(pg._quote_ident(schema)))
+    admin.close()
+
+    settings = dict(search_path=schema)
+    conn = connect(category=category, settings=settings)
+    writer = connect(settings=settings)
+
+    started = time.monotonic()
+    total_events = generate(conn, rooms, aliases, events, skew)
+    log.info("Generated %i rooms, %i events in %.2fs", rooms, total_events,
+             time.monotonic() - started)
+    db = pg.Database(conn, schema)
+
+    cutoff = int(time.time() * 1000) - 30 * 24 * 3600 * 1000
+    room_ids = ["!room{}:bench".format(i) for i in range(1, rooms + 1)]
+    sample = room_ids[:samples]
+
+    def all_rooms():
+        db.forget_rooms()
+        return db.all_rooms
+
+    conf = _bench_config(rooms)
+
+    def resolve_room_ids():
+        db.forget_rooms()
+        purger.resolve_room_ids(conf, db, True)
+
+    def purge_history():
+        event_ids = db.find_event_ids((room_id, cutoff) for room_id in sample)
+        for room_id, event_id in event_ids.items():
+            if event_id is not None:
+                db.purge_history(room_id, event_id)
+
+    results = [
+        _measure("find_event_id",
+                 lambda: [db.find_event_id(r, cutoff) for r in sample], repeat),
+        _measure("find_event_ids",
+                 lambda: db.find_event_ids((r, cutoff) for r in room_ids), repeat),
+        _measure("count_events_before",
+                 lambda: db.count_events_before((r, cutoff) for r in room_ids), repeat),
+        _measure("all_rooms", all_rooms, repeat),
+        _measure("resolve_room_ids", resolve_room_ids, repeat),
+        _measure("get_room_info", lambda: [db.get_room_info(r) for r in sample], repeat),
+        # Purging creates the dead tuples needed by the maintenance operations.
+        _measure("purge_history", purge_history),
+        _measure("cleanup", db.cleanup),
+        _measure("reindex_table_concurrent", lambda: db.reindex_table_concurrent("events")),
+        _measure("repack_table", lambda: _repack_while_writing(db, writer)),
+    ]
+    writer.close()
+    db.close()
+    for result in results:
+        result.update(rooms=rooms, aliases=aliases, events=total_events, skew=skew,
+                      samples=len(sample))
+    return results
+
+
+@bench
+def db(path: "configuration file with a [database] section",
+       schema: "schema in which the synthetic database is created" = "synpurge_bench",
+       rooms: "number of rooms at scale 1" = 100,
+       aliases: "number of aliases per room" = 2,
+       events: "number of events at scale 1" = 10000,
+       skew: "skew of the per-room event counts" = 1.0,
+       scales: "comma-separated list of scale factors" = "1,10",
+       repeat: "times each operation is measured" = 3,
+       samples: "number of rooms used by per-room operations" = 50,
+       debug: "enable debugging output" = False,
+       verbose: "enable verbose operation" = False):
+    """Benchmark database operations with a synthetic Synapse schema."""
+    logging.basicConfig(level=logging.DEBUG if debug else
+                        logging.INFO if verbose else logging.WARNING)
+    if schema == "public":
+        raise SystemExit("Refusing to use the 'public' schema")
+
+    import functools
+    from postgresql import driver
+    from . import __version__, config, pg
+    try:
+        c = config.load(path)
+    except Exception as e:
+        raise SystemExit("Error loading configuration: {!s}".format(e))
+    if not c.database:
+        raise SystemExit("No database configured")
+
+    conn_params = dict((key, getattr(c.database, key))
+                       for key in pg._CONNECTION_PARAMS)
+    connect = functools.partial(driver.connect, **conn_params)
+    for scale in (int(s) for s in scales.split(",")):
+        for result in _run_db_scale(connect, schema, rooms * scale, aliases,
+                                    events * scale, skew, repeat, samples):
+            result.update(benchmark="db", scale=scale, version=__version__)
+            print(json.dumps(result, sort_keys=True), flush=True)
+
+
+_HTTP_CONFIG = """\
+[synpurge]
+homeserver = {url}
+token = bench
+keep = {keep} days
+purge_request_timeout = 1 hour
+jobs = {jobs}
+async_purge = {async_purge}
+max_request_rate = {max_request_rate}
+
+[#public.*:bench]
+pattern = true
+"""
+
+
+def _populate_homeserver(hs, rooms, events, skew, span_days, private_every):
+    """
+    Adds rooms to the stand-in homeserver. Every ``private_every``-th room
+    is left out of the room directory. Returns the aliases of those.
+    """
+    now_ms, span_ms = int(time.time() * 1000), span_days * 24 * 3600 * 1000
+    private = []
+    for i, count in enumerate(_skewed_counts(events, rooms, skew), 1):
+        public = not private_every or i % private_every != 0
+        alias = "#{}{}:bench".format("public" if public else "private", i)
+        if not public:
+            private.append(alias)
+        hs.add_room("!room{}:bench".format(i), aliases=(alias,), public=public,
+                    events=[("$e{}_{}:bench".format(i, k),
+                             now_ms - span_ms + k * span_ms // count)
+                            for k in range(1, count + 1)])
+    return private
+
+
+def _run_http(rooms, events, skew, keep, span_days, private_every, jobs,
+              async_purge, max_request_rate, hs_options):
+    import os
+    import tempfile
+    from . import cli, standin
+
+    hs = standin.Homeserver(**hs_options)
+    private = _populate_homeserver(hs, rooms, events, skew, span_days, private_every)
+    total_events = sum(len(room.events) for room in hs.rooms.values())
+
+    with standin.StandinServer(hs) as server:
+        fd, config_path = tempfile.mkstemp(prefix="synpurge-bench-", suffix=".conf")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(_HTTP_CONFIG.format(url=server.url, keep=keep, jobs=jobs,
+                                            async_purge=str(async_purge).lower(),
+                                            max_request_rate=max_request_rate))
+                for alias in private:
+                    f.write("\n[{}]\n".format(alias))
+            error = None
+            started = time.monotonic()
+            try:
+                cli.purge(config_path)
+            except (Exception, SystemExit) as e:
+                error = str(e) or e.__class__.__name__
+            elapsed = time.monotonic() - started
+        finally:
+            os.unlink(config_path)
+
+    purged = hs.completed_purges()
+    return dict(operation="purge", seconds=elapsed, error=error,
+                rooms=rooms, events=total_events, skew=skew, jobs=jobs,
+                async_purge=async_purge, max_request_rate=max_request_rate,
+                rooms_purged=purged,
+                rooms_per_second=purged / elapsed if elapsed else None,
+                requests=hs.stats.total_requests,
+                requests_by_route=hs.stats.requests,
+                rate_limited=hs.stats.rate_limited,
+                bytes_received=hs.stats.bytes_received,
+                bytes_sent=hs.stats.bytes_sent,
+                events_left=sum(len(room.events) for room in hs.rooms.values()),
+                **hs_options)
+
+
+@bench
+def http(rooms: "number of rooms at scale 1" = 100,
+         events: "number of events at scale 1" = 10000,
+         skew: "skew of the per-room event counts" = 1.0,
+         scales: "comma-separated list of scale factors" = "1",
+         keep: "days of history to keep" = 30,
+         span_days: "days over which events are spread" = 90,
+         private_every: "every n-th room is not in the directory (0: none)" = 4,
+         jobs: "number of purges to run at the same time" = 1,
+         async_purge: "start purges and poll for their status" = False,
+         max_request_rate: "client-side limit of requests per second (0: none)" = 0.0,
+         latency: "latency of each request, in seconds" = 0.0,
+         rate_limit: "requests per second before replying 429 (0: none)" = 0.0,
+         purge_duration: "seconds each purge takes to complete" = 0.0,
+         blocking_purges: "purge requests wait for purges to complete" = False,
+         no_timestamp_to_event: "simulate a server without timestamp_to_event" = False,
+         debug: "enable debugging output" = False,
+         verbose: "enable verbose operation" = False):
+    """Benchmark purging over HTTP against a local stand-in homeserver."""
+    logging.basicConfig(level=logging.DEBUG if debug else
+                        logging.INFO if verbose else logging.WARNING)
+    from . import __version__
+    hs_options = dict(latency=latency, rate_limit=rate_limit,
+                      purge_duration=purge_duration,
+                      blocking_purges=blocking_purges,
+                      timestamp_to_event=not no_timestamp_to_event)
+    for scale in (int(s) for s in scales.split(",")):
+        result = _run_http(rooms * scale, events * scale, skew, keep, span_days,
+                           private_every, jobs, async_purge, max_request_rate,
+                           hs_options)
+        result.update(benchmark="http", scale=scale, version=__version__)
+        print(json.dumps(result, sort_keys=True), flush=True)
+
+
+if __name__ == "__main__":
+    bench()
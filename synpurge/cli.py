@@ -28,50 +28,150 @@ def check(path: "configuration file",
     """Load and validate a configuration file."""
     from . import config
     try:
-        c = config.load(path)
+        configs = config.load_all(path)
     except Exception as e:
         raise SystemExit(e)
     if verbose:
-        return c.as_config_snippet()
+        return "\n\n".join(c.as_config_snippet() for c in configs)
 
 
-def _configure(config_path,
-               open_database=False,
-               require_database=True,
-               debug=False,
-               verbose=False):
+def _configure_logging(debug=False, verbose=False):
     if debug:
         logging.basicConfig(level=logging.DEBUG)
     elif verbose:
         logging.basicConfig(level=logging.INFO)
 
-    from . import config, pg
+
+def _configure(config_path,
+               open_database=False,
+               require_database=True,
+               debug=False,
+               verbose=False,
+               homeserver=None):
+    _configure_logging(debug, verbose)
+
+    from . import config
     try:
-        c = config.load(config_path)
+        c = config.load(config_path, homeserver)
     except Exception as e:
         raise SystemExit("Error loading configuration: {!s}".format(e))
 
+    return c, _open_database(c, open_database, require_database)
+
+
+def _open_database(c, open_database=True, require_database=True):
+    from . import pg
     db = None
     if open_database:
         if c.database:
-            db = pg.open(c.database)
+            db = pg.open(c.database, c.metric_labels)
             log.debug("Using PostgreSQL: %r", db)
         elif require_database:
             raise SystemExit("No database configured")
+    return db
+
 
-    return c, db
+def _make_api(c):
+    from . import minimx
+    directory_cache = None
+    if c.directory_cache:
+        from .directory import open_cache
+        directory_cache = open_cache(c.directory_cache, c.directory_cache_ttl)
+    return minimx.API(homeserver=c.homeserver, token=c.token,
+                      directory_cache=directory_cache,
+                      directory_search=c.directory_search,
+                      retry_policy=minimx.RetryPolicy(c.max_attempts,
+                                                      c.max_attempts_by_endpoint),
+                      rate_limiter=minimx.RateLimiter(c.max_request_rate),
+                      metric_labels=c.metric_labels)
+
+
+def _make_throttle(c, pgdb):
+    if not c.database:
+        return None
+    from . import pg
+    throttle = pg.Throttle(pgdb.load_sample,
+                           max_replication_lag=c.database.max_replication_lag,
+                           max_wal_rate=c.database.max_wal_rate,
+                           max_active_backends=c.database.max_active_backends)
+    return throttle if throttle.enabled else None
+
+
+def _estimate_purges(purges, api, pgdb):
+    from . import pg, purger
+    if pgdb is not None:
+        return pgdb.estimate_purges((p.room_id, None if p.delete else p.event_id)
+                                    for p in purges)
+
+    # Only events can be counted using the API, paginating back from the
+    # reference events, and deleted rooms cannot be estimated at all.
+    def estimate(p):
+        events, capped = purger.estimate_purge_size(p.room_id, p.event_id, api,
+                                                    params=dict(access_token=p.config.token))
+        return pg.PurgeEstimate(events=events, lower_bound=capped)
+
+    return dict((p.room_id, estimate(p)) for p in purges if not p.delete)
+
+
+def _approx(estimate):
+    return "≥" if estimate.lower_bound else "~"
+
+
+def _pretend_report(purges, estimates, now_ms, as_json):
+    from . import pg, purger
+    total = pg.PurgeEstimate()
+    rooms, lines = [], []
+    for purge in purges:
+        estimate = estimates.get(purge.room_id)
+        if estimate is not None:
+            total.add(estimate)
+        rooms.append(dict(room_id=purge.room_id,
+                          name=purge.room_display_name,
+                          action="delete" if purge.delete else "purge",
+                          event_id=purge.event_id,
+                          cutoff_ms=None if purge.delete else purge.cutoff_ms(now_ms),
+                          estimate=None if estimate is None else estimate.asdict()))
+        if as_json:
+            continue
+        if purge.delete:
+            line = "{} delete ({}, no local members)".format(purge.room_id,
+                                                             purge.room_display_name)
+        else:
+            cutoff = purger.format_epoch_ms(purge.cutoff_ms(now_ms))
+            line = "{} {} ({}, keep since {})".format(purge.room_id, purge.event_id,
+                                                      purge.room_display_name, cutoff)
+        if estimate is not None:
+            line += ": {}{} events".format(_approx(estimate), estimate.events)
+            if estimate.rows:
+                line += ", ~{} rows, ~{} bytes".format(estimate.total_rows,
+                                                       estimate.total_bytes)
+        lines.append(line)
+
+    if as_json:
+        return dict(rooms=rooms, total=total.asdict())
+
+    line = "Total: {} rooms, {}{} events".format(len(rooms), _approx(total), total.events)
+    if total.rows:
+        line += ", ~{} rows, ~{} bytes".format(total.total_rows, total.total_bytes)
+    lines.append(line)
+    for table in sorted(total.rows, key=total.bytes.get, reverse=True):
+        lines.append("  {}: ~{} rows, ~{} bytes".format(table, total.rows[table],
+                                                        total.bytes[table]))
+    return "\n".join(lines)
 
 
 @cmd
 def room_info(path: "configuration file",
               room: "room ID or alias",
               debug: "enable debugging output" = False,
-              json: "output information as JSON" = False):
+              json: "output information as JSON" = False,
+              homeserver: "name of the homeserver, if several are configured" = None):
     """Obtains information about a room."""
     c, pgdb = _configure(path,
                          open_database=True,
                          require_database=True,
-                         debug=debug)
+                         debug=debug,
+                         homeserver=homeserver)
 
     # TODO: Provide an alternate implemenation using the HTTP API.
     if room.startswith("!"):
@@ -105,13 +205,15 @@ def cleanup(path: "configuration file",
             reindex: "re-create indexes" = False,
             full: "clean the whole database" = False,
             debug: "enable debugging output" = False,
-            verbose: "enable verbose operation" = False):
+            verbose: "enable verbose operation" = False,
+            homeserver: "name of the homeserver, if several are configured" = None):
     """Cleans up the database after purging."""
     c, pgdb = _configure(path,
                          open_database=True,
                          require_database=True,
                          debug=debug,
-                         verbose=verbose)
+                         verbose=verbose,
+                         homeserver=homeserver)
     if full:
         pgdb.cleanup_full()
         if reindex:
@@ -126,107 +228,471 @@ def cleanup(path: "configuration file",
 def reindex(path: "configuration file",
             concurrent: "enable concurrent reindexing" = False,
             debug: "enable debugging output" = False,
-            verbose: "enable verbose operation" = False):
+            verbose: "enable verbose operation" = False,
+            homeserver: "name of the homeserver, if several are configured" = None):
     """Reindex the database."""
     c, pgdb = _configure(path,
                          open_database=True,
                          require_database=True,
                          debug=debug,
-                         verbose=verbose)
+                         verbose=verbose,
+                         homeserver=homeserver)
     if concurrent:
         pgdb.reindex_concurrent()
     else:
         pgdb.reindex()
 
 
+@cmd
+def repack(path: "configuration file",
+           *tables: "tables to compact",
+           debug: "enable debugging output" = False,
+           verbose: "enable verbose operation" = False,
+           homeserver: "name of the homeserver, if several are configured" = None):
+    """Compact tables online, without locking them during the rewrite."""
+    if not tables:
+        raise SystemExit("No tables given")
+    c, pgdb = _configure(path,
+                         open_database=True,
+                         require_database=True,
+                         debug=debug,
+                         verbose=verbose,
+                         homeserver=homeserver)
+    for table_name in tables:
+        before = pgdb.relation_sizes((table_name,)).get(table_name)
+        if pgdb.repack_table(table_name) is None:
+            print("Size of {}: {} bytes, cannot be repacked".format(table_name, before))
+        else:
+            print("Size of {}: {} -> {} bytes".format(table_name, before,
+                                                      pgdb.relation_sizes((table_name,)).get(table_name)))
+
+
+_STATE_TABLES = ("state_groups", "state_group_edges", "state_groups_state")
+
+
+@cmd
+def compact_state(path: "configuration file",
+                  room: "only compact the state of this room ID" = None,
+                  keep_chains: "do not collapse delta chains" = False,
+                  batch_size: "state groups handled in each transaction" = 100,
+                  pause: "seconds to wait between transactions" = 0.0,
+                  debug: "enable debugging output" = False,
+                  verbose: "enable verbose operation" = False,
+                  json: "output the results as JSON" = False,
+                  homeserver: "name of the homeserver, if several are configured" = None):
+    """Remove state groups no longer needed after purging."""
+    if batch_size < 1:
+        raise SystemExit("The batch size must be positive")
+    c, pgdb = _configure(path,
+                         open_database=True,
+                         require_database=True,
+                         debug=debug,
+                         verbose=verbose,
+                         homeserver=homeserver)
+    if room is not None and not room.startswith("!"):
+        room_id = pgdb.get_room_id(room)
+        if room_id is None:
+            raise SystemExit("No room has the alias {}".format(room))
+        room = room_id
+
+    sizes_before = pgdb.relation_sizes(_STATE_TABLES)
+    summary = pgdb.compact_state(room_ids=None if room is None else [room],
+                                 collapse=not keep_chains,
+                                 batch_size=batch_size,
+                                 pause=pause,
+                                 throttle=_make_throttle(c, pgdb))
+    sizes_after = pgdb.relation_sizes(_STATE_TABLES)
+
+    if json:
+        import json
+        result = summary.asdict()
+        result["relation_bytes"] = dict((name, dict(before=sizes_before.get(name),
+                                                    after=sizes_after.get(name)))
+                                        for name in _STATE_TABLES)
+        return json.dumps(result, indent="  ", sort_keys=True)
+
+    print("Rooms:            ", summary.rooms)
+    print("Collapsed groups: ", summary.collapsed_groups)
+    print("Deleted groups:   ", summary.deleted_groups)
+    print("Deleted edges:    ", summary.deleted_edges)
+    print("State rows:        -{} +{}".format(summary.deleted_rows, summary.inserted_rows))
+    print("State bytes:       -{} +{}".format(summary.deleted_bytes, summary.inserted_bytes))
+    for name in _STATE_TABLES:
+        print("Size of {}: {} -> {} bytes".format(name, sizes_before.get(name),
+                                                  sizes_after.get(name)))
+
+
 @cmd
 def purge(path: "configuration file",
           debug: "enable debugging output" = False,
           verbose: "enable verbose operation" = False,
           pretend: "only show what would be done" = False,
           keep_going: "keep going on purge timeouts" = False,
-          concurrent: "enable concurrent reindexing" = False):
+          concurrent: "enable concurrent reindexing" = False,
+          jobs: "number of purges to run at the same time" = 0,
+          async_purge: "start purges and poll for their status" = False,
+          state_file: "file which records the purged rooms" = None,
+          largest_first: "purge rooms with more history first" = False,
+          max_duration: "do not start new purges after this time, e.g. '3 hours'" = None,
+          metrics_file: "write Prometheus metrics to this file" = None,
+          json: "output the --pretend report as JSON" = False,
+          homeserver: "only purge the rooms of this homeserver" = None,
+          total_jobs: "maximum number of purges at the same time, for all homeservers" = 0):
     """Run a batch of room history purges."""
-    c, pgdb = _configure(path,
-                         open_database=True,
-                         require_database=False,
-                         debug=debug,
-                         verbose=verbose)
+    if jobs < 0:
+        raise SystemExit("The number of jobs cannot be negative")
+    if total_jobs < 0:
+        raise SystemExit("The total number of jobs cannot be negative")
+    if json and not pretend:
+        raise SystemExit("JSON output is only available with --pretend")
+
+    import time
+    from .metrics import registry
+    started = time.monotonic()
+    registry.set("synpurge_run_start_timestamp_seconds", time.time())
+
+    _configure_logging(debug, verbose)
+    from . import config
+    try:
+        if homeserver is None:
+            configs = config.load_all(path)
+        else:
+            configs = [config.load(path, homeserver)]
+    except Exception as e:
+        raise SystemExit("Error loading configuration: {!s}".format(e))
 
-    from . import purger
-    from . import minimx
+    if len(configs) > 1:
+        if state_file:
+            raise SystemExit("--state-file cannot be used with several homeservers, "
+                             "use the state_file option of each one instead")
+        state_files = [c.state_file for c in configs if c.state_file]
+        if len(state_files) != len(set(state_files)):
+            raise SystemExit("Each homeserver needs a different state_file")
 
-    api = minimx.API(homeserver=c.homeserver, token=c.token)
-    if c.database:
-        assert pgdb is not None
-        if c.database.reindex_full and concurrent:
-            raise SystemExit("reindex_full (from configuration file) cannot "
-                             "be used simultanously with --concurrent")
+    if max_duration:
+        try:
+            max_duration = config.parse_timedelta(max_duration)
+        except ValueError as e:
+            raise SystemExit("Invalid --max-duration: {!s}".format(e))
+
+    # Homeservers share the cap, each one still limited by its own "jobs".
+    slots = None
+    if total_jobs:
+        import threading
+        slots = threading.BoundedSemaphore(total_jobs)
+
+    options = dict(started=started, slots=slots, pretend=pretend,
+                   keep_going=keep_going, concurrent=concurrent, jobs=jobs,
+                   async_purge=async_purge, state_file=state_file,
+                   largest_first=largest_first, max_duration=max_duration,
+                   with_metrics=bool(metrics_file or any(c.metrics_file for c in configs)),
+                   as_json=json)
 
-        def find_event_id(room_id, upto, _token=None):
-            return pgdb.find_event_id(room_id, upto)
+    try:
+        if len(configs) == 1:
+            reports = [_purge_homeserver(configs[0], **options)]
+        else:
+            reports = _purge_homeservers(configs, options)
+    finally:
+        metrics_file = metrics_file or next((c.metrics_file for c in configs
+                                             if c.metrics_file), None)
+        if metrics_file and not pretend:
+            registry.set("synpurge_run_duration_seconds", time.monotonic() - started)
+            registry.write_textfile(metrics_file)
+
+    if not pretend:
+        return
+    if len(configs) == 1:
+        report = reports[0]
+    elif json:
+        report = dict((c.name, r) for c, r in zip(configs, reports))
     else:
-        def find_event_id(room_id, upto, token=None):
-            params = None if token is None else dict(access_token=token)
-            return purger.find_event_id(room_id, upto, api, params=params)
+        report = "\n\n".join("[{}]\n{}".format(c.name, r) for c, r in zip(configs, reports))
+    if json:
+        import json
+        return json.dumps(report, indent="  ", sort_keys=True)
+    return report
+
+
+def _purge_homeservers(configs, options):
+    """
+    Purges the rooms of several homeservers at the same time, one thread
+    each. Returns their results in the same order as ``configs``; failures
+    are logged, and reported once all of them have finished.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(configs)) as pool:
+        futures = [pool.submit(_purge_homeserver, c, **options) for c in configs]
+
+    results, failed = [], []
+    for c, future in zip(configs, futures):
+        try:
+            results.append(future.result())
+        except (Exception, SystemExit) as e:
+            log.error("Purging homeserver %s failed: %s", c.name, e)
+            failed.append(c.name)
+    if failed:
+        raise SystemExit("Purging failed for homeservers: {}".format(", ".join(failed)))
+    return results
+
+
+def _purge_homeserver(c, started, slots, pretend, keep_going, concurrent, jobs,
+                      async_purge, state_file, largest_first, max_duration,
+                      with_metrics, as_json):
+    import itertools
+    import time
+    from . import purger
+    from . import minimx
+    from .metrics import registry
 
-    log.info("Resolving room aliases")
+    # Each homeserver uses its own HTTP session and database connections.
+    labels = c.metric_labels
+    pgdb = _open_database(c, require_database=False)
     try:
-        purges, warnings = purger.resolve_room_ids(c, pgdb or api, True)
-    except purger.DuplicateRoomId as e:
-        raise SystemExit("Two configuration items resolve to the same room: {}".format(e))
+        api = _make_api(c)
+        if c.database:
+            assert pgdb is not None
+            if c.database.reindex_full and concurrent:
+                raise SystemExit("reindex_full (from configuration file) cannot "
+                                 "be used simultanously with --concurrent")
 
-    if warnings:
-        for ex in warnings:
-            log.info("During alias resolution: {}".format(e))
+        log.info("Resolving room aliases")
+        try:
+            purges, warnings = purger.resolve_room_ids(c, pgdb or api, True)
+        except purger.DuplicateRoomId as e:
+            raise SystemExit("Two configuration items resolve to the same room: {}".format(e))
 
-    import delorean
-    import itertools
-    now = delorean.utcnow()
-    num_purges = len(purges)
-    for current, purge in zip(itertools.count(1), purges):
-        log.info("Finding reference event (%i/%i) for room %s (%s)",
-                 current, num_purges, purge.room_id, purge.room_display_name)
-        purge.event_id = find_event_id(purge.room_id,
-                                       now - purge.config.keep,
-                                       purge.config.token)
-
-    # Remove the rooms for which a suitable reference event couldn't be found.
-    purges = [p for p in purges if p.event_id is not None]
-    num_purges = len(purges)
-
-    if pretend:
-        for purge in purges:
-            print("{} {} ({}, keep up to {})".format(purge.room_id, purge.event_id,
-                                                     purge.room_display_name,
-                                                     (now - purge.config.keep).humanize()))
-        return
+        if warnings:
+            for ex in warnings:
+                log.info("During alias resolution: {}".format(ex))
+
+        purges, deletions = purger.mark_abandoned(purges, pgdb or api)
+        now_ms = purger.epoch_ms()
+        num_purges = len(purges) + len(deletions)
 
-    for current, purge in zip(itertools.count(1), purges):
-        log.info("Purging (%i/%i) for room %s (%s), event %s",
-                 current, num_purges, purge.room_id,
-                 purge.room_display_name, purge.event_id)
-        try:
-            api.purge_history(purge.room_id, purge.event_id,
-                              params=dict(access_token=purge.config.token))
-        except minimx.APITimeout:
-            if keep_going:
-                log.info("Timed out purging room %s (%s) - continuing",
-                         purge.room_id, purge.room_display_name)
-            else:
-                raise SystemExit("Timed out purging room {} ({})".format(purge.room_id,
-                                                                         purge.room_display_name))
         if c.database:
-            assert pgdb is not None
-            if c.database.clean_interval and current % c.database.clean_interval == 0:
-                if c.database.clean_full:
-                    pgdb.cleanup_full()
+            def lookup(batch):
+                with registry.timer("synpurge_lookup_seconds", **labels):
+                    event_ids = pgdb.find_event_ids((p.room_id, p.cutoff_ms(now_ms))
+                                                    for p in batch)
+                for purge in batch:
+                    purge.event_id = event_ids.get(purge.room_id)
+            lookup_batch_size = purger.LOOKUP_BATCH_SIZE
+        else:
+            def lookup(batch):
+                for purge in batch:
+                    log.info("Finding reference event for room %s (%s)",
+                             purge.room_id, purge.room_display_name)
+                    with registry.timer("synpurge_lookup_seconds", **labels):
+                        purge.event_id = purger.find_event_id(purge.room_id,
+                                                              purge.cutoff_ms(now_ms), api,
+                                                              params=dict(access_token=purge.config.token))
+            lookup_batch_size = 1
+
+        if largest_first or c.largest_first:
+            if c.database:
+                log.info("Estimating purge sizes for %i rooms", num_purges)
+                counts = pgdb.count_events_before((p.room_id, p.cutoff_ms(now_ms))
+                                                  for p in purges)
+                for purge in purges:
+                    purge.estimate = counts.get(purge.room_id, 0)
+                purges = purger.lookup_event_ids(purger.order_by_estimate(purges, labels),
+                                                 lookup, lookup_batch_size, labels=labels)
+            else:
+                # Sizes are estimated paginating back from the reference events,
+                # so all of them need to be known before purging can start. Only
+                # a few pages are counted, so the order is approximate for rooms
+                # with more history than that.
+                purges = list(purger.lookup_event_ids(purges, lookup, lookup_batch_size,
+                                                      labels=labels))
+                log.info("Estimating purge sizes for %i rooms", len(purges))
+                for purge in purges:
+                    params = dict(access_token=purge.config.token)
+                    purge.estimate, _ = purger.estimate_purge_size(purge.room_id, purge.event_id,
+                                                                   api, params=params)
+                purges = purger.order_by_estimate(purges, labels)
+        else:
+            # Rooms flow into the purge stage as soon as their reference event is
+            # found; those for which a suitable one cannot be found are skipped.
+            purges = purger.lookup_event_ids(purges, lookup, lookup_batch_size,
+                                             labels=labels)
+
+        state_file = state_file or c.state_file
+        if state_file:
+            from . import state
+            store = state.open(state_file)
+            log.debug("Using state file: %r", store)
+            purges = store.skip_purged(purges, labels)
+        else:
+            store = None
+
+        # Deleting abandoned rooms needs no reference event, so they go first.
+        purges = itertools.chain(deletions, purges)
+
+        if pretend:
+            try:
+                purges = list(purges)
+            finally:
+                if store is not None:
+                    store.close()
+            log.info("Estimating purge sizes for %i rooms", len(purges))
+            return _pretend_report(purges, _estimate_purges(purges, api, pgdb), now_ms, as_json)
+
+        purge_timeout = None
+        if c.purge_request_timeout is not None:
+            purge_timeout = c.purge_request_timeout.total_seconds()
+
+        throttle = _make_throttle(c, pgdb)
+
+        def purge_room(current, total, purge):
+            if slots is None:
+                return purge_or_delete(current, total, purge)
+            with slots:
+                return purge_or_delete(current, total, purge)
+
+        def purge_or_delete(current, total, purge):
+            if purge.delete:
+                return delete_room(current, total, purge)
+            log.info("Purging (%i/%i) for room %s (%s), event %s",
+                     current, total, purge.room_id,
+                     purge.room_display_name, purge.event_id)
+            purge_started = time.monotonic()
+            try:
+                purger.purge_room(purge, api, pgdb, c.database,
+                                  timeout=purge_timeout,
+                                  poll=async_purge or c.async_purge,
+                                  throttle=throttle)
+            except minimx.APITimeout:
+                registry.inc("synpurge_purge_timeouts_total", **labels)
+                if keep_going:
+                    log.info("Timed out purging room %s (%s) - continuing",
+                             purge.room_id, purge.room_display_name)
                 else:
-                    pgdb.cleanup()
-            if c.database.reindex_interval and current % c.database.reindex_interval == 0:
-                if c.database.reindex_full:
-                    pgdb.reindex_full()
-                elif concurrent:
-                    pgdb.reindex_concurrent()
+                    raise SystemExit("Timed out purging room {} ({})".format(purge.room_id,
+                                                                             purge.room_display_name))
+            else:
+                elapsed = time.monotonic() - purge_started
+                registry.observe("synpurge_purge_seconds", elapsed, **labels)
+                registry.inc("synpurge_rooms_purged_total", **labels)
+                log.info("Purged room %s (%s) in %.2fs", purge.room_id,
+                         purge.room_display_name, elapsed)
+                if store is not None:
+                    store.record(purge, purge.cutoff_ms(now_ms))
+
+        def delete_room(current, total, purge):
+            log.info("Deleting (%i/%i) room %s (%s), without local members",
+                     current, total, purge.room_id, purge.room_display_name)
+            try:
+                purger.delete_room(purge, api, timeout=purge_timeout, throttle=throttle)
+            except minimx.APITimeout:
+                registry.inc("synpurge_purge_timeouts_total", **labels)
+                if keep_going:
+                    log.info("Timed out deleting room %s (%s) - continuing",
+                             purge.room_id, purge.room_display_name)
                 else:
-                    pgdb.reindex()
+                    raise SystemExit("Timed out deleting room {} ({})".format(purge.room_id,
+                                                                              purge.room_display_name))
+            else:
+                registry.inc("synpurge_rooms_deleted_total", **labels)
+                log.info("Deleted room %s (%s)", purge.room_id, purge.room_display_name)
+
+        executor = purger.PurgeExecutor(purge_room, jobs=jobs or c.jobs)
+        max_duration = max_duration or c.max_duration
+        if max_duration is not None:
+            executor.deadline = started + max_duration.total_seconds()
+        if c.database:
+            assert pgdb is not None
+            if c.database.clean_full:
+                executor.add_barrier(c.database.clean_interval, pgdb.cleanup_full)
+            else:
+                executor.add_barrier(c.database.clean_interval, pgdb.cleanup)
+            if c.database.reindex_full:
+                executor.add_barrier(c.database.reindex_interval, pgdb.reindex_full)
+            elif concurrent:
+                executor.add_barrier(c.database.reindex_interval, pgdb.reindex_concurrent)
+            else:
+                executor.add_barrier(c.database.reindex_interval, pgdb.reindex)
+
+        relation_names = ()
+        if with_metrics and c.database:
+            tables = pgdb.table_stats()
+            relation_names = [t.name for t in tables]
+            for table in tables:
+                registry.set("synpurge_relation_bytes", table.total_bytes,
+                             table=table.name, when="before", **labels)
+
+        log.info("Purging up to %i rooms from %s, %i at a time",
+                 num_purges, c.homeserver, executor.jobs)
+        try:
+            executor.run(purges, total=num_purges)
+        finally:
+            if store is not None:
+                store.close()
+            if relation_names:
+                for name, size in pgdb.relation_sizes(relation_names).items():
+                    registry.set("synpurge_relation_bytes", size,
+                                 table=name, when="after", **labels)
+    finally:
+        if pgdb is not None:
+            pgdb.close()
+
+
+@cmd
+def daemon(path: "configuration file",
+           debug: "enable debugging output" = False,
+           verbose: "enable verbose operation" = False,
+           interval: "time between purge rounds, e.g. '15 minutes'" = None,
+           jobs: "number of purges to run at the same time" = 0,
+           async_purge: "start purges and poll for their status" = False,
+           state_file: "file which records the purged rooms" = None,
+           metrics_file: "write Prometheus metrics to this file" = None,
+           homeserver: "name of the homeserver, if several are configured" = None):
+    """Purge room history continuously, in small steps."""
+    if jobs < 0:
+        raise SystemExit("The number of jobs cannot be negative")
+
+    c, pgdb = _configure(path,
+                         open_database=True,
+                         require_database=False,
+                         debug=debug,
+                         verbose=verbose,
+                         homeserver=homeserver)
+
+    if interval:
+        from .config import parse_timedelta
+        try:
+            interval = parse_timedelta(interval)
+        except ValueError as e:
+            raise SystemExit("Invalid --interval: {!s}".format(e))
+    else:
+        interval = c.daemon_interval
+
+    if c.database and (c.database.clean_full or c.database.reindex_full):
+        log.warning("The daemon never uses clean_full nor reindex_full, "
+                    "which lock tables")
+
+    state_file = state_file or c.state_file
+    store = None
+    if state_file:
+        from . import state
+        store = state.open(state_file)
+
+    from .daemon import Daemon
+    d = Daemon(c, _make_api(c), pgdb,
+               interval=interval.total_seconds(),
+               maintenance_interval=c.daemon_maintenance_interval.total_seconds(),
+               jobs=jobs or c.jobs,
+               poll=async_purge or c.async_purge,
+               store=store,
+               throttle=_make_throttle(c, pgdb),
+               metrics_file=metrics_file or c.metrics_file)
+
+    import signal
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: d.stop())
+    log.info("Purging every %s", interval)
+    try:
+        d.run()
+    finally:
+        if store is not None:
+            store.close()
@@ -43,17 +43,90 @@ def _optional_string_to_timedelta(s):
     return None if s is None else _string_to_timedelta(s)
 
 
+parse_timedelta = _string_to_timedelta
+
+
 def _timedelta_to_string(d):
     if d.seconds > 0:
-        return "{} seconds".format(d.total_seconds())
+        return "{} seconds".format(int(d.total_seconds()))
     else:
         return "{} days".format(d.days)
 
 
+def _string_to_bool(s):
+    if isinstance(s, bool):
+        return s
+    value = s.strip().lower()
+    if value in ("1", "yes", "true", "on"):
+        return True
+    if value in ("0", "no", "false", "off"):
+        return False
+    raise ValueError("Invalid boolean: {!r}".format(s))
+
+
 def _optional_int(s):
     return None if s is None else int(s)
 
 
+_size_unit_map = dict(b=1, kb=1024, mb=1024 ** 2, gb=1024 ** 3, tb=1024 ** 4)
+
+
+def _optional_string_to_bytes(s):
+    if s is None or isinstance(s, int):
+        return s
+    m = re.match(r"^\s*(\d+)\s*([a-zA-Z]*)\s*$", s)
+    if m is None:
+        raise ValueError("Invalid size: {!r}".format(s))
+    unit = _size_unit_map.get(m.group(2).lower() or "b", None)
+    if unit is None:
+        raise ValueError("Invalid unit: {!r}".format(m.group(2)))
+    return int(m.group(1)) * unit
+
+
+def _string_to_attempts_map(s):
+    if isinstance(s, dict):
+        return s
+    attempts = {}
+    for item in s.replace(",", " ").split():
+        endpoint, sep, value = item.partition("=")
+        if not sep or not endpoint:
+            raise ValueError("Invalid endpoint attempts: {!r}".format(item))
+        attempts[endpoint] = int(value)
+        if attempts[endpoint] < 1:
+            raise ValueError("Attempts for {} must be positive".format(endpoint))
+    return attempts
+
+
+def _positive_int(instance, attribute, value):
+    if not isinstance(value, int) or value < 1:
+        raise ValueError("{} must be a positive integer (got {!r})".format(attribute.name, value))
+
+
+def _purge_engine(instance, attribute, value):
+    if value not in ("api", "sql"):
+        raise ValueError("{} must be 'api' or 'sql' (got {!r})".format(attribute.name, value))
+
+
+def _compact_method(instance, attribute, value):
+    if value not in ("vacuum", "repack"):
+        raise ValueError("{} must be 'vacuum' or 'repack' (got {!r})".format(attribute.name, value))
+
+
+_ABANDONED_POLICIES = ("keep", "purge", "delete")
+
+
+def _abandoned_policy(instance, attribute, value):
+    if value is not None and value not in _ABANDONED_POLICIES:
+        raise ValueError("{} must be one of {} (got {!r})".format(attribute.name,
+                                                                  ", ".join(_ABANDONED_POLICIES),
+                                                                  value))
+
+
+def _ratio(instance, attribute, value):
+    if not isinstance(value, float) or not 0.0 <= value <= 1.0:
+        raise ValueError("{} must be between 0 and 1 (got {!r})".format(attribute.name, value))
+
+
 @attr.s(frozen=True)
 class Database(object):
     user = attr.ib(validator=vv.instance_of(str))
@@ -64,24 +137,59 @@ class Database(object):
     host = attr.ib(validator=vv.instance_of(str), default="localhost")
     port = attr.ib(validator=vv.instance_of(int), default=5432, convert=int)
     clean_full = attr.ib(validator=vv.instance_of(bool),
-                         default=False, convert=bool)
+                         default=False, convert=_string_to_bool)
     clean_interval = attr.ib(validator=vv.instance_of(int),
                              default=0, convert=int)
     reindex_full = attr.ib(validator=vv.instance_of(bool),
-                           default=False, convert=bool)
+                           default=False, convert=_string_to_bool)
     reindex_interval = attr.ib(validator=vv.instance_of(int),
                                default=0, convert=int)
+    clean_tables = attr.ib(validator=_positive_int, default=10, convert=int)
+    clean_dead_ratio = attr.ib(validator=_ratio, default=0.1, convert=float)
+    clean_full_ratio = attr.ib(validator=_ratio, default=0.5, convert=float)
+    maintenance_jobs = attr.ib(validator=_positive_int, default=1, convert=int)
+    reindex_bloat_ratio = attr.ib(validator=_ratio, default=0.3, convert=float)
+    compact_method = attr.ib(validator=_compact_method, default="vacuum")
+    repack_lock_timeout = attr.ib(validator=vv.instance_of(float), default=5.0,
+                                  convert=float)
+    purge_engine = attr.ib(validator=_purge_engine, default="api")
+    purge_batch_size = attr.ib(validator=_positive_int, default=1000, convert=int)
+    purge_batch_pause = attr.ib(validator=vv.instance_of(float), default=0.0,
+                                convert=float)
+    max_replication_lag = attr.ib(validator=vv.optional(vv.instance_of(int)),
+                                  convert=_optional_string_to_bytes, default=None)
+    max_wal_rate = attr.ib(validator=vv.optional(vv.instance_of(int)),
+                           convert=_optional_string_to_bytes, default=None)
+    max_active_backends = attr.ib(validator=vv.optional(vv.instance_of(int)),
+                                  convert=_optional_int, default=None)
+    maintenance_work_mem = attr.ib(validator=vv.optional(vv.instance_of(str)),
+                                   default=None)
 
-    def as_config_snippet(self):
+    def as_config_snippet(self, name=None):
         lines = [
-            "[database]",
+            "[database]" if name is None else "[database:{}]".format(name),
             "clean_interval = {}".format(self.clean_interval),
             "clean_full = {}".format("true" if self.clean_full else "false"),
+            "clean_tables = {}".format(self.clean_tables),
+            "clean_dead_ratio = {}".format(self.clean_dead_ratio),
+            "clean_full_ratio = {}".format(self.clean_full_ratio),
+            "maintenance_jobs = {}".format(self.maintenance_jobs),
+            "reindex_bloat_ratio = {}".format(self.reindex_bloat_ratio),
+            "compact_method = {}".format(self.compact_method),
+            "repack_lock_timeout = {}".format(self.repack_lock_timeout),
+            "purge_engine = {}".format(self.purge_engine),
+            "purge_batch_size = {}".format(self.purge_batch_size),
+            "purge_batch_pause = {}".format(self.purge_batch_pause),
             "reindex_interval = {}".format(self.reindex_interval),
             "reindex_full = {}".format("true" if self.reindex_full else "false"),
             "host = {}".format(self.host),
             "user = {}".format(self.user),
         ]
+        for key in ("max_replication_lag", "max_wal_rate", "max_active_backends"):
+            if getattr(self, key) is not None:
+                lines.append("{} = {}".format(key, getattr(self, key)))
+        if self.maintenance_work_mem is not None:
+            lines.append("maintenance_work_mem = {}".format(self.maintenance_work_mem))
         if self.password is not None:
             lines.append("password = {}".format(self.password))
         if self.database is not None:
@@ -106,17 +214,92 @@ class Config(object):
                 default=None)
     database = attr.ib(validator=vv.optional(vv.instance_of(Database)),
                        default=None)
+    jobs = attr.ib(validator=_positive_int, default=1, convert=int)
+    async_purge = attr.ib(validator=vv.instance_of(bool), default=False,
+                          convert=_string_to_bool)
+    state_file = attr.ib(validator=vv.optional(vv.instance_of(str)),
+                         default=None)
+    largest_first = attr.ib(validator=vv.instance_of(bool), default=False,
+                            convert=_string_to_bool)
+    max_duration = attr.ib(validator=vv.optional(vv.instance_of(timedelta)),
+                           convert=_optional_string_to_timedelta,
+                           default=None)
+    metrics_file = attr.ib(validator=vv.optional(vv.instance_of(str)),
+                           default=None)
+    directory_cache = attr.ib(validator=vv.optional(vv.instance_of(str)),
+                              default=None)
+    directory_cache_ttl = attr.ib(validator=vv.instance_of(timedelta),
+                                  convert=_string_to_timedelta,
+                                  default="1 hours")
+    directory_search = attr.ib(validator=vv.instance_of(bool), default=False,
+                               convert=_string_to_bool)
+    max_attempts = attr.ib(validator=_positive_int, default=5, convert=int)
+    max_attempts_by_endpoint = attr.ib(validator=vv.instance_of(dict),
+                                       default=attr.Factory(dict),
+                                       convert=_string_to_attempts_map,
+                                       hash=False)
+    max_request_rate = attr.ib(validator=vv.instance_of(float), default=0.0,
+                               convert=float)
+    daemon_interval = attr.ib(validator=vv.instance_of(timedelta),
+                              convert=_string_to_timedelta,
+                              default="15 minutes")
+    daemon_maintenance_interval = attr.ib(validator=vv.instance_of(timedelta),
+                                          convert=_string_to_timedelta,
+                                          default="1 hours")
+    abandoned_rooms = attr.ib(validator=_abandoned_policy, default="keep")
+    name = attr.ib(validator=vv.optional(vv.instance_of(str)), default=None)
+
+    @property
+    def metric_labels(self):
+        """Labels which tell apart the metrics of each named homeserver."""
+        return {} if self.name is None else dict(homeserver=self.name)
 
     def as_config_snippet(self):
-        lines = ["[synpurge]",
+        lines = ["[synpurge]" if self.name is None else "[synpurge:{}]".format(self.name),
                  "homeserver = {}".format(self.homeserver),
                  "keep = {}".format(_timedelta_to_string(self.keep)),
                  "token = {}".format(self.token)]
+        if self.jobs != 1:
+            lines.append("jobs = {}".format(self.jobs))
+        if self.async_purge:
+            lines.append("async_purge = true")
+        if self.state_file is not None:
+            lines.append("state_file = {}".format(self.state_file))
+        if self.largest_first:
+            lines.append("largest_first = true")
+        if self.max_duration is not None:
+            value = _timedelta_to_string(self.max_duration)
+            lines.append("max_duration = {}".format(value))
+        if self.metrics_file is not None:
+            lines.append("metrics_file = {}".format(self.metrics_file))
+        if self.directory_cache is not None:
+            lines.append("directory_cache = {}".format(self.directory_cache))
+        if self.directory_cache_ttl != timedelta(hours=1):
+            value = _timedelta_to_string(self.directory_cache_ttl)
+            lines.append("directory_cache_ttl = {}".format(value))
+        if self.directory_search:
+            lines.append("directory_search = true")
+        if self.max_attempts != 5:
+            lines.append("max_attempts = {}".format(self.max_attempts))
+        if self.max_attempts_by_endpoint:
+            value = ", ".join("{}={}".format(k, v) for k, v in
+                              sorted(self.max_attempts_by_endpoint.items()))
+            lines.append("max_attempts_by_endpoint = {}".format(value))
+        if self.max_request_rate:
+            lines.append("max_request_rate = {}".format(self.max_request_rate))
+        if self.daemon_interval != timedelta(minutes=15):
+            value = _timedelta_to_string(self.daemon_interval)
+            lines.append("daemon_interval = {}".format(value))
+        if self.daemon_maintenance_interval != timedelta(hours=1):
+            value = _timedelta_to_string(self.daemon_maintenance_interval)
+            lines.append("daemon_maintenance_interval = {}".format(value))
+        if self.abandoned_rooms != "keep":
+            lines.append("abandoned_rooms = {}".format(self.abandoned_rooms))
         if self.purge_request_timeout is not None:
             value = _timedelta_to_string(self.purge_request_timeout)
             lines.append("purge_request_timeout = {}".format(value))
         if self.database:
-            lines.append("\n{}".format(self.database.as_config_snippet()))
+            lines.append("\n{}".format(self.database.as_config_snippet(self.name)))
         room_snippets = (r.as_config_snippet() for r in self.rooms)
         return "\n".join(lines) + "\n\n" + "\n\n".join(sorted(room_snippets))
 
@@ -134,7 +317,8 @@ class Room(object):
                      default=None)
     pattern = attr.ib(validator=vv.instance_of(bool),
                       default=False,
-                      convert=bool)
+                      convert=_string_to_bool)
+    _abandoned = attr.ib(validator=_abandoned_policy, default=None)
 
     def as_config_snippet(self):
         lines = ["[{}]".format(self.name)]
@@ -144,6 +328,8 @@ class Room(object):
             lines.append("token = {}".format(self._token))
         if self.pattern:
             lines.append("pattern = true")
+        if self._abandoned is not None:
+            lines.append("abandoned = {}".format(self._abandoned))
         return "\n".join(lines)
 
     @property
@@ -154,18 +340,225 @@ class Room(object):
     def token(self):
         return self._config.token if self._token is None else self._token
 
+    @property
+    def abandoned(self):
+        """What to do with rooms without local members: keep, purge or delete."""
+        return self._config.abandoned_rooms if self._abandoned is None else self._abandoned
+
+    def cutoff_ms(self, now_ms):
+        """Time before which history is purged, in milliseconds."""
+        return now_ms - int(self.keep.total_seconds() * 1000)
+
     def build_alias_matcher(self):
         re_match = re.compile(r"^" + self.name + r"$").match
         return lambda s: bool(re_match(s))
 
 
-def load(path):
+_REGEX_QUANTIFIERS = "*+?{"
+_REGEX_SPECIAL = "\\.^$|()[]" + _REGEX_QUANTIFIERS
+
+
+def _required_literal(pattern):
+    """
+    Returns the longest piece of literal text which any string matching a
+    regular expression must contain, or ``None`` if it cannot be told.
+    """
+    runs, run, depth, i = [], "", 0, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            if pattern[i + 1].isalnum():
+                # Character classes (\d, \w...) and assertions (\b...).
+                runs.append(run)
+                run = ""
+            elif depth == 0:
+                run += pattern[i + 1]
+            i += 2
+            continue
+        if c in _REGEX_QUANTIFIERS:
+            # The quantified character may not be there at all.
+            run = run[:-1]
+        if c not in _REGEX_SPECIAL and depth == 0:
+            run += c
+        else:
+            runs.append(run)
+            run = ""
+            if c == "|" and depth == 0:
+                return None
+            elif c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            elif c == "[":
+                # Skip the character class, which may contain "]" first.
+                end = pattern.find("]", i + 2)
+                if end < 0:
+                    return None
+                i = end
+            elif c == "{":
+                end = pattern.find("}", i)
+                i = len(pattern) if end < 0 else end
+        i += 1
+    runs.append(run)
+    return max(runs, key=len) or None
+
+
+class AliasMatcher(object):
+    """
+    Matches room aliases against the patterns of many room sections at once.
+
+    All the patterns are compiled into a single regular expression, which
+    checks each alias in one pass. :meth:`match` returns the section which
+    matched, trying them in order when more than one would match, and
+    :meth:`match_all` returns all of them. The anchored ``patterns`` can also
+    be handed to PostgreSQL.
+    """
+
+    def __init__(self, rooms):
+        self.rooms = tuple(rooms)
+        self.patterns = tuple(r"^(?:" + room.name + r")$" for room in self.rooms)
+        self._groups, self._matches, alternatives, group = [], [], [], 1
+        for pattern in self.patterns:
+            compiled = re.compile(pattern)
+            self._groups.append(group)
+            self._matches.append(compiled.match)
+            alternatives.append("(" + pattern + ")")
+            group += 1 + compiled.groups
+        self._re_match = re.compile("|".join(alternatives)).match
+
+    def match(self, alias):
+        m = self._re_match(alias)
+        if m is not None:
+            for room, group in zip(self.rooms, self._groups):
+                if m.group(group) is not None:
+                    return room
+        return None
+
+    def match_all(self, alias):
+        return [room for room, match in zip(self.rooms, self._matches) if match(alias)]
+
+    def search_terms(self, min_length=3):
+        """
+        Returns a set of strings such that every matching alias contains at
+        least one of them, or ``None`` if there is a pattern for which no
+        literal text of at least ``min_length`` characters is required.
+        """
+        terms = set()
+        for room in self.rooms:
+            term = _required_literal(room.name)
+            if term is None or len(term) < min_length:
+                return None
+            terms.add(term)
+        return terms
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __repr__(self):
+        return "AliasMatcher({!r})".format([room.name for room in self.rooms])
+
+
+def _section_name(section, kind):
+    """
+    Returns the homeserver name of a ``[kind:name]`` section, ``None`` for
+    a plain ``[kind]`` section, or ``False`` for sections of other kinds.
+    """
+    if section == kind:
+        return None
+    prefix = kind + ":"
+    if section.startswith(prefix) and len(section) > len(prefix):
+        return section[len(prefix):]
+    return False
+
+
+def _homeserver_blocks(lines):
+    """
+    Splits the lines of a configuration file in blocks which start with a
+    ``[synpurge]`` or ``[synpurge:name]`` section, the first block having
+    the lines before them. Yields ``(first_line_index, lines)`` tuples.
+    """
     from configparser import ConfigParser
-    ini = ConfigParser(default_section=None, interpolation=None)
-    ini.read(path)
-    rooms = set()
-    db = Database(**ini["database"]) if "database" in ini else None
-    cfg = Config(rooms=rooms, database=db, **ini["synpurge"])
-    [rooms.add(Room(name=s, config=cfg, **ini[s]))
-        for s in ini.sections() if s not in ("synpurge", "database")]
-    return cfg
+    start, block = 0, []
+    for index, line in enumerate(lines):
+        match = None if line[:1].isspace() else ConfigParser.SECTCRE.match(line.rstrip())
+        if match and _section_name(match.group("header"), "synpurge") is not False:
+            yield start, block
+            start, block = index, []
+        block.append(line)
+    yield start, block
+
+
+def load_all(path):
+    """
+    Loads a configuration file, which may configure several homeservers.
+
+    Each homeserver has a ``[synpurge:name]`` section, optionally with a
+    ``[database:name]`` one, and the room sections which come after it are
+    its rooms. Plain ``[synpurge]`` and ``[database]`` sections configure an
+    unnamed homeserver; when it is the only one, rooms can come anywhere.
+    The same room may be configured for several homeservers, as the blocks
+    of each one are parsed separately.
+    Returns a list of :class:`Config`, in the order they are configured.
+    """
+    from configparser import ConfigParser
+    with open(path) as f:
+        lines = f.readlines()
+
+    homeservers, databases, leading_rooms = [], {}, []
+    for start, block in _homeserver_blocks(lines):
+        ini = ConfigParser(default_section=None, interpolation=None)
+        # Padding keeps the line numbers in error messages right.
+        ini.read_string("\n" * start + "".join(block), path)
+        rooms = leading_rooms
+        for section in ini.sections():
+            name = _section_name(section, "synpurge")
+            if name is not False:
+                if any(name == n for n, _, _ in homeservers):
+                    raise ValueError("Duplicate section [{}]".format(section))
+                rooms = []
+                homeservers.append((name, ini[section], rooms))
+                continue
+            name = _section_name(section, "database")
+            if name is not False:
+                if name in databases:
+                    raise ValueError("Duplicate section [{}]".format(section))
+                databases[name] = ini[section]
+                continue
+            rooms.append(ini[section])
+
+    if not homeservers:
+        raise ValueError("No [synpurge] section")
+    for name in databases:
+        if not any(name == n for n, _, _ in homeservers):
+            raise ValueError("No homeserver for section [{}]".format(
+                "database" if name is None else "database:" + name))
+    if leading_rooms and len(homeservers) > 1:
+        raise ValueError("Room [{}] comes before any [synpurge] section".format(
+            leading_rooms[0].name))
+
+    configs = []
+    for name, section, rooms in homeservers:
+        db = Database(**databases[name]) if name in databases else None
+        cfg = Config(rooms=set(), database=db, name=name, **section)
+        if len(homeservers) == 1:
+            rooms = leading_rooms + rooms
+        [cfg.rooms.add(Room(name=s.name, config=cfg, **s)) for s in rooms]
+        configs.append(cfg)
+    return configs
+
+
+def load(path, name=None):
+    """
+    Loads the configuration for the homeserver with the given ``name``,
+    which can be omitted if the file configures a single homeserver.
+    """
+    configs = load_all(path)
+    if name is None:
+        if len(configs) > 1:
+            raise ValueError("Several homeservers configured, choose one of: {}".format(
+                ", ".join(str(c.name) for c in configs)))
+        return configs[0]
+    for cfg in configs:
+        if cfg.name == name:
+            return cfg
+    raise ValueError("No homeserver named {!r}".format(name))
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Continuous purging, as an alternative to running ``synpurge purge`` from
+cron. Each round purges only the history which has become older than the
+configured ``keep`` time since the previous round, and the purges of a
+round are spread over its whole duration.
+"""
+
+import attr
+import functools
+import itertools
+import logging
+import threading
+import time
+
+from . import config, minimx, purger
+from .metrics import registry
+from attr import validators as vv
+
+log = logging.getLogger(__name__)
+
+
+@attr.s
+class Daemon(object):
+    """
+    Runs a round of purges every ``interval`` seconds, until stopped.
+
+    Maintenance of the database, if configured, is done every
+    ``maintenance_interval`` seconds, alternating between vacuuming and
+    reindexing, so that neither runs in bulk. Both only touch the tables
+    and indexes which need it, and neither locks tables: bloated tables are
+    repacked with the "repack" compaction method, and otherwise get a plain
+    vacuum instead of ``VACUUM FULL``.
+    """
+    config = attr.ib(validator=vv.instance_of(config.Config))
+    api = attr.ib(validator=vv.instance_of(minimx.API))
+    db = attr.ib(default=None)
+    interval = attr.ib(validator=vv.instance_of(float), default=900.0,
+                       convert=float)
+    maintenance_interval = attr.ib(validator=vv.instance_of(float),
+                                   default=3600.0, convert=float)
+    jobs = attr.ib(validator=vv.instance_of(int), default=1, convert=int)
+    poll = attr.ib(validator=vv.instance_of(bool), default=False, convert=bool)
+    store = attr.ib(default=None)
+    throttle = attr.ib(default=None)
+    metrics_file = attr.ib(default=None)
+    _stopping = attr.ib(default=attr.Factory(threading.Event), init=False,
+                        repr=False)
+    _last_event_ids = attr.ib(default=attr.Factory(dict), init=False,
+                              repr=False)
+    _maintenance = attr.ib(default=None, init=False, repr=False)
+    _next_maintenance = attr.ib(default=None, init=False, repr=False)
+
+    def stop(self):
+        """Makes :meth:`run` return once the purges in progress are done."""
+        log.info("Stopping")
+        self._stopping.set()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def run(self):
+        if self.db is not None:
+            cleanup = functools.partial(self.db.cleanup, lock_tables=False)
+            self._maintenance = itertools.cycle((("cleanup", cleanup),
+                                                 ("reindex", self.db.reindex_concurrent)))
+            self._next_maintenance = time.monotonic() + self.maintenance_interval
+        while not self.stopping:
+            started = time.monotonic()
+            registry.set("synpurge_run_start_timestamp_seconds", time.time())
+            try:
+                self.run_once(deadline=started + self.interval)
+                self.__maintain()
+            except Exception:
+                # Whatever failed may work in the next round.
+                log.exception("Purge round failed")
+                registry.inc("synpurge_daemon_errors_total")
+            registry.set("synpurge_run_duration_seconds", time.monotonic() - started)
+            if self.metrics_file:
+                registry.write_textfile(self.metrics_file)
+            self._stopping.wait(max(0.0, started + self.interval - time.monotonic()))
+
+    def run_once(self, deadline=None):
+        """
+        Purges the rooms which have history older than their ``keep`` time.
+
+        If a ``deadline`` (as given by :func:`time.monotonic`) is passed, the
+        purges are evenly spread until then: before each one, the remaining
+        time is divided among the remaining rooms. Purges which are late are
+        started anyway, instead of being left for the next round.
+        """
+        source = self.api if self.db is None else self.db
+        source.forget_rooms()
+        purges, warnings = purger.resolve_room_ids(self.config, source, True)
+        for ex in warnings:
+            log.info("During alias resolution: %s", ex)
+        purges, deletions = purger.mark_abandoned(purges, source)
+
+        now_ms = purger.epoch_ms()
+        pending = list(deletions)
+        pending.extend(info for info in self.__find_event_ids(purges, now_ms)
+                       if info.event_id is not None and not self.__is_purged(info))
+        log.info("Round with %i rooms to purge, out of %i", len(pending), len(purges))
+        if not pending:
+            return
+
+        # Records use the cutoff used to find the reference events.
+        executor = purger.PurgeExecutor(functools.partial(self.__purge, now_ms),
+                                        jobs=self.jobs)
+        executor.run(self.__paced(pending, deadline), total=len(pending))
+
+    def __find_event_ids(self, purges, now_ms):
+        if self.db is not None:
+            event_ids = self.db.find_event_ids((info.room_id, info.cutoff_ms(now_ms))
+                                               for info in purges)
+            for info in purges:
+                info.event_id = event_ids.get(info.room_id)
+                yield info
+        else:
+            for info in purges:
+                info.event_id = purger.find_event_id(info.room_id,
+                                                     info.cutoff_ms(now_ms),
+                                                     self.api,
+                                                     params=dict(access_token=info.config.token))
+                yield info
+
+    def __is_purged(self, info):
+        if self._last_event_ids.get(info.room_id) == info.event_id:
+            return True
+        return self.store is not None and self.store.is_purged(info)
+
+    def __paced(self, purges, deadline):
+        for i, info in enumerate(purges):
+            if i > 0 and deadline is not None:
+                # One interval is left after the last purge, as it may take
+                # as long as the previous ones.
+                pace = max(0.0, deadline - time.monotonic()) / (len(purges) - i + 1)
+                if pace and self._stopping.wait(pace):
+                    break
+            if self.stopping:
+                break
+            yield info
+
+    def __purge(self, now_ms, current, total, info):
+        if info.delete:
+            return self.__delete(current, total, info)
+        log.info("Purging (%i/%i) for room %s (%s), event %s",
+                 current, total, info.room_id, info.room_display_name,
+                 info.event_id)
+        started = time.monotonic()
+        try:
+            purger.purge_room(info, self.api, self.db, self.config.database,
+                              timeout=self.__timeout(), poll=self.poll,
+                              throttle=self.throttle)
+        except minimx.APITimeout:
+            registry.inc("synpurge_purge_timeouts_total", **self.config.metric_labels)
+            log.warning("Timed out purging room %s (%s), will retry in the next round",
+                        info.room_id, info.room_display_name)
+            return
+        elapsed = time.monotonic() - started
+        registry.observe("synpurge_purge_seconds", elapsed, **self.config.metric_labels)
+        log.info("Purged room %s (%s) in %.2fs", info.room_id, info.room_display_name,
+                 elapsed)
+        registry.inc("synpurge_rooms_purged_total", **self.config.metric_labels)
+        self._last_event_ids[info.room_id] = info.event_id
+        if self.store is not None:
+            self.store.record(info, info.cutoff_ms(now_ms))
+
+    def __delete(self, current, total, info):
+        log.info("Deleting (%i/%i) room %s (%s), without local members",
+                 current, total, info.room_id, info.room_display_name)
+        try:
+            purger.delete_room(info, self.api, timeout=self.__timeout(),
+                               throttle=self.throttle)
+        except minimx.APITimeout:
+            registry.inc("synpurge_purge_timeouts_total", **self.config.metric_labels)
+            log.warning("Timed out deleting room %s (%s), will retry in the next round",
+                        info.room_id, info.room_display_name)
+            return
+        registry.inc("synpurge_rooms_deleted_total", **self.config.metric_labels)
+
+    def __timeout(self):
+        if self.config.purge_request_timeout is None:
+            return None
+        return self.config.purge_request_timeout.total_seconds()
+
+    def __maintain(self):
+        if self._maintenance is None or self.stopping:
+            return
+        if time.monotonic() < self._next_maintenance:
+            return
+        name, task = next(self._maintenance)
+        log.info("Running database maintenance: %s", name)
+        task()
+        self._next_maintenance = time.monotonic() + self.maintenance_interval
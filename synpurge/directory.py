@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+On-disk cache of room directories fetched using the HTTP API.
+
+Entries are keyed by homeserver and by the search terms used to filter the
+directory, so filtered and complete listings never get mixed up.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DirectoryCache(object):
+    """
+    Keeps the mapping of room IDs to aliases in a JSON file, for ``ttl``
+    seconds after it was fetched.
+    """
+
+    def __init__(self, path, ttl):
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def __key(homeserver, search_terms):
+        return "\n".join((homeserver,) + tuple(search_terms or ()))
+
+    def __read(self):
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning("Ignoring invalid directory cache %s: %s", self._path, e)
+            return {}
+
+    def load(self, homeserver, search_terms=None):
+        """Returns the cached rooms, or ``None`` if missing or expired."""
+        with self._lock:
+            entry = self.__read().get(self.__key(homeserver, search_terms))
+        if entry is None:
+            return None
+        age = time.time() - entry["fetched_at"]
+        if age > self._ttl:
+            log.debug("Directory cache entry expired %is ago", age - self._ttl)
+            return None
+        log.info("Using cached room directory (%i rooms, fetched %is ago)",
+                 len(entry["rooms"]), age)
+        return entry["rooms"]
+
+    def store(self, homeserver, rooms, search_terms=None):
+        with self._lock:
+            entries = self.__read()
+            now = time.time()
+            # Drop expired entries, so the file does not keep growing.
+            entries = dict((k, v) for k, v in entries.items()
+                           if now - v["fetched_at"] <= self._ttl)
+            entries[self.__key(homeserver, search_terms)] = \
+                dict(fetched_at=now, rooms=rooms)
+            tmp_path = "{}.{}.tmp".format(self._path, os.getpid())
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self._path)
+        log.debug("Cached %i rooms in %s", len(rooms), self._path)
+
+    def __repr__(self):
+        return "DirectoryCache(path={!r}, ttl={!r})".format(self._path, self._ttl)
+
+
+def open_cache(path, ttl):
+    return DirectoryCache(path, ttl.total_seconds())
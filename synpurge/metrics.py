@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Metrics about purge runs, in the Prometheus text exposition format.
+
+Modules record values in the global :data:`registry`, which the command
+line tool writes to a file suitable for the textfile collector of the
+node exporter once a run is done.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+_METRICS = {
+    "synpurge_run_start_timestamp_seconds":
+        ("gauge", "Time at which the last run started."),
+    "synpurge_run_duration_seconds":
+        ("gauge", "Duration of the last run."),
+    "synpurge_lookup_seconds":
+        ("summary", "Time spent finding reference events."),
+    "synpurge_purge_seconds":
+        ("summary", "Time spent purging rooms."),
+    "synpurge_rooms_purged_total":
+        ("counter", "Rooms purged."),
+    "synpurge_rooms_deleted_total":
+        ("counter", "Rooms without local members deleted as a whole."),
+    "synpurge_rooms_skipped_total":
+        ("counter", "Rooms skipped, by reason."),
+    "synpurge_purge_timeouts_total":
+        ("counter", "Purges which timed out."),
+    "synpurge_daemon_errors_total":
+        ("counter", "Purge rounds of the daemon which failed."),
+    "synpurge_request_retries_total":
+        ("counter", "Retried HTTP API requests, by endpoint and reason."),
+    "synpurge_maintenance_seconds":
+        ("gauge", "Duration of maintenance operations, by table."),
+    "synpurge_relation_bytes":
+        ("gauge", "Size of the biggest tables, before and after the run."),
+}
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ('{}="{}"'.format(k, _escape_label_value(v)) for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            for suffix, amount in (("_count", 1), ("_sum", value)):
+                key = (name + suffix, labels)
+                self._values[key] = self._values.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, name, gauge=False, **labels):
+        """
+        Observes the time taken by the body of a ``with`` statement, or
+        sets it as the value of a gauge if ``gauge`` is true.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            record = self.set if gauge else self.observe
+            record(name, time.monotonic() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines, described = [], set()
+        for (sample_name, labels), value in values:
+            name = sample_name
+            for suffix in ("_count", "_sum"):
+                if name.endswith(suffix) and name[:-len(suffix)] in _METRICS:
+                    name = name[:-len(suffix)]
+            if name not in described and name in _METRICS:
+                described.add(name)
+                kind, description = _METRICS[name]
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{}{} {}".format(sample_name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # Written to a temporary file first, so the node exporter never
+        # reads a partial file.
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+        log.debug("Wrote metrics to %s", path)
+
+
+registry = Registry()
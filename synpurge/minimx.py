@@ -6,9 +6,15 @@
 # Distributed under terms of the GPLv3 license.
 
 import attr
+import itertools
+import json
 import logging
+import random
 import requests
+import threading
+import time
 
+from .metrics import registry
 from attr import validators as vv
 from urllib.parse import quote as urlquote
 
@@ -17,9 +23,135 @@ log = logging.getLogger(__name__)
 
 
 class APIError(Exception):
+    def __init__(self, message, status_code=None, errcode=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.errcode = errcode
+
+    @classmethod
+    def from_response(cls, res):
+        try:
+            errcode = res.json().get("errcode")
+        except ValueError:
+            errcode = None
+        return cls(res.text, res.status_code, errcode)
+
+
+class APITimeout(APIError):
     pass
 
 
+class APIUnsupported(APIError):
+    pass
+
+
+@attr.s(frozen=True)
+class RetryPolicy(object):
+    """
+    Decides whether failed requests are retried, and how long to wait.
+
+    Rate-limited requests (429) are retried after the delay suggested by the
+    homeserver. Transient errors (502, 503, 504) and connection errors are
+    retried with jittered exponential backoff, but only for idempotent
+    methods: a purge may still be running in the homeserver after a proxy
+    gave up waiting for it, and must not be started again. Requests are
+    attempted at most ``max_attempts`` times, which can be changed for
+    particular endpoints using ``max_attempts_by_endpoint``.
+    """
+    max_attempts = attr.ib(validator=vv.instance_of(int), default=5, convert=int)
+    max_attempts_by_endpoint = attr.ib(default=attr.Factory(dict), hash=False)
+    backoff = attr.ib(validator=vv.instance_of(float), default=0.5, convert=float)
+    max_backoff = attr.ib(validator=vv.instance_of(float), default=30.0, convert=float)
+
+    RETRY_STATUS_CODES = (429, 502, 503, 504)
+    IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+    def attempts(self, endpoint):
+        return self.max_attempts_by_endpoint.get(endpoint, self.max_attempts)
+
+    def retries(self, method, status_code=None, idempotent=None):
+        """
+        Whether a ``method`` request can be retried after getting the given
+        ``status_code``, or after a connection error if it is ``None``.
+        Requests which only read data using other methods can be marked as
+        ``idempotent``.
+        """
+        if status_code == 429:
+            return True
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        if not idempotent:
+            return False
+        return status_code is None or status_code in self.RETRY_STATUS_CODES
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            # Small jitter, so waiting callers do not all retry at once.
+            return retry_after + random.uniform(0, self.backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all the threads using an :class:`API` instance.
+
+    Allows up to ``rate`` requests per second, with bursts of up to ``burst``
+    requests. With no ``rate``, requests are only held back after the
+    homeserver asks to slow down (see :meth:`defer`).
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._rate = rate or None
+        self._burst = burst or max(1.0, rate or 1.0)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._deferred_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._deferred_until:
+                    wait = self._deferred_until - now
+                elif self._rate is None:
+                    return
+                else:
+                    self._tokens = min(self._burst,
+                                       self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def defer(self, seconds):
+        """Holds back all requests for the given amount of seconds."""
+        with self._lock:
+            self._deferred_until = max(self._deferred_until,
+                                       time.monotonic() + seconds)
+
+    def __repr__(self):
+        return "RateLimiter(rate={!r}, burst={!r})".format(self._rate, self._burst)
+
+
+def _retry_after(res):
+    # Proxies may answer with bodies which are not Matrix errors, and the
+    # header may be a date; the retry policy backs off by itself then.
+    try:
+        body = res.json()
+    except ValueError:
+        body = None
+    retry_after_ms = body.get("retry_after_ms") if isinstance(body, dict) else None
+    if isinstance(retry_after_ms, (int, float)) and retry_after_ms >= 0:
+        return retry_after_ms / 1000.0
+    try:
+        return max(0.0, float(res.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
 def _make_requests_session():
     s = requests.Session()
     s.headers.update({
@@ -37,28 +169,93 @@ class API(object):
     _session = attr.ib(validator=vv.instance_of(requests.Session),
                        default=attr.Factory(_make_requests_session))
 
+    # Optional synpurge.directory.DirectoryCache instance.
+    directory_cache = attr.ib(default=None, hash=False)
+    directory_search = attr.ib(validator=vv.instance_of(bool),
+                               default=False, convert=bool)
+    retry_policy = attr.ib(validator=vv.instance_of(RetryPolicy),
+                           default=attr.Factory(RetryPolicy), hash=False)
+    rate_limiter = attr.ib(validator=vv.instance_of(RateLimiter),
+                           default=attr.Factory(RateLimiter), hash=False)
+    # Added to the labels of the metrics, e.g. the name of the homeserver.
+    metric_labels = attr.ib(validator=vv.instance_of(dict),
+                            default=attr.Factory(dict), hash=False)
+
     _cached_public_rooms = attr.ib(default=None, init=False,
                                    hash=False, repr=False)
 
+    _cached_directories = attr.ib(default=attr.Factory(dict), init=False,
+                                  hash=False, repr=False)
+
+    _admin_room_list = attr.ib(default=None, init=False,
+                               hash=False, repr=False)
+
     _all_rooms_warned = attr.ib(default=False, init=False,
                                 hash=False, repr=False)
 
+    _timestamp_to_event = attr.ib(default=None, init=False,
+                                  hash=False, repr=False)
+
     _API_BASE = "/_matrix/client/r0/"
+    _API_V1_BASE = "/_matrix/client/v1/"
+    _ADMIN_BASE = "/_synapse/admin/v1/"
+    _ADMIN_V2_BASE = "/_synapse/admin/v2/"
+    _STATUS_TIMEOUT = 30
+    _DIRECTORY_PAGE_SIZE = 500
 
-    def url(self, *components):
+    def url(self, *components, base=_API_BASE):
         encoded = (urlquote(c) for c in components)
-        return self.homeserver + self._API_BASE + "/".join(encoded)
+        return self.homeserver + base + "/".join(encoded)
+
+    @property
+    def supports_timestamp_to_event(self):
+        """
+        Whether the homeserver implements the timestamp to event endpoint.
+
+        This is ``None`` until :meth:`get_event_for_timestamp` has been used.
+        """
+        return self._timestamp_to_event
 
     def request(self, method, url, raw_response=False, raw_body=False,
-                timeout=None, params=None):
+                timeout=None, params=None, body=None, endpoint=None,
+                idempotent=None):
         if params is None:
             params = {}
         if "access_token" not in params:
             params["access_token"] = self.token
-        # TODO: Handle rate-limiting and retries.
         req = self._session.prepare_request(requests.Request(method, url,
-                                                             params=params))
-        res = self._session.send(req, timeout=timeout)
+                                                             params=params,
+                                                             json=body))
+        max_attempts = self.retry_policy.attempts(endpoint)
+        for attempt in itertools.count(1):
+            self.rate_limiter.acquire()
+            try:
+                res = self._session.send(req, timeout=timeout)
+            except requests.Timeout as e:
+                raise APITimeout(str(e))
+            except requests.ConnectionError as e:
+                if attempt >= max_attempts \
+                        or not self.retry_policy.retries(method, idempotent=idempotent):
+                    raise
+                reason, delay = "connection", self.retry_policy.delay(attempt)
+                log.info("Connection error on %s (%s), retrying in %.1fs", endpoint, e, delay)
+            else:
+                if raw_response or attempt >= max_attempts \
+                        or not self.retry_policy.retries(method, res.status_code, idempotent):
+                    break
+                reason = str(res.status_code)
+                if res.status_code == 429:
+                    delay = self.retry_policy.delay(attempt, _retry_after(res))
+                    # Other threads would get rate-limited as well.
+                    self.rate_limiter.defer(delay)
+                else:
+                    delay = self.retry_policy.delay(attempt)
+                log.info("Got status %i from %s, retrying in %.1fs (attempt %i/%i)",
+                         res.status_code, endpoint, delay, attempt, max_attempts)
+            registry.inc("synpurge_request_retries_total",
+                         endpoint=endpoint or "other", reason=reason,
+                         **self.metric_labels)
+            time.sleep(delay)
         if raw_response:
             return res
         if res.status_code == 200:
@@ -67,7 +264,7 @@ class API(object):
             else:
                 return res.json()
         else:
-            raise APIError(res.text)
+            raise APIError.from_response(res)
 
     @property
     def public_rooms(self):
@@ -80,46 +277,146 @@ class API(object):
                      len(self._cached_public_rooms))
         return self._cached_public_rooms
 
+    def forget_rooms(self):
+        """Drops the room directories kept in memory."""
+        self._cached_public_rooms = None
+        self._cached_directories.clear()
+
     @property
     def all_rooms(self):
-        if not self._all_rooms_warned:
+        rooms = self.room_directory()
+        if self._admin_room_list is False and not self._all_rooms_warned:
             self._all_rooms_warned = True
             log.warning("API.all_rooms cannot fetch unlisted rooms")
-        return self.public_rooms
+        return rooms
+
+    def room_directory(self, search_terms=None):
+        """
+        Returns a dictionary which maps room IDs to lists of aliases.
 
-    def get_public_rooms(self, timeout=None, params=None):
+        The room list of the admin API is used when the access token allows
+        it, which includes unlisted rooms but only their canonical aliases;
+        otherwise the public room directory is used. If ``search_terms`` are
+        given, only the rooms which the homeserver finds searching for any
+        of them are returned. Results are kept in the directory cache, if
+        configured.
+        """
+        key = tuple(sorted(search_terms or ()))
+        rooms = self._cached_directories.get(key)
+        if rooms is None and self.directory_cache is not None:
+            rooms = self.directory_cache.load(self.homeserver, key)
+        if rooms is None:
+            log.info("Fetching room directory")
+            found = {}
+            for term in key or (None,):
+                for room in self.get_directory_rooms(search_term=term):
+                    aliases = found.setdefault(room["room_id"], set())
+                    aliases.update(room.get("aliases") or ())
+                    if room.get("canonical_alias"):
+                        aliases.add(room["canonical_alias"])
+            rooms = dict((room_id, sorted(aliases))
+                         for room_id, aliases in found.items())
+            log.info("Fetched information for %d rooms", len(rooms))
+            if self.directory_cache is not None:
+                self.directory_cache.store(self.homeserver, rooms, key)
+        self._cached_directories[key] = rooms
+        return rooms
+
+    def match_room_aliases(self, matcher):
+        """
+        Yields ``(room_id, room_alias, room_conf)`` for each alias of the
+        known rooms which matches a :class:`synpurge.config.AliasMatcher`.
+        """
+        search_terms = matcher.search_terms() if self.directory_search else None
+        for room_id, room_aliases in self.room_directory(search_terms).items():
+            for room_alias in room_aliases:
+                room_conf = matcher.match(room_alias)
+                if room_conf is not None:
+                    yield room_id, room_alias, room_conf
+
+    def get_directory_rooms(self, search_term=None, timeout=None, params=None):
+        if self._admin_room_list is not False:
+            try:
+                rooms = list(self.get_admin_rooms(search_term, timeout, params))
+                self._admin_room_list = True
+                return rooms
+            except APIError as e:
+                if self._admin_room_list or e.status_code not in (400, 401, 403, 404, 405):
+                    raise
+                self._admin_room_list = False
+                log.info("Admin room list unavailable (%s), using the public "
+                         "room directory", e.errcode or e.status_code)
+        return list(self.get_public_rooms(timeout, params, search_term))
+
+    def get_admin_rooms(self, search_term=None, timeout=None, params=None):
+        params = {} if params is None else dict(params)
+        params["limit"] = self._DIRECTORY_PAGE_SIZE
+        if search_term is not None:
+            params["search_term"] = search_term
+        while True:
+            data = self.request("GET", self.url("rooms", base=self._ADMIN_BASE),
+                                timeout=timeout,
+                                endpoint="admin_rooms",
+                                params=dict(params))
+            for room in data["rooms"]:
+                yield room
+            if data.get("next_batch") is None:
+                break
+            params["from"] = data["next_batch"]
+
+    def get_public_rooms(self, timeout=None, params=None, search_term=None):
         next_batch = None
-        prev_batch = False
-        while next_batch != prev_batch:
+        while True:
             data = self.__get_public_rooms_chunk(next_batch,
+                                                 search_term,
                                                  timeout,
                                                  params)
             for room in data["chunk"]:
                 yield room
-            prev_batch = next_batch
+            # The last page does not include a "next_batch" token.
+            if data.get("next_batch") in (None, next_batch):
+                break
             next_batch = data["next_batch"]
 
-    def __get_public_rooms_chunk(self, next_batch, timeout, params):
-        if params is None:
-            params = {}
+    def __get_public_rooms_chunk(self, next_batch, search_term, timeout, params):
+        params = {} if params is None else dict(params)
+        if search_term is not None:
+            # Filtering requires using POST, with the parameters in the body,
+            # but it is still a read which can be retried like a GET.
+            body = dict(limit=self._DIRECTORY_PAGE_SIZE,
+                        filter=dict(generic_search_term=search_term))
+            if next_batch is not None:
+                body["since"] = next_batch
+            return self.request("POST", self.url("publicRooms"),
+                                timeout=timeout,
+                                endpoint="publicRooms",
+                                params=params,
+                                body=body,
+                                idempotent=True)
+        params["limit"] = self._DIRECTORY_PAGE_SIZE
         if next_batch is not None:
-            params["next_batch"] = next_batch
+            params["since"] = next_batch
         return self.request("GET", self.url("publicRooms"),
                             timeout=timeout,
+                            endpoint="publicRooms",
                             params=params)
 
     def get_room_id(self, room_alias, timeout=None, params=None):
         data = self.request("GET",
                             self.url("directory", "room", room_alias),
                             timeout=timeout,
+                            endpoint="directory",
                             params=params)
         return data["room_id"]
 
     def get_room_messages(self, room_id, start=None, end=None, limit=None,
-                          forward=False, timeout=None, params=None):
+                          forward=False, room_filter=None, timeout=None,
+                          params=None):
         if params is None:
             params = {}
         params["dir"] = "f" if forward else "b"
+        if room_filter is not None:
+            params["filter"] = json.dumps(room_filter, separators=(",", ":"))
         if start is not None:
             params["from"] = start
         if end is not None:
@@ -129,11 +426,173 @@ class API(object):
         return self.request("GET",
                             self.url("rooms", room_id, "messages"),
                             timeout=timeout,
+                            endpoint="messages",
+                            params=params)
+
+    def get_event_context(self, room_id, event_id, limit=None,
+                          timeout=None, params=None):
+        if params is None:
+            params = {}
+        if limit is not None:
+            params["limit"] = limit
+        return self.request("GET",
+                            self.url("rooms", room_id, "context", event_id),
+                            timeout=timeout,
+                            endpoint="context",
                             params=params)
 
-    def purge_history(self, room_id, event_id, timeout=None, params=None):
+    def get_event_for_timestamp(self, room_id, timestamp, forward=False,
+                                timeout=None, params=None):
+        """
+        Finds the event closest to a timestamp, in milliseconds.
+
+        Returns an ``(event_id, origin_server_ts)`` tuple, or ``None`` if the
+        room has no event in the given direction. Raises :class:`APIUnsupported`
+        if the homeserver does not implement the endpoint.
+        """
+        if self._timestamp_to_event is False:
+            raise APIUnsupported("timestamp_to_event is not supported")
+        if params is None:
+            params = {}
+        params["ts"] = timestamp
+        params["dir"] = "f" if forward else "b"
+        try:
+            data = self.request("GET",
+                                self.url("rooms", room_id, "timestamp_to_event",
+                                         base=self._API_V1_BASE),
+                                timeout=timeout,
+                                endpoint="timestamp_to_event",
+                                params=params)
+        except APIError as e:
+            if e.errcode == "M_NOT_FOUND":
+                self._timestamp_to_event = True
+                return None
+            if e.errcode == "M_UNRECOGNIZED" or e.status_code in (404, 405):
+                self._timestamp_to_event = False
+                raise APIUnsupported(str(e), e.status_code, e.errcode)
+            raise
+        self._timestamp_to_event = True
+        return data["event_id"], data["origin_server_ts"]
+
+    def purge_history(self, room_id, event_id, timeout=None, params=None,
+                      poll=False):
+        if poll:
+            purge_id = self.start_purge_history(room_id, event_id,
+                                                params=params)
+            return self.wait_purge_history(purge_id, deadline=timeout,
+                                           params=params)
         if timeout is not None and timeout < 180:
             log.warn("Timeout smaller than 180s (%is), will likely timeout", timeout)
         return self.request("POST",
                             self.url("admin", "purge_history", room_id, event_id),
-                            timeout=timeout, params=params)
+                            timeout=timeout, params=params,
+                            endpoint="purge_history")
+
+    def start_purge_history(self, room_id, event_id, timeout=None, params=None):
+        data = self.request("POST",
+                            self.url("admin", "purge_history", room_id, event_id),
+                            timeout=timeout or self._STATUS_TIMEOUT,
+                            endpoint="purge_history",
+                            params=params)
+        purge_id = data.get("purge_id")
+        if purge_id is None:
+            raise APIError("No purge_id returned for room {}".format(room_id))
+        log.debug("Started purge %s for room %s", purge_id, room_id)
+        return purge_id
+
+    def get_purge_history_status(self, purge_id, timeout=None, params=None):
+        data = self.request("GET",
+                            self.url("admin", "purge_history_status", purge_id),
+                            timeout=timeout or self._STATUS_TIMEOUT,
+                            endpoint="purge_history_status",
+                            params=params)
+        return data["status"]
+
+    def wait_purge_history(self, purge_id, deadline=None, params=None,
+                           poll_interval=1.0, max_poll_interval=30.0):
+        """
+        Polls the status of a purge until it is complete.
+
+        The delay between status requests doubles after each one, up to
+        ``max_poll_interval`` seconds. If ``deadline`` (in seconds) passes
+        before the purge completes, :class:`APITimeout` is raised; note that
+        the purge itself keeps running in the homeserver.
+        """
+        self.__wait_status("Purge {}".format(purge_id),
+                           lambda: self.get_purge_history_status(purge_id, params=params),
+                           ("active",), deadline, poll_interval, max_poll_interval)
+
+    def get_room_details(self, room_id, timeout=None, params=None):
+        return self.request("GET",
+                            self.url("rooms", room_id, base=self._ADMIN_BASE),
+                            timeout=timeout,
+                            endpoint="admin_room",
+                            params=params)
+
+    def rooms_without_local_members(self, room_ids, params=None):
+        """Returns the subset of ``room_ids`` without joined local users."""
+        abandoned = set()
+        for room_id in room_ids:
+            try:
+                details = self.get_room_details(room_id, params=params)
+            except APIError as e:
+                if e.status_code != 404:
+                    raise
+                log.debug("Room %s unknown to the admin API", room_id)
+                continue
+            if details.get("joined_local_members", 1) == 0:
+                abandoned.add(room_id)
+        return abandoned
+
+    def delete_room(self, room_id, deadline=None, params=None,
+                    poll_interval=1.0, max_poll_interval=30.0):
+        """
+        Deletes a room, purging it from the database, and waits until done.
+
+        Raises :class:`APITimeout` like :meth:`wait_purge_history`.
+        """
+        data = self.request("DELETE",
+                            self.url("rooms", room_id, base=self._ADMIN_V2_BASE),
+                            timeout=self._STATUS_TIMEOUT,
+                            endpoint="delete_room",
+                            params=params,
+                            body=dict(purge=True, block=False))
+        delete_id = data.get("delete_id")
+        if delete_id is None:
+            raise APIError("No delete_id returned for room {}".format(room_id))
+        log.debug("Started deletion %s for room %s", delete_id, room_id)
+        self.__wait_status("Deletion {}".format(delete_id),
+                           lambda: self.get_delete_room_status(delete_id, params=params),
+                           ("shutting_down", "purging"), deadline,
+                           poll_interval, max_poll_interval)
+
+    def get_delete_room_status(self, delete_id, timeout=None, params=None):
+        data = self.request("GET",
+                            self.url("rooms", "delete_status", delete_id,
+                                     base=self._ADMIN_V2_BASE),
+                            timeout=timeout or self._STATUS_TIMEOUT,
+                            endpoint="delete_room_status",
+                            params=params)
+        return data["status"]
+
+    @staticmethod
+    def __wait_status(what, get_status, active_statuses, deadline,
+                      poll_interval, max_poll_interval):
+        started = time.monotonic()
+        while True:
+            status = get_status()
+            log.debug("%s status: %s", what, status)
+            if status == "complete":
+                return
+            if status == "failed":
+                raise APIError("{} failed".format(what))
+            if status not in active_statuses:
+                raise APIError("{} has unknown status {!r}".format(what, status))
+            delay = poll_interval
+            if deadline is not None:
+                remaining = deadline - (time.monotonic() - started)
+                if remaining <= 0:
+                    raise APITimeout("{} still {} after {}s".format(what, status, deadline))
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
@@ -6,10 +6,17 @@
 # Distributed under terms of the GPLv3 license.
 
 import attr
+import contextlib
+import functools
 import itertools
 import logging
+import queue
+import re
+import threading
+import time
 
 from attr import validators as vv
+from .metrics import registry
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +37,41 @@ _HUGE_TABLES = ("event_to_state_groups",
                 "event_json",
                 "state_groups_state")
 
+#
+# Tables of the above from which purging history deletes rows. State events
+# are kept, and so are their memberships and state groups.
+#
+_PURGED_HUGE_TABLES = tuple(t for t in _HUGE_TABLES
+                            if t not in ("state_events",
+                                         "room_memberships",
+                                         "state_groups_state"))
+
+#
+# Tables from which rows referring to purged events are deleted by the
+# direct SQL purge engine, the same as the purge of Synapse. The "events"
+# table goes last, so an interrupted batch never leaves rows which refer to
+# an event no longer there.
+#
+_PURGE_TABLES = ("event_auth",
+                 "event_auth_chains",
+                 "event_auth_chain_to_calculate",
+                 "event_edges",
+                 "event_expiry",
+                 "event_forward_extremities",
+                 "event_json",
+                 "event_labels",
+                 "event_push_actions",
+                 "event_push_actions_staging",
+                 "event_reference_hashes",
+                 "event_relations",
+                 "event_search",
+                 "event_to_state_groups",
+                 "event_txn_id",
+                 "rejections",
+                 "redactions",
+                 "stream_ordering_to_exterm",
+                 "events")
+
 
 @attr.s(frozen=True, slots=True)
 class RoomInfo(object):
@@ -46,28 +88,565 @@ class RoomInfo(object):
         return d
 
 
+@attr.s(frozen=True, slots=True)
+class TableStats(object):
+    name = attr.ib(validator=vv.instance_of(str))
+    live_tuples = attr.ib(validator=vv.instance_of(int), convert=int)
+    dead_tuples = attr.ib(validator=vv.instance_of(int), convert=int)
+    total_bytes = attr.ib(validator=vv.instance_of(int), convert=int)
+    table_bytes = attr.ib(validator=vv.instance_of(int), convert=int)
+    free_bytes = attr.ib(validator=vv.instance_of(int), convert=int)
+
+    @property
+    def dead_ratio(self):
+        total = self.live_tuples + self.dead_tuples
+        return self.dead_tuples / total if total else 0.0
+
+    @property
+    def free_ratio(self):
+        if self.table_bytes == 0:
+            return 0.0
+        return min(1.0, self.free_bytes / self.table_bytes)
+
+
+@attr.s(frozen=True, slots=True)
+class IndexInfo(object):
+    oid = attr.ib(validator=vv.instance_of(int), convert=int)
+    name = attr.ib(validator=vv.instance_of(str))
+    table = attr.ib(validator=vv.instance_of(str))
+    definition = attr.ib(validator=vv.instance_of(str))
+    clustered = attr.ib(validator=vv.instance_of(bool), convert=bool)
+    method = attr.ib(validator=vv.instance_of(str))
+    total_bytes = attr.ib(validator=vv.instance_of(int), convert=int)
+    expected_bytes = attr.ib(validator=vv.instance_of(int), convert=int)
+
+    @property
+    def bloat_ratio(self):
+        if self.total_bytes == 0:
+            return 0.0
+        return max(0.0, 1.0 - self.expected_bytes / self.total_bytes)
+
+
+@attr.s
+class StateCompaction(object):
+    """Summary of the work done by :meth:`Database.compact_state`."""
+    rooms = attr.ib(default=0)
+    collapsed_groups = attr.ib(default=0)
+    deleted_groups = attr.ib(default=0)
+    deleted_edges = attr.ib(default=0)
+    deleted_rows = attr.ib(default=0)
+    deleted_bytes = attr.ib(default=0)
+    inserted_rows = attr.ib(default=0)
+    inserted_bytes = attr.ib(default=0)
+
+    def asdict(self):
+        return attr.asdict(self)
+
+
+@attr.s
+class PurgeEstimate(object):
+    """
+    Expected work for purging a room, or several once added up: events, and
+    rows and bytes of each table deleted. See :meth:`Database.estimate_purges`.
+    When counting stopped early, ``lower_bound`` is set and the amount of
+    events is a minimum.
+    """
+    events = attr.ib(default=0)
+    rows = attr.ib(default=attr.Factory(dict))
+    bytes = attr.ib(default=attr.Factory(dict))
+    lower_bound = attr.ib(default=False)
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.values())
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+    def add(self, other):
+        self.events += other.events
+        self.lower_bound = self.lower_bound or other.lower_bound
+        for table, rows in other.rows.items():
+            self.rows[table] = self.rows.get(table, 0) + rows
+        for table, size in other.bytes.items():
+            self.bytes[table] = self.bytes.get(table, 0) + size
+        return self
+
+    def asdict(self):
+        d = attr.asdict(self)
+        d["total_rows"] = self.total_rows
+        d["total_bytes"] = self.total_bytes
+        return d
+
+
+@attr.s(frozen=True, slots=True)
+class LoadSample(object):
+    timestamp = attr.ib()
+    wal_position = attr.ib(validator=vv.instance_of(int), convert=int)
+    replication_lag = attr.ib(validator=vv.optional(vv.instance_of(int)),
+                              convert=lambda v: None if v is None else int(v))
+    active_backends = attr.ib(validator=vv.instance_of(int), convert=int)
+
+
+@attr.s
+class Throttle(object):
+    """
+    Pauses work while the database server is under too much load.
+
+    Load is sampled with the ``sample`` callable, which returns a
+    :class:`LoadSample`, at most once every ``interval`` seconds. While
+    any of the configured limits is exceeded, :meth:`wait` sleeps with an
+    exponential backoff between ``backoff`` and ``max_backoff`` seconds.
+    """
+    _sample = attr.ib()
+    max_replication_lag = attr.ib(default=None)
+    max_wal_rate = attr.ib(default=None)
+    max_active_backends = attr.ib(default=None)
+    interval = attr.ib(default=1.0)
+    backoff = attr.ib(default=5.0)
+    max_backoff = attr.ib(default=300.0)
+    _last = attr.ib(default=None, init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in (self.max_replication_lag,
+                                                   self.max_wal_rate,
+                                                   self.max_active_backends))
+
+    def wait(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._last is not None and \
+                    time.monotonic() - self._last.timestamp < self.interval:
+                return
+            delay = self.backoff
+            while True:
+                reasons = self.__check(self._sample())
+                if not reasons:
+                    return
+                log.info("Throttling for %.1fs: %s", delay, ", ".join(reasons))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def __check(self, sample):
+        reasons = []
+        if self.max_replication_lag is not None and sample.replication_lag is not None \
+                and sample.replication_lag > self.max_replication_lag:
+            reasons.append("replication lag {} > {} bytes".format(sample.replication_lag,
+                                                                  self.max_replication_lag))
+        if self.max_wal_rate is not None and self._last is not None:
+            elapsed = sample.timestamp - self._last.timestamp
+            if elapsed > 0:
+                rate = (sample.wal_position - self._last.wal_position) / elapsed
+                if rate > self.max_wal_rate:
+                    reasons.append("WAL rate {:.0f} > {} bytes/s".format(rate, self.max_wal_rate))
+        if self.max_active_backends is not None \
+                and sample.active_backends > self.max_active_backends:
+            reasons.append("{} > {} active backends".format(sample.active_backends,
+                                                            self.max_active_backends))
+        self._last = sample
+        return reasons
+
+
+def plan_vacuum(tables, dead_ratio, full_ratio):
+    """
+    Chooses which tables to vacuum, and how.
+
+    Returns a list of ``(stats, full)`` tuples for the tables whose ratio of
+    dead tuples is at least ``dead_ratio``, which get a plain vacuum, and
+    for the tables whose estimated ratio of free space is at least
+    ``full_ratio``, which get a ``VACUUM FULL``: dead tuples are reused
+    after a plain vacuum, but only a rewrite returns free space to the
+    operating system. Plain vacuums come first because they need no extra
+    disk space, then full ones from the smallest to the biggest table, so
+    the space freed by each rewrite is available for the next ones.
+    """
+    plain, full = [], []
+    for stats in tables:
+        if stats.free_ratio >= full_ratio:
+            full.append((stats, True))
+        elif stats.dead_ratio >= dead_ratio and stats.dead_tuples > 0:
+            plain.append((stats, False))
+    full.sort(key=lambda item: item[0].total_bytes)
+    return plain + full
+
+
+def _quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _quote_literal(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def _execute(conn, statement):
+    log.debug(statement)
+    conn.execute(statement)
+
+
+class ConnectionPool(object):
+    """
+    Hands out up to ``size`` connections, opened on demand using ``connect``.
+
+    The ``setup`` statements are executed once on each new connection.
+    """
+
+    def __init__(self, connect, size, setup=()):
+        self.size = size
+        self._connect = connect
+        self._setup = tuple(setup)
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                for statement in self._setup:
+                    _execute(conn, statement)
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _chain(tasks):
+    def run(execute):
+        for task in tasks:
+            task(execute)
+    return run
+
+
+_CREATE_INDEX_RE = re.compile(r"^CREATE (UNIQUE )?INDEX (\S+) ON ")
+
+
+def _ccnew_prefix(name):
+    """
+    Prefix of the names given by ``REINDEX CONCURRENTLY`` to the replacement
+    of an index. PostgreSQL truncates the name of the index to fit in 63
+    bytes, and appends a number if the name is already taken.
+    """
+    suffix = "_ccnew"
+    encoded = name.encode("utf-8")[:63 - len(suffix)]
+    return encoded.decode("utf-8", "ignore") + suffix
+
+
+def _reindex_concurrent(index, execute, native):
+    """
+    Rebuilds an index without blocking writes to its table.
+
+    Uses ``REINDEX INDEX CONCURRENTLY`` when ``native`` is true (PostgreSQL
+    12 or newer), or otherwise builds a new index concurrently which then
+    replaces the old one. Returns whether the index was rebuilt; failures
+    are logged and leave the original index in place whenever possible.
+    Native failures may leave an invalid replacement index behind, which
+    the caller has to drop.
+    """
+    if native:
+        try:
+            execute("REINDEX INDEX CONCURRENTLY {}".format(_quote_ident(index.name)))
+            return True
+        except Exception as e:
+            log.warning("Could not re-index '%s': %s", index.name, e)
+            return False
+
+    tmp_idx_name = _quote_ident("{}_tmp".format(index.name))
+    tmp_idx_definition = _CREATE_INDEX_RE.sub(
+        lambda m: "CREATE {}INDEX CONCURRENTLY {} ON ".format(m.group(1) or "", tmp_idx_name),
+        index.definition, count=1)
+    dropped = False
+    try:
+        execute(tmp_idx_definition)
+        if index.clustered:
+            execute("ALTER TABLE {} CLUSTER ON {}".format(_quote_ident(index.table), tmp_idx_name))
+        execute("DROP INDEX CONCURRENTLY {}".format(_quote_ident(index.name)))
+        dropped = True
+        execute("ALTER INDEX {} RENAME TO {}".format(tmp_idx_name, _quote_ident(index.name)))
+        return True
+    except Exception as e:
+        if dropped:
+            log.error("Could not rename index %s to '%s': %s", tmp_idx_name, index.name, e)
+        else:
+            log.warning("Could not re-index '%s': %s", index.name, e)
+            execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(tmp_idx_name))
+        return False
+
+
+def _synchronized(method):
+    # The connection cannot be shared between threads, e.g. the reference
+    # event lookups of a purge pipeline and the maintenance between purges.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Database(object):
-    def __init__(self, db, db_name):
+    def __init__(self, db, db_name, clean_tables=10, clean_dead_ratio=0.1,
+                 clean_full_ratio=0.5, connect=None, maintenance_jobs=1,
+                 maintenance_work_mem=None, reindex_bloat_ratio=0.3,
+                 compact_method="vacuum", repack_lock_timeout=5.0,
+                 metric_labels=None):
         self._db = db
+        self._metric_labels = dict(metric_labels or {})
         self._name = db_name
+        self._compact_method = compact_method
+        self._repack_lock_timeout = repack_lock_timeout
+        self._reindex_bloat_ratio = reindex_bloat_ratio
+        self._server_version = None
+        self._has_pgstattuple = None
+        self._purge_statements = None
+        self._clean_tables = clean_tables
+        self._clean_dead_ratio = clean_dead_ratio
+        self._clean_full_ratio = clean_full_ratio
+        setup = []
+        if maintenance_work_mem:
+            setup.append("SET maintenance_work_mem = {}".format(_quote_literal(maintenance_work_mem)))
+        for statement in setup:
+            _execute(self._db, statement)
+        # Maintenance of independent tables can use additional connections.
+        self._pool = None
+        if connect is not None and maintenance_jobs > 1:
+            self._pool = ConnectionPool(connect, maintenance_jobs, setup)
+        self._lock = threading.RLock()
         self._cached_all_rooms = None
         self._cached_public_rooms = None
 
-    def find_event_id(self, room_id, upto):
-        timestamp = int(upto.epoch * 1000)
-        return self._db.synapse.event_id_before(room_id, timestamp)
+    def find_event_id(self, room_id, timestamp):
+        return self.find_event_ids(((room_id, timestamp),)).get(room_id)
+
+    @_synchronized
+    def find_event_ids(self, rooms):
+        """
+        Finds reference events for many rooms using a single query.
+
+        Takes an iterable of ``(room_id, timestamp)`` pairs, with timestamps
+        in milliseconds since the epoch, and returns a dictionary which maps
+        each room ID to the last event sent up to the given time, or ``None``.
+        """
+        room_ids, timestamps = [], []
+        for room_id, timestamp in rooms:
+            room_ids.append(room_id)
+            timestamps.append(timestamp)
+        if not room_ids:
+            return {}
+        return dict(self._db.synapse.event_ids_before(room_ids, timestamps))
+
+    @_synchronized
+    def count_events_before(self, rooms):
+        """
+        Counts the events sent up to a given time for many rooms.
+
+        Takes the same ``(room_id, timestamp)`` pairs as :meth:`find_event_ids`,
+        and returns a dictionary which maps room IDs to event counts.
+        """
+        room_ids, timestamps = [], []
+        for room_id, timestamp in rooms:
+            room_ids.append(room_id)
+            timestamps.append(timestamp)
+        if not room_ids:
+            return {}
+        return dict(self._db.synapse.events_count_before(room_ids, timestamps))
+
+    @_synchronized
+    def estimate_purges(self, purges):
+        """
+        Estimates the work needed to purge many rooms, without scanning them.
+
+        Takes ``(room_id, event_id)`` pairs, where ``event_id`` is the
+        reference event, or ``None`` to delete the whole room. Events are
+        counted using the index on their ordering in the room, and rows and
+        bytes of the biggest tables are derived from the average amount of
+        rows per event and size per row in the planner statistics. Returns
+        a dictionary which maps room IDs to :class:`PurgeEstimate`.
+        """
+        room_ids, event_ids = [], []
+        for room_id, event_id in purges:
+            room_ids.append(room_id)
+            event_ids.append(event_id)
+        if not room_ids:
+            return {}
+        counts = dict(self._db.synapse.events_count_before_events(room_ids, event_ids))
+        stats = dict((name, (tuples, size)) for name, tuples, size
+                     in self._db.synapse.table_estimates(list(_HUGE_TABLES)))
+        event_tuples = stats.get("events", (0, 0))[0]
+
+        estimates = {}
+        for room_id, event_id in zip(room_ids, event_ids):
+            estimate = PurgeEstimate(events=counts.get(room_id, 0))
+            for table in _HUGE_TABLES if event_id is None else _PURGED_HUGE_TABLES:
+                if table not in stats:
+                    continue
+                tuples, size = stats[table]
+                if table == "events":
+                    rows = estimate.events
+                elif event_tuples:
+                    rows = estimate.events * tuples // event_tuples
+                else:
+                    rows = 0
+                estimate.rows[table] = rows
+                estimate.bytes[table] = rows * size // tuples if tuples else 0
+            estimates[room_id] = estimate
+        return estimates
+
+    @_synchronized
+    def load_sample(self):
+        return LoadSample(time.monotonic(), *self._db.synapse.load_sample())
+
+    def purge_history(self, room_id, event_id, batch_size=1000, pause=0.0,
+                      throttle=None):
+        """
+        Deletes the history of a room older than a reference event, directly
+        in the database.
+
+        Events are deleted in batches of at most ``batch_size``, each one in
+        its own transaction, sleeping for ``pause`` seconds between batches.
+        Like the purge API of Synapse, state events are kept and marked as
+        outliers, so they are no longer part of the timeline, and the deleted
+        events referenced by the remaining timeline are marked as backward
+        extremities.
+        If a :class:`Throttle` is given, it is waited on between batches.
+        Returns the number of events deleted.
+        """
+        with self._lock:
+            ordering = self._db.synapse.event_topological_ordering(event_id)
+            if ordering is None:
+                raise LookupError("No such event {}".format(event_id))
+            statements = self.__purge_statements()
+
+        deleted = 0
+        while True:
+            with self._lock, self._db.xact():
+                event_ids = list(self._db.synapse.purge_batch(room_id, ordering, batch_size))
+                if event_ids:
+                    self._db.synapse.mark_state_outliers(room_id, ordering)
+                    self._db.synapse.add_backward_extremities(room_id, event_ids)
+                    for statement in statements:
+                        statement(event_ids)
+            if not event_ids:
+                break
+            deleted += len(event_ids)
+            log.debug("Deleted %i events from room %s (%i so far)",
+                      len(event_ids), room_id, deleted)
+            if pause > 0:
+                time.sleep(pause)
+            if throttle is not None:
+                throttle.wait()
+
+        with self._lock:
+            self._db.synapse.prune_backward_extremities(room_id)
+        log.debug("Purged %i events from room %s", deleted, room_id)
+        return deleted
+
+    def compact_state(self, room_ids=None, collapse=True, batch_size=100,
+                      pause=0.0, throttle=None):
+        """
+        Removes state groups which are not needed anymore after purging.
+
+        With ``collapse``, each state group referenced by events whose
+        previous group in the delta chain is not referenced first gets its
+        full state stored, detaching it from the chain. Then the groups which
+        are neither referenced by events nor needed to resolve the state of
+        a referenced group are deleted. Groups are processed in batches of at
+        most ``batch_size``, each one in its own transaction, sleeping for
+        ``pause`` seconds (and waiting on the ``throttle``) between batches.
+        Returns a :class:`StateCompaction`.
+        """
+        if room_ids is None:
+            with self._lock:
+                room_ids = list(self._db.synapse.state_group_rooms())
+        summary = StateCompaction()
+        for room_id in room_ids:
+            summary.rooms += 1
+            if collapse:
+                with self._lock:
+                    groups = list(self._db.synapse.collapsible_state_groups(room_id))
+                for batch in _batches(groups, batch_size):
+                    with self._lock, self._db.xact():
+                        for group in batch:
+                            deleted, deleted_bytes, inserted, inserted_bytes = \
+                                self._db.synapse.collapse_state_group(group, room_id)
+                            summary.deleted_rows += deleted
+                            summary.deleted_bytes += deleted_bytes
+                            summary.inserted_rows += inserted
+                            summary.inserted_bytes += inserted_bytes
+                    summary.collapsed_groups += len(batch)
+                    self.__between_batches(pause, throttle)
+            with self._lock:
+                groups = list(self._db.synapse.unreferenced_state_groups(room_id))
+            for batch in _batches(groups, batch_size):
+                with self._lock, self._db.xact():
+                    deleted_groups, deleted_edges, deleted, deleted_bytes = \
+                        self._db.synapse.delete_state_groups(batch)
+                summary.deleted_groups += deleted_groups
+                summary.deleted_edges += deleted_edges
+                summary.deleted_rows += deleted
+                summary.deleted_bytes += deleted_bytes
+                self.__between_batches(pause, throttle)
+            log.debug("Compacted state of room %s: %r", room_id, summary)
+        return summary
+
+    def rooms_without_local_members(self, room_ids):
+        """Returns the subset of ``room_ids`` without joined local users."""
+        with self._lock:
+            return frozenset(self._db.synapse.rooms_without_local_members(list(room_ids)))
 
+    @staticmethod
+    def __between_batches(pause, throttle):
+        if pause > 0:
+            time.sleep(pause)
+        if throttle is not None:
+            throttle.wait()
+
+    def __purge_statements(self):
+        if self._purge_statements is None:
+            tables = frozenset(self._db.synapse.existing_tables(list(_PURGE_TABLES)))
+            self._purge_statements = [
+                self._db.prepare("DELETE FROM {} WHERE event_id = ANY ($1::text[])".format(_quote_ident(t)))
+                for t in _PURGE_TABLES if t in tables
+            ]
+        return self._purge_statements
+
+    @_synchronized
     def get_room_id(self, room_alias, params=None):
         return self._db.synapse.resolve_room_alias(room_alias)
 
+    @_synchronized
     def get_room_info(self, room_id):
         info = self._db.synapse.get_room_info(room_id)
         return info if info is None else RoomInfo(**dict(info.items()))
 
+    @_synchronized
     def find_table_indexes(self, table_name):
         return self._db.synapse.table_indexes(table_name)
 
+    @_synchronized
+    def forget_rooms(self):
+        """Drops the room aliases kept in memory."""
+        self._cached_all_rooms = None
+        self._cached_public_rooms = None
+
     @property
+    @_synchronized
     def public_rooms(self):
         if self._cached_public_rooms is None:
             self._cached_public_rooms = \
@@ -77,6 +656,7 @@ class Database(object):
         return self._cached_public_rooms
 
     @property
+    @_synchronized
     def all_rooms(self):
         if self._cached_all_rooms is None:
             self._cached_all_rooms = \
@@ -85,71 +665,305 @@ class Database(object):
                       len(self._cached_all_rooms))
         return self._cached_all_rooms
 
-    def cleanup(self):
+    @_synchronized
+    def match_room_aliases(self, matcher):
+        """
+        Like :meth:`synpurge.minimx.API.match_room_aliases`, but the aliases
+        are matched by PostgreSQL, so only the matching ones are fetched.
+        """
+        rows = self._db.synapse.matching_room_aliases(list(matcher.patterns),
+                                                      "|".join(matcher.patterns))
+        log.debug("Room patterns matched %i aliases", len(rows))
+        return [(room_id, room_alias, matcher.rooms[index])
+                for room_id, room_alias, index in rows]
+
+    @_synchronized
+    def table_stats(self, limit=None, free_space=False):
+        """
+        Returns statistics for the biggest tables, biggest first. The free
+        space in each table is estimated from the planner statistics, or
+        with ``pgstattuple_approx()`` when ``free_space`` is true and the
+        pgstattuple extension is installed.
+        """
+        if free_space and self._has_pgstattuple is None:
+            self._has_pgstattuple = self._db.synapse.has_pgstattuple()
+        tables = []
+        for row in self._db.synapse.table_stats(limit or self._clean_tables):
+            row = list(row)
+            if free_space and self._has_pgstattuple:
+                row[5] = self._db.synapse.table_free_space(row[0])
+            tables.append(TableStats(*row))
+        return tables
+
+    @_synchronized
+    def relation_sizes(self, table_names):
+        """Returns the total size in bytes of each of the given tables."""
+        return dict(self._db.synapse.relation_sizes(list(table_names)))
+
+    @_synchronized
+    def cleanup(self, lock_tables=True):
+        """
+        Vacuums the biggest tables which have enough dead tuples. Heavily
+        bloated ones get a ``VACUUM FULL``, which locks them, or are repacked
+        with the "repack" compaction method. When ``lock_tables`` is false,
+        they get a plain vacuum instead of ``VACUUM FULL``.
+        """
         log.info("Starting database cleanup")
-        for i, table_name in zip(itertools.count(1), _HUGE_TABLES):
-            log.debug("Cleaning up table '%s' (%i/%i)",
-                      table_name, i, len(_HUGE_TABLES))
-            # VACUUM does not work from an ILF library.
-            self._db.execute("VACUUM FULL ANALYZE {}".format(table_name))
-        log.info("Finished database cleanup")
+        plan = plan_vacuum(self.table_stats(free_space=True), self._clean_dead_ratio,
+                           self._clean_full_ratio)
+
+        def vacuum(i, stats, full, execute):
+            log.debug("Cleaning up table '%s' (%i/%i), %.1f%% dead tuples,"
+                      " %.1f%% free space, %s", stats.name, i, len(plan),
+                      stats.dead_ratio * 100, stats.free_ratio * 100,
+                      "full" if full else "plain")
+            if full and self._compact_method == "repack":
+                if self.__try_repack(stats.name):
+                    return
+                # Dead tuples can still be reused, without locking the table.
+                full = False
+            elif full and not lock_tables:
+                full = False
+            with registry.timer("synpurge_maintenance_seconds", gauge=True,
+                                operation="vacuum_full" if full else "vacuum",
+                                table=stats.name, **self._metric_labels):
+                # VACUUM does not work from an ILF library.
+                execute("VACUUM {}ANALYZE {}".format("FULL " if full else "",
+                                                     _quote_ident(stats.name)))
 
+        # Full vacuums are chained to keep their order, while plain ones
+        # need no additional disk space and can run alongside.
+        full_chain, tasks = [], []
+        for i, (stats, full) in zip(itertools.count(1), plan):
+            task = functools.partial(vacuum, i, stats, full)
+            if full:
+                full_chain.append(task)
+            else:
+                tasks.append(task)
+        if full_chain:
+            tasks.insert(0, _chain(full_chain))
+        self.__maintain(tasks)
+        log.info("Finished database cleanup, %i tables vacuumed", len(plan))
+
+    @_synchronized
     def cleanup_full(self):
         log.info("Starting full database cleanup")
-        # VACUUM does not work from an ILF library.
-        self._db.execute("VACUUM FULL ANALYZE")
+        if self._compact_method == "repack":
+            tables = frozenset(self._db.synapse.existing_tables(list(_HUGE_TABLES)))
+            for table_name in _HUGE_TABLES:
+                if table_name in tables:
+                    self.__try_repack(table_name)
+            # VACUUM does not work from an ILF library.
+            self._db.execute("VACUUM ANALYZE")
+        else:
+            self._db.execute("VACUUM FULL ANALYZE")
         log.info("Finished full database cleanup")
 
+    @_synchronized
+    def repack_table(self, table_name):
+        """
+        Compacts a table without locking it for the whole rewrite, like
+        ``VACUUM FULL`` does (see :mod:`synpurge.repack`). Returns the bytes
+        reclaimed, or ``None`` if the table cannot be compacted online.
+        """
+        return self.__repack_table(table_name)
+
+    def __repack_table(self, table_name):
+        from . import repack
+        try:
+            with registry.timer("synpurge_maintenance_seconds", gauge=True,
+                                operation="repack", table=table_name,
+                                **self._metric_labels):
+                before, after = repack.repack_table(self._db, table_name,
+                                                    lock_timeout=self._repack_lock_timeout)
+        except repack.CannotRepack as e:
+            log.info("Cannot repack %s", e)
+            return None
+        return before - after
+
+    def __try_repack(self, table_name):
+        # Runs from maintenance tasks, on behalf of the thread which holds
+        # the lock, so the lock must not be taken again.
+        try:
+            return self.__repack_table(table_name) is not None
+        except Exception as e:
+            log.warning("Could not repack '%s': %s", table_name, e)
+            return False
+
+    @_synchronized
     def reindex(self):
         log.info("Starting database reindexing")
-        for i, table_name in zip(itertools.count(1), _HUGE_TABLES):
+
+        def reindex_table(i, table_name, execute):
             log.debug("Re-indexing table '%s' (%i/%i)",
-                      table_name, i, len(_HUGE_TABLES))
-            # REINDEX does not work from an ILF library.
-            self._db.execute("REINDEX TABLE {}".format(table_name))
+                      table_name, i, len(tables))
+            with registry.timer("synpurge_maintenance_seconds", gauge=True,
+                                operation="reindex", table=table_name,
+                                **self._metric_labels):
+                # REINDEX does not work from an ILF library.
+                execute("REINDEX TABLE {}".format(_quote_ident(table_name)))
+
+        # Tables are reindexed one at a time, from the smallest to the
+        # biggest, like full vacuums: the space freed by rebuilding the
+        # indexes of each is available for the next ones, and only one of
+        # the tables is locked at a time.
+        sizes = self._db.synapse.relation_sizes(list(_HUGE_TABLES))
+        tables = [name for name, _ in sorted(sizes, key=lambda item: item[1])]
+        self.__maintain([_chain([functools.partial(reindex_table, i, table_name)
+                                 for i, table_name in zip(itertools.count(1), tables)])])
         log.info("Finished database reindexing")
 
+    @_synchronized
     def reindex_concurrent(self):
         log.info("Starting database concurrent reindexing")
-        for i, table_name in zip(itertools.count(1), _HUGE_TABLES):
-            log.debug("Re-indexing table '%s' concurrently (%i/%i)",
-                      table_name, i, len(_HUGE_TABLES))
-            self.reindex_table_concurrent(table_name)
-        log.info("Finished database concurrent reindexing")
+        reclaimed = self.__reindex_concurrent(_HUGE_TABLES)
+        log.info("Finished database concurrent reindexing, %i indexes rebuilt, %i bytes reclaimed",
+                 len(reclaimed), sum(reclaimed.values()))
+        return reclaimed
 
+    @_synchronized
     def reindex_full(self):
         log.info("Starting full database reindexing")
         # REINDEX does not work from an ILF library.
         self._db.execute("REINDEX DATABASE {}".format(self._name))
         log.info("Finished full database reindexing")
 
+    @_synchronized
     def reindex_table_concurrent(self, table_name):
-        for idx_name, idx_definition, idx_cluster in self.find_table_indexes(table_name):
-            log.debug("Re-indexing index '%s' in table '%s'", idx_name, table_name)
-            tmp_idx_name = "{}_tmp".format(idx_name)
-            tmp_idx_definition = idx_definition.replace(idx_name, tmp_idx_name)
+        return self.__reindex_concurrent((table_name,))
+
+    @property
+    @_synchronized
+    def server_version(self):
+        if self._server_version is None:
+            self._server_version = self._db.synapse.server_version_num()
+        return self._server_version
+
+    @_synchronized
+    def find_index_bloat(self, table_name):
+        """
+        Returns information about the indexes of a table, including an
+        estimation of their expected size without bloat. The estimation is
+        obtained with ``pgstatindex()`` for B-tree indexes if the pgstattuple
+        extension is installed, or from the planner statistics otherwise.
+        Indexes whose size cannot be estimated are left out.
+        """
+        if self._has_pgstattuple is None:
+            self._has_pgstattuple = self._db.synapse.has_pgstattuple()
+        indexes = []
+        for row in self._db.synapse.index_bloat(table_name):
+            row = list(row)
+            oid, method, total_bytes = row[0], row[5], row[6]
+            if self._has_pgstattuple and method == "btree":
+                # Leaf pages of new B-tree indexes are filled up to 90%.
+                density = self._db.synapse.index_leaf_density(oid)
+                if density:
+                    row[7] = int(total_bytes * density / 90)
+            if row[7] is None:
+                log.debug("Cannot estimate the bloat of index '%s' in table '%s'",
+                          row[1], table_name)
+                continue
+            indexes.append(IndexInfo(*row))
+        return indexes
+
+    def __reindex_concurrent(self, table_names):
+        native = self.server_version >= 120000
+        tasks, candidates = [], []
+        for i, table_name in zip(itertools.count(1), table_names):
+            indexes = [index for index in self.find_index_bloat(table_name)
+                       if index.bloat_ratio >= self._reindex_bloat_ratio]
+            for index in indexes:
+                log.debug("Index '%s' in table '%s' is %.1f%% bloated",
+                          index.name, table_name, index.bloat_ratio * 100)
+            if not indexes:
+                log.debug("No bloated indexes in table '%s' (%i/%i)",
+                          table_name, i, len(table_names))
+                continue
+            candidates.extend(indexes)
+            tasks.append(functools.partial(self.__reindex_table_concurrent, i,
+                                           len(table_names), table_name, indexes, native))
+
+        rebuilt = list(itertools.chain.from_iterable(self.__maintain(tasks)))
+        if native:
+            rebuilt_names = set(index.name for index in rebuilt)
+            for index in candidates:
+                if index.name not in rebuilt_names:
+                    self.__drop_invalid_replacements(index)
+        reclaimed = {}
+        for index in rebuilt:
+            new_bytes = self._db.synapse.relation_size(_quote_ident(index.name)) or 0
+            reclaimed[index.name] = index.total_bytes - new_bytes
+            log.info("Re-indexed '%s': %i -> %i bytes, %i reclaimed",
+                     index.name, index.total_bytes, new_bytes, reclaimed[index.name])
+        return reclaimed
+
+    def __drop_invalid_replacements(self, index):
+        # The invalid replacement would still be updated on every write.
+        for name in self._db.synapse.invalid_replacement_indexes(
+                index.oid, _ccnew_prefix(index.name)):
+            log.info("Dropping invalid index '%s' left by re-indexing '%s'",
+                     name, index.name)
             try:
-                self.__execute(tmp_idx_definition)
-                if idx_cluster:
-                    self.__execute("ALTER TABLE {} CLUSTER ON {}".format(table_name, tmp_idx_name))
-                self.__execute("DROP INDEX {}".format(idx_name))
-                self.__execute("ALTER INDEX {} RENAME TO {}".format(tmp_idx_name, idx_name))
-            except:
-                self.__execute("DROP INDEX {}".format(tmp_idx_name))
+                self.__execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(_quote_ident(name)))
+            except Exception as e:
+                log.error("Could not drop invalid index '%s': %s", name, e)
+
+    def __reindex_table_concurrent(self, i, count, table_name, indexes, native, execute):
+        log.debug("Re-indexing %i indexes of table '%s' concurrently (%i/%i)",
+                  len(indexes), table_name, i, count)
+        with registry.timer("synpurge_maintenance_seconds", gauge=True,
+                            operation="reindex_concurrent", table=table_name,
+                            **self._metric_labels):
+            return [index for index in indexes
+                    if _reindex_concurrent(index, execute, native)]
+
+    def __maintain(self, tasks):
+        """
+        Runs maintenance tasks, in parallel when a connection pool is
+        available. Each task is a callable which receives a function to
+        execute statements on the connection assigned to it. Returns the
+        results of the tasks, in the same order.
+        """
+        if self._pool is None or len(tasks) < 2:
+            return [task(self.__execute) for task in tasks]
+
+        def run(task):
+            with self._pool.connection() as conn:
+                return task(functools.partial(_execute, conn))
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self._pool.size) as executor:
+            futures = [executor.submit(run, task) for task in tasks]
+            return [future.result() for future in futures]
 
     def __execute(self, statement):
-        log.debug(statement)
-        self._db.execute(statement)
+        _execute(self._db, statement)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+        self._db.close()
 
     def __repr__(self):
         return "Database(pg={!r})".format(self._db)
 
 
-def open(db_conf):
+_CONNECTION_PARAMS = ("user", "password", "database", "host", "port")
+
+
+def open(db_conf, metric_labels=None):
     from postgresql import driver
     from .pglib import category
-    conn_params = attr.asdict(db_conf)
-    for key in ("clean_interval", "clean_full", "reindex_interval", "reindex_full"):
-        del conn_params[key]
+    conn_params = dict((key, getattr(db_conf, key)) for key in _CONNECTION_PARAMS)
     return Database(driver.connect(category=category, **conn_params),
-                    db_conf.database or db_conf.user)
+                    db_conf.database or db_conf.user,
+                    clean_tables=db_conf.clean_tables,
+                    clean_dead_ratio=db_conf.clean_dead_ratio,
+                    clean_full_ratio=db_conf.clean_full_ratio,
+                    connect=functools.partial(driver.connect, **conn_params),
+                    maintenance_jobs=db_conf.maintenance_jobs,
+                    maintenance_work_mem=db_conf.maintenance_work_mem,
+                    reindex_bloat_ratio=db_conf.reindex_bloat_ratio,
+                    compact_method=db_conf.compact_method,
+                    repack_lock_timeout=db_conf.repack_lock_timeout,
+                    metric_labels=metric_labels)
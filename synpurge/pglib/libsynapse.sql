@@ -4,6 +4,92 @@ SELECT event_id FROM events
     ORDER BY origin_server_ts DESC
     LIMIT 1
 
+[event_ids_before]
+SELECT r.room_id, e.event_id
+    FROM unnest($1::text[], $2::bigint[]) AS r(room_id, ts)
+    LEFT JOIN LATERAL (
+        SELECT event_id FROM events
+            WHERE room_id = r.room_id AND origin_server_ts <= r.ts
+            ORDER BY origin_server_ts DESC
+            LIMIT 1
+    ) e ON TRUE
+
+[events_count_before]
+SELECT r.room_id, c.count
+    FROM unnest($1::text[], $2::bigint[]) AS r(room_id, ts)
+    CROSS JOIN LATERAL (
+        SELECT count(*) FROM events
+            WHERE room_id = r.room_id AND origin_server_ts <= r.ts
+    ) c
+
+[events_count_before_events]
+-- A NULL reference event counts all the events of the room.
+SELECT r.room_id, c.count
+    FROM unnest($1::text[], $2::text[]) AS r(room_id, event_id)
+    CROSS JOIN LATERAL (
+        SELECT count(*) FROM events e
+            WHERE e.room_id = r.room_id
+              AND (r.event_id IS NULL OR
+                   e.topological_ordering < (SELECT topological_ordering FROM events
+                                               WHERE event_id = r.event_id))
+    ) c
+
+[event_topological_ordering::first]
+SELECT topological_ordering FROM events WHERE event_id = $1
+
+[existing_tables::column]
+SELECT c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r'
+      AND n.nspname = current_schema()
+      AND c.relname = ANY ($1::text[])
+
+[purge_batch::column]
+SELECT e.event_id FROM events e
+    WHERE e.room_id = $1
+      AND e.topological_ordering < $2
+      AND NOT e.outlier
+      AND NOT EXISTS (SELECT 1 FROM state_events s
+                        WHERE s.event_id = e.event_id)
+      AND NOT EXISTS (SELECT 1 FROM event_forward_extremities f
+                        WHERE f.event_id = e.event_id)
+    ORDER BY e.topological_ordering, e.stream_ordering
+    LIMIT $3
+
+[mark_state_outliers]
+-- The kept state events lose their previous events, so they are taken out
+-- of the timeline. Only the first batch of a purge finds any to update.
+UPDATE events e SET outlier = TRUE
+    WHERE e.room_id = $1
+      AND e.topological_ordering < $2
+      AND NOT e.outlier
+      AND EXISTS (SELECT 1 FROM state_events s
+                    WHERE s.event_id = e.event_id)
+      AND NOT EXISTS (SELECT 1 FROM event_forward_extremities f
+                        WHERE f.event_id = e.event_id)
+
+[add_backward_extremities]
+-- Deleted events referenced by events which remain in the timeline. The
+-- kept state events are outliers by now, and do not count.
+INSERT INTO event_backward_extremities (event_id, room_id)
+    SELECT DISTINCT ed.prev_event_id, $1 FROM event_edges ed
+        JOIN events c ON c.event_id = ed.event_id
+        WHERE ed.prev_event_id = ANY ($2::text[])
+          AND NOT ed.event_id = ANY ($2::text[])
+          AND NOT c.outlier
+          AND NOT EXISTS (SELECT 1 FROM event_backward_extremities b
+                            WHERE b.event_id = ed.prev_event_id
+                              AND b.room_id = $1)
+
+[prune_backward_extremities]
+DELETE FROM event_backward_extremities b
+    WHERE b.room_id = $1
+      AND NOT EXISTS (SELECT 1 FROM event_edges ed
+                        JOIN events c ON c.event_id = ed.event_id
+                        WHERE ed.prev_event_id = b.event_id
+                          AND NOT c.outlier)
+
 [resolve_room_alias::first]
 SELECT room_id FROM room_aliases WHERE room_alias = $1
 
@@ -18,6 +104,18 @@ SELECT room_id, array_agg(room_alias) aliases
     WHERE room_id IN (SELECT room_id FROM rooms WHERE is_public = TRUE)
     GROUP BY room_id;
 
+[matching_room_aliases]
+-- $1 is an array of anchored patterns, and $2 all of them as alternatives,
+-- which filters out most of the aliases using a single regex per row.
+SELECT a.room_id, a.room_alias, m.n - 1
+    FROM room_aliases a,
+    LATERAL (SELECT p.n
+                 FROM unnest($1::text[]) WITH ORDINALITY AS p(pattern, n)
+                 WHERE a.room_alias ~ p.pattern
+                 ORDER BY p.n
+                 LIMIT 1) m
+    WHERE a.room_alias ~ $2;
+
 [get_room_info::first]
 SELECT
     r.room_id AS room_id,
@@ -50,3 +148,344 @@ WHERE tbl.relname = $1
     AND ind.indisvalid
     AND ind.indisready
 
+[table_stats]
+SELECT
+    s.relname AS name,
+    s.n_live_tup AS live_tuples,
+    s.n_dead_tup AS dead_tuples,
+    pg_total_relation_size(s.relid) AS total_bytes,
+    c.relpages::bigint * current_setting('block_size')::bigint AS table_bytes,
+    -- Each heap tuple has a 24 byte header plus a 4 byte line pointer. Tables
+    -- which were never analyzed have no row width, and no estimation.
+    CASE WHEN c.reltuples <= 0 OR w.width IS NULL THEN 0
+    ELSE greatest(c.relpages * current_setting('block_size')::numeric
+                  - c.reltuples::numeric * (28 + w.width), 0)::bigint
+    END AS free_bytes
+FROM pg_stat_user_tables s
+    JOIN pg_class c ON c.oid = s.relid
+    LEFT JOIN LATERAL (
+        SELECT sum(st.avg_width) AS width
+            FROM pg_stats st
+            WHERE st.schemaname = s.schemaname
+                AND st.tablename = s.relname
+    ) w ON TRUE
+WHERE s.schemaname = current_schema()
+ORDER BY pg_total_relation_size(s.relid) DESC
+LIMIT $1
+
+[relation_sizes]
+SELECT c.relname, pg_total_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema()
+      AND c.relname = ANY ($1::text[])
+
+[table_estimates]
+SELECT c.relname, greatest(c.reltuples, 0)::bigint, pg_total_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r'
+      AND n.nspname = current_schema()
+      AND c.relname = ANY ($1::text[])
+
+[server_version_num::first]
+SELECT current_setting('server_version_num')::integer
+
+[has_pgstattuple::first]
+SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pgstattuple')
+
+[table_free_space::first]
+SELECT (approx_free_space + dead_tuple_len)::bigint
+    FROM pgstattuple_approx(quote_ident($1)::regclass)
+
+[index_leaf_density::first]
+SELECT avg_leaf_density FROM pgstatindex($1::oid::regclass)
+
+[relation_size::first]
+SELECT pg_relation_size($1::regclass)
+
+[index_bloat]
+SELECT
+    idx.oid AS oid,
+    idx.relname AS name,
+    tbl.relname AS table,
+    pg_get_indexdef(idx.oid) AS definition,
+    ind.indisclustered AS clustered,
+    am.amname AS method,
+    pg_relation_size(idx.oid) AS total_bytes,
+    -- Each index tuple has a 8 byte header plus a 4 byte line pointer,
+    -- and pages are filled up to 90% when an index is built. There is no
+    -- estimation for never analyzed indexes (reltuples is -1 since 14) or
+    -- for columns without statistics, like expressions.
+    CASE WHEN idx.reltuples < 0 OR ind.indexprs IS NOT NULL
+              OR w.columns < ind.indnatts THEN NULL
+    ELSE ((ceil(greatest(idx.reltuples, 0) * (12 + coalesce(w.width, 0))
+                / (current_setting('block_size')::numeric * 0.9)) + 1)
+          * current_setting('block_size')::numeric)::bigint
+    END AS expected_bytes
+FROM pg_index ind
+    JOIN pg_class idx ON idx.oid = ind.indexrelid
+    JOIN pg_class tbl ON tbl.oid = ind.indrelid
+    JOIN pg_am am ON am.oid = idx.relam
+    JOIN pg_namespace ns ON ns.oid = tbl.relnamespace
+    LEFT JOIN LATERAL (
+        SELECT sum(s.avg_width) AS width, count(*) AS columns
+            FROM pg_attribute a
+            JOIN pg_stats s ON s.schemaname = ns.nspname
+                AND s.tablename = tbl.relname
+                AND s.attname = a.attname
+            WHERE a.attrelid = tbl.oid
+                AND a.attnum = ANY (ind.indkey)
+    ) w ON TRUE
+WHERE tbl.relname = $1
+    AND ns.nspname = current_schema()
+    AND ind.indisvalid
+    AND ind.indisready
+
+[invalid_replacement_indexes::column]
+-- Invalid indexes left on the table of an index by a failed REINDEX
+-- CONCURRENTLY, whose names start with the given prefix.
+SELECT idx.relname
+    FROM pg_index ind
+    JOIN pg_class idx ON idx.oid = ind.indexrelid
+    WHERE ind.indrelid = (SELECT indrelid FROM pg_index WHERE indexrelid = $1::oid)
+      AND NOT ind.indisvalid
+      AND idx.relname LIKE replace(replace(replace($2::text, '\', '\\'),
+                                           '%', '\%'), '_', '\_') || '%'
+
+[load_sample::first]
+SELECT
+    pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0') AS wal_position,
+    (SELECT max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn))
+        FROM pg_stat_replication) AS replication_lag,
+    (SELECT count(*) FROM pg_stat_activity
+        WHERE state = 'active' AND pid <> pg_backend_pid()) AS active_backends
+
+[state_group_rooms::column]
+SELECT DISTINCT room_id FROM state_groups;
+
+[collapsible_state_groups::column]
+-- Groups referenced by events whose previous group in the delta chain is
+-- not. Groups newer than any referenced one may be in the middle of being
+-- created by Synapse, and are never touched.
+SELECT e.state_group
+    FROM state_group_edges e
+    JOIN state_groups sg ON sg.id = e.state_group
+    WHERE sg.room_id = $1
+      AND sg.id < (SELECT max(state_group) FROM event_to_state_groups)
+      AND EXISTS (SELECT 1 FROM event_to_state_groups r
+                    WHERE r.state_group = e.state_group)
+      AND NOT EXISTS (SELECT 1 FROM event_to_state_groups r
+                        WHERE r.state_group = e.prev_state_group)
+    ORDER BY e.state_group;
+
+[collapse_state_group::first]
+-- Replaces the delta stored for a group with its full state, resolved
+-- following the chain of previous groups, then detaches it from the chain.
+-- Returns the amount of rows and bytes deleted and inserted.
+WITH RECURSIVE chain(id, depth) AS (
+        SELECT $1::bigint, 0
+    UNION ALL
+        SELECT e.prev_state_group, c.depth + 1
+            FROM state_group_edges e JOIN chain c ON e.state_group = c.id
+), full_state AS (
+    SELECT DISTINCT ON (s.type, s.state_key) s.type, s.state_key, s.event_id
+        FROM state_groups_state s JOIN chain c ON s.state_group = c.id
+        ORDER BY s.type, s.state_key, c.depth
+), deleted AS (
+    DELETE FROM state_groups_state WHERE state_group = $1
+        RETURNING pg_column_size(state_groups_state.*) AS size
+), inserted AS (
+    INSERT INTO state_groups_state (state_group, room_id, type, state_key, event_id)
+        SELECT $1, $2, type, state_key, event_id FROM full_state
+        RETURNING pg_column_size(state_groups_state.*) AS size
+), detached AS (
+    DELETE FROM state_group_edges WHERE state_group = $1
+)
+SELECT (SELECT count(*) FROM deleted), (SELECT coalesce(sum(size), 0) FROM deleted),
+       (SELECT count(*) FROM inserted), (SELECT coalesce(sum(size), 0) FROM inserted);
+
+[unreferenced_state_groups::column]
+-- Groups which no event refers to, and which are not in the delta chain of
+-- any group an event refers to. Groups newer than those referenced may be
+-- still being written by Synapse, so they and their chains are needed too.
+-- Newest first, so the groups in a delta chain go before their ancestors.
+WITH RECURSIVE needed(id) AS (
+        SELECT r.state_group
+            FROM event_to_state_groups r
+            JOIN state_groups sg ON sg.id = r.state_group
+            WHERE sg.room_id = $1
+    UNION
+        SELECT sg.id
+            FROM state_groups sg
+            WHERE sg.room_id = $1
+              AND sg.id >= (SELECT max(state_group) FROM event_to_state_groups)
+    UNION
+        SELECT e.prev_state_group
+            FROM state_group_edges e JOIN needed n ON e.state_group = n.id
+)
+SELECT sg.id
+    FROM state_groups sg
+    WHERE sg.room_id = $1
+      AND NOT EXISTS (SELECT 1 FROM needed n WHERE n.id = sg.id)
+    ORDER BY sg.id DESC;
+
+[delete_state_groups::first]
+-- Returns the amount of groups, edges and state rows deleted, and the size
+-- of the state rows. Groups which got referenced since they were listed are
+-- kept, along with their delta chains: those referenced by events, newer
+-- than the referenced ones, or the previous group of one not being deleted.
+WITH RECURSIVE candidates AS (
+    SELECT unnest($1::bigint[]) AS id
+), kept(id) AS (
+        SELECT c.id
+            FROM candidates c
+            WHERE c.id >= (SELECT max(state_group) FROM event_to_state_groups)
+               OR EXISTS (SELECT 1 FROM event_to_state_groups r
+                            WHERE r.state_group = c.id)
+               OR EXISTS (SELECT 1 FROM state_group_edges e
+                            WHERE e.prev_state_group = c.id
+                              AND e.state_group NOT IN (SELECT id FROM candidates))
+    UNION
+        SELECT e.prev_state_group
+            FROM state_group_edges e JOIN kept k ON e.state_group = k.id
+            WHERE e.prev_state_group IN (SELECT id FROM candidates)
+), ids AS (
+    SELECT id FROM candidates WHERE id NOT IN (SELECT id FROM kept)
+), deleted_state AS (
+    DELETE FROM state_groups_state WHERE state_group IN (SELECT id FROM ids)
+        RETURNING pg_column_size(state_groups_state.*) AS size
+), deleted_edges AS (
+    DELETE FROM state_group_edges WHERE state_group IN (SELECT id FROM ids)
+        RETURNING 1
+), deleted_groups AS (
+    DELETE FROM state_groups WHERE id IN (SELECT id FROM ids)
+        RETURNING 1
+)
+SELECT (SELECT count(*) FROM deleted_groups), (SELECT count(*) FROM deleted_edges),
+       (SELECT count(*) FROM deleted_state),
+       (SELECT coalesce(sum(size), 0) FROM deleted_state);
+
+[rooms_without_local_members::column]
+-- Rooms, out of the given ones, which exist but have no local user joined.
+SELECT r.room_id
+    FROM unnest($1::text[]) AS r(room_id)
+    WHERE EXISTS (SELECT 1 FROM rooms WHERE rooms.room_id = r.room_id)
+      AND NOT EXISTS (SELECT 1 FROM current_state_events c
+                        JOIN room_memberships m ON m.event_id = c.event_id
+                        JOIN users u ON u.name = c.state_key
+                        WHERE c.room_id = r.room_id
+                          AND c.type = 'm.room.member'
+                          AND m.membership = 'join')
+
+[table_oid::first]
+SELECT c.oid
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r'
+      AND n.nspname = current_schema()
+      AND c.relname = $1
+
+[quoted_current_schema::first]
+SELECT quote_ident(current_schema())
+
+[repack_blockers::column]
+-- Reasons why a table cannot be compacted online, swapping it with a copy.
+SELECT 'referenced by foreign keys'
+    WHERE EXISTS (SELECT 1 FROM pg_constraint WHERE confrelid = $1 AND contype = 'f')
+UNION ALL
+SELECT 'has foreign keys'
+    WHERE EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = $1 AND contype = 'f')
+UNION ALL
+SELECT 'has exclusion or deferrable constraints'
+    WHERE EXISTS (SELECT 1 FROM pg_constraint
+                    WHERE conrelid = $1 AND (contype = 'x' OR condeferrable))
+UNION ALL
+SELECT 'has inheritance parents or children'
+    WHERE EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = $1 OR inhparent = $1)
+UNION ALL
+SELECT 'used by views or rules'
+    WHERE EXISTS (SELECT 1 FROM pg_depend d
+                    JOIN pg_rewrite r ON r.oid = d.objid
+                    WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = $1)
+UNION ALL
+SELECT 'has identity columns'
+    WHERE EXISTS (SELECT 1 FROM pg_attribute a
+                    WHERE a.attrelid = $1
+                      AND coalesce(to_jsonb(a)->>'attidentity', '') <> '')
+UNION ALL
+SELECT 'is part of a publication'
+    WHERE EXISTS (SELECT 1 FROM pg_publication_rel WHERE prrelid = $1)
+       OR EXISTS (SELECT 1 FROM pg_publication WHERE puballtables)
+UNION ALL
+SELECT 'has row level security policies'
+    WHERE EXISTS (SELECT 1 FROM pg_policy WHERE polrelid = $1)
+       OR EXISTS (SELECT 1 FROM pg_class WHERE oid = $1 AND relrowsecurity)
+
+[repack_key_columns]
+-- Columns of the primary key of a table or, lacking one, of the narrowest
+-- unique index on columns which cannot be NULL, along with their types.
+SELECT a.attname AS name, format_type(a.atttypid, a.atttypmod) AS type
+    FROM (SELECT i.indkey
+            FROM pg_index i
+            WHERE i.indrelid = $1
+              AND i.indisunique
+              AND i.indisvalid
+              AND i.indpred IS NULL
+              AND i.indexprs IS NULL
+              AND NOT EXISTS (SELECT 1 FROM pg_attribute a
+                                WHERE a.attrelid = i.indrelid
+                                  AND a.attnum = ANY (i.indkey)
+                                  AND NOT a.attnotnull)
+            ORDER BY i.indisprimary DESC, i.indnatts, i.indexrelid
+            LIMIT 1) k
+    CROSS JOIN LATERAL unnest(k.indkey::smallint[]) WITH ORDINALITY AS c(attnum, n)
+    JOIN pg_attribute a ON a.attrelid = $1 AND a.attnum = c.attnum
+    ORDER BY c.n
+
+[repack_table_options::first]
+SELECT quote_ident(pg_get_userbyid(c.relowner)), c.reloptions
+    FROM pg_class c WHERE c.oid = $1
+
+[repack_grants]
+SELECT a.privilege_type,
+       CASE a.grantee WHEN 0 THEN 'PUBLIC'
+                      ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+       a.is_grantable
+    FROM pg_class c, aclexplode(c.relacl) a
+    WHERE c.oid = $1
+      AND a.grantee <> c.relowner
+
+[repack_indexes]
+SELECT i.indexrelid AS oid,
+       c.relname AS name,
+       pg_get_indexdef(i.indexrelid) AS definition,
+       con.contype AS constraint_type,
+       i.indisclustered AS clustered
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid
+                               AND con.conrelid = i.indrelid
+                               AND con.contype IN ('p', 'u')
+    WHERE i.indrelid = $1
+      AND i.indisvalid
+    ORDER BY c.relname
+
+[repack_triggers::column]
+SELECT pg_get_triggerdef(t.oid)
+    FROM pg_trigger t
+    WHERE t.tgrelid = $1
+      AND NOT t.tgisinternal
+      AND t.tgname <> 'synpurge_repack'
+    ORDER BY t.tgname
+
+[repack_owned_sequences]
+SELECT quote_ident(n.nspname) || '.' || quote_ident(s.relname), a.attname
+    FROM pg_depend d
+    JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+    JOIN pg_namespace n ON n.oid = s.relnamespace
+    JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+    WHERE d.classid = 'pg_class'::regclass
+      AND d.refclassid = 'pg_class'::regclass
+      AND d.refobjid = $1
+      AND d.deptype = 'a'
@@ -0,0 +1,148 @@
+-- Subset of the Synapse database schema used by synpurge, for benchmarks.
+-- Tables and indexes are created in the current schema (search_path).
+
+CREATE TABLE rooms (
+    room_id TEXT NOT NULL PRIMARY KEY,
+    is_public BOOLEAN,
+    creator TEXT
+);
+
+CREATE TABLE room_aliases (
+    room_alias TEXT NOT NULL UNIQUE,
+    room_id TEXT NOT NULL
+);
+CREATE INDEX room_aliases_id ON room_aliases (room_id);
+
+CREATE TABLE events (
+    stream_ordering BIGINT NOT NULL UNIQUE,
+    topological_ordering BIGINT NOT NULL,
+    event_id TEXT NOT NULL UNIQUE,
+    type TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    content TEXT,
+    sender TEXT,
+    depth BIGINT NOT NULL DEFAULT 0,
+    origin_server_ts BIGINT,
+    outlier BOOLEAN NOT NULL DEFAULT FALSE,
+    processed BOOLEAN NOT NULL DEFAULT TRUE
+);
+CREATE INDEX events_order_room ON events (room_id, topological_ordering, stream_ordering);
+CREATE INDEX events_room_stream ON events (room_id, stream_ordering);
+CREATE INDEX events_ts ON events (origin_server_ts, stream_ordering);
+
+CREATE TABLE event_json (
+    event_id TEXT NOT NULL UNIQUE,
+    room_id TEXT NOT NULL,
+    internal_metadata TEXT NOT NULL,
+    json TEXT NOT NULL
+);
+
+CREATE TABLE state_events (
+    event_id TEXT NOT NULL UNIQUE,
+    room_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    state_key TEXT NOT NULL,
+    prev_state TEXT
+);
+
+CREATE TABLE room_memberships (
+    event_id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    membership TEXT NOT NULL
+);
+CREATE INDEX room_memberships_room_id ON room_memberships (room_id);
+CREATE INDEX room_memberships_user_id ON room_memberships (user_id);
+
+CREATE TABLE event_edges (
+    event_id TEXT NOT NULL,
+    prev_event_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    is_state BOOLEAN NOT NULL DEFAULT FALSE
+);
+CREATE UNIQUE INDEX event_edges_event_id_prev_event_id_idx ON event_edges (event_id, prev_event_id);
+CREATE INDEX ev_edges_prev_id ON event_edges (prev_event_id);
+
+CREATE TABLE event_auth (
+    event_id TEXT NOT NULL,
+    auth_id TEXT NOT NULL,
+    room_id TEXT NOT NULL
+);
+CREATE INDEX evauth_edges_id ON event_auth (event_id);
+
+CREATE TABLE event_reference_hashes (
+    event_id TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    hash BYTEA NOT NULL
+);
+CREATE UNIQUE INDEX event_reference_hashes_event_id_algorithm ON event_reference_hashes (event_id, algorithm);
+
+CREATE TABLE event_search (
+    event_id TEXT NOT NULL UNIQUE,
+    room_id TEXT NOT NULL,
+    sender TEXT,
+    key TEXT NOT NULL,
+    vector TSVECTOR,
+    origin_server_ts BIGINT,
+    stream_ordering BIGINT
+);
+CREATE INDEX event_search_fts_idx ON event_search USING gin (vector);
+
+CREATE TABLE event_to_state_groups (
+    event_id TEXT NOT NULL UNIQUE,
+    state_group BIGINT NOT NULL
+);
+
+CREATE TABLE state_groups (
+    id BIGINT PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL
+);
+
+CREATE TABLE state_group_edges (
+    state_group BIGINT NOT NULL,
+    prev_state_group BIGINT NOT NULL
+);
+CREATE INDEX state_group_edges_idx ON state_group_edges (state_group);
+CREATE INDEX state_group_edges_prev_idx ON state_group_edges (prev_state_group);
+
+CREATE TABLE state_groups_state (
+    state_group BIGINT NOT NULL,
+    room_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    state_key TEXT NOT NULL,
+    event_id TEXT NOT NULL
+);
+CREATE INDEX state_groups_state_type_idx ON state_groups_state (state_group, type, state_key);
+
+CREATE TABLE event_forward_extremities (
+    event_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    UNIQUE (event_id, room_id)
+);
+
+CREATE TABLE event_backward_extremities (
+    event_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    UNIQUE (event_id, room_id)
+);
+
+CREATE TABLE event_push_actions (
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    actions TEXT NOT NULL
+);
+CREATE INDEX event_push_actions_room_id_user_id ON event_push_actions (room_id, user_id);
+
+CREATE TABLE redactions (
+    event_id TEXT NOT NULL UNIQUE,
+    redacts TEXT NOT NULL
+);
+
+CREATE TABLE rejections (
+    event_id TEXT NOT NULL PRIMARY KEY,
+    reason TEXT NOT NULL,
+    last_check TEXT NOT NULL
+);
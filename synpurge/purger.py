@@ -6,12 +6,13 @@
 # Distributed under terms of the GPLv3 license.
 
 import attr
+import itertools
 import logging
+import time
 
-from . import config
+from . import config, minimx
+from .metrics import registry
 from attr import validators as vv
-from datetime import datetime
-from delorean import Delorean
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +48,19 @@ class PurgeInfo(object):
                        default=None, init=False)
     matched_alias = attr.ib(validator=vv.optional(vv.instance_of(str)),
                             default=None)
+    estimate = attr.ib(validator=vv.optional(vv.instance_of(int)),
+                       default=None, init=False)
+    abandoned = attr.ib(validator=vv.instance_of(bool), default=False,
+                        init=False)
+
+    @property
+    def delete(self):
+        """Whether the room is to be deleted as a whole, instead of purged."""
+        return self.abandoned and self.config.abandoned == "delete"
+
+    def cutoff_ms(self, now_ms):
+        """Like :meth:`config.Room.cutoff_ms`, but abandoned rooms keep nothing."""
+        return now_ms if self.abandoned else self.config.cutoff_ms(now_ms)
 
     @property
     def room_display_name(self):
@@ -82,15 +96,22 @@ class RoomIdsResolver(object):
         self._rooms[room_id] = PurgeInfo(room_id, room_conf,
                                          matched_alias=matched_alias)
 
+    def resolve_patterns(self, room_confs, replace: bool = False):
+        matcher = config.AliasMatcher(sorted(room_confs, key=lambda r: r.name))
+        if not matcher:
+            return
+        log.debug("Expanding room patterns: %r", matcher)
+        for room_id, room_alias, room_conf in self._api.match_room_aliases(matcher):
+            for other in matcher.match_all(room_alias):
+                if other is not room_conf:
+                    log.warning("Alias %s of room %s matches both [%s] and [%s], using [%s]",
+                                room_alias, room_id, room_conf.name, other.name, room_conf.name)
+            self.__add(room_id, room_conf, room_alias, replace)
+
     def resolve(self, room_conf: config.Room, replace: bool = False):
         params = dict(access_token=room_conf.token)
         if room_conf.pattern:
-            log.debug("Expanding room pattern: %s", room_conf.name)
-            room_alias_matches = room_conf.build_alias_matcher()
-            for room_id, room_aliases in self._api.all_rooms.items():
-                for room_alias in room_aliases:
-                    if room_alias_matches(room_alias):
-                        self.__add(room_id, room_conf, room_alias, replace)
+            self.resolve_patterns((room_conf,), replace)
         elif room_conf.name.startswith("!"):
             self.__add(room_conf.name, room_conf, replace)
         else:
@@ -104,28 +125,328 @@ class RoomIdsResolver(object):
                                 in self._rooms.items())), self._warnings)
 
 
+@attr.s
+class PurgeExecutor(object):
+    """
+    Runs purge operations using a bounded pool of worker threads.
+
+    The ``purge`` callable is invoked as ``purge(current, total, info)``.
+    Purges are consumed lazily from the iterable passed to :meth:`run`, so
+    it can be fed from a pipeline; ``total`` is then an upper bound.
+    Maintenance callbacks added with :meth:`add_barrier` are run every
+    ``interval`` purges, once all the purges submitted so far have
+    completed and none is in flight. Once the ``deadline`` (as given by
+    :func:`time.monotonic`) passes, no more purges are started.
+    """
+    _purge = attr.ib()
+    jobs = attr.ib(validator=vv.instance_of(int), default=1, convert=int)
+    deadline = attr.ib(default=None)
+    _barriers = attr.ib(default=attr.Factory(list), init=False)
+
+    def add_barrier(self, interval, callback):
+        if interval:
+            self._barriers.append((interval, callback))
+
+    def run(self, purges, total=None):
+        from concurrent.futures import ThreadPoolExecutor
+        if total is None:
+            purges = tuple(purges)
+            total = len(purges)
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            try:
+                for current, info in zip(itertools.count(1), purges):
+                    if self.deadline is not None and time.monotonic() >= self.deadline:
+                        log.info("Time budget spent, not starting more purges after %i",
+                                 current - 1)
+                        break
+                    in_flight.add(pool.submit(self._purge, current, total, info))
+                    callbacks = [callback for interval, callback in self._barriers
+                                 if current % interval == 0]
+                    if callbacks:
+                        self.__wait(in_flight, everything=True)
+                        log.debug("Reached barrier after %i purges", current)
+                        for callback in callbacks:
+                            callback()
+                    elif len(in_flight) >= self.jobs:
+                        self.__wait(in_flight)
+                self.__wait(in_flight, everything=True)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                raise
+
+    @staticmethod
+    def __wait(in_flight, everything=False):
+        from concurrent.futures import wait, ALL_COMPLETED, FIRST_COMPLETED
+        done, _ = wait(in_flight,
+                       return_when=ALL_COMPLETED if everything else FIRST_COMPLETED)
+        in_flight.difference_update(done)
+        for future in done:
+            future.result()  # Re-raises exceptions from the worker.
+
+
+LOOKUP_BATCH_SIZE = 100
+_LOOKUP_QUEUE_SIZE = 64
+
+
+def lookup_event_ids(purges, lookup, batch_size=1, queue_size=_LOOKUP_QUEUE_SIZE,
+                     labels=None):
+    """
+    Finds reference events in a background thread, yielding each purge as
+    soon as its event is known.
+
+    The ``lookup`` callable receives lists of up to ``batch_size`` purges,
+    and sets their ``event_id``. Purges without a reference event are
+    skipped. At most ``queue_size`` purges are kept waiting to be consumed,
+    and closing the generator stops the lookups.
+    """
+    import queue
+    import threading
+
+    pending = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            batch = []
+            for info in purges:
+                batch.append(info)
+                if len(batch) >= batch_size:
+                    if not produce_batch(batch):
+                        return
+                    batch = []
+            if batch and not produce_batch(batch):
+                return
+            put(finished)
+        except BaseException as e:
+            put(e)
+
+    def produce_batch(batch):
+        lookup(batch)
+        for info in batch:
+            if info.event_id is None:
+                log.info("No reference event for room %s (%s), skipping",
+                         info.room_id, info.room_display_name)
+                registry.inc("synpurge_rooms_skipped_total", reason="no_reference_event",
+                             **(labels or {}))
+            elif not put(info):
+                return False
+        return True
+
+    producer = threading.Thread(target=produce, name="synpurge-lookup",
+                                daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is finished:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def order_by_estimate(purges, labels=None):
+    """
+    Sorts purges by their estimated size, largest first.
+
+    Rooms which are known to have no history to purge are left out.
+    """
+    ordered = []
+    for info in purges:
+        if info.estimate == 0:
+            log.info("Nothing to purge in room %s (%s), skipping",
+                     info.room_id, info.room_display_name)
+            registry.inc("synpurge_rooms_skipped_total", reason="nothing_to_purge",
+                         **(labels or {}))
+        else:
+            ordered.append(info)
+    ordered.sort(key=lambda info: info.estimate or 0, reverse=True)
+    return ordered
+
+
+def purge_room(info, api, db=None, db_conf=None, timeout=None, poll=False,
+               throttle=None):
+    """
+    Purges the history of a room up to its reference event.
+
+    Uses the batched SQL engine when ``db_conf`` selects it, and the purge
+    history endpoint of ``api`` otherwise. Raises :class:`minimx.APITimeout`
+    if the homeserver does not complete the purge in ``timeout`` seconds.
+    """
+    if throttle is not None:
+        throttle.wait()
+    if db_conf is not None and db_conf.purge_engine == "sql":
+        deleted = db.purge_history(info.room_id, info.event_id,
+                                   batch_size=db_conf.purge_batch_size,
+                                   pause=db_conf.purge_batch_pause,
+                                   throttle=throttle)
+        log.debug("Deleted %i events from room %s", deleted, info.room_id)
+    else:
+        api.purge_history(info.room_id, info.event_id,
+                          timeout=timeout,
+                          params=dict(access_token=info.config.token),
+                          poll=poll)
+
+
+def mark_abandoned(purges, source):
+    """
+    Marks the rooms without joined local users, for those configured to do
+    something about it, checking membership with ``source`` (either the
+    database or the API). Returns a tuple with the rooms to purge, and the
+    rooms to delete as a whole.
+    """
+    candidates = [info for info in purges if info.config.abandoned != "keep"]
+    if not candidates:
+        return purges, ()
+    log.info("Checking local membership of %i rooms", len(candidates))
+    abandoned = source.rooms_without_local_members(info.room_id for info in candidates)
+    for info in candidates:
+        if info.room_id in abandoned:
+            log.info("Room %s (%s) has no local members, will %s it",
+                     info.room_id, info.room_display_name, info.config.abandoned)
+            info.abandoned = True
+    return (frozenset(info for info in purges if not info.delete),
+            tuple(info for info in purges if info.delete))
+
+
+def delete_room(info, api, timeout=None, throttle=None):
+    """
+    Deletes a room as a whole. This is always done with the admin API, even
+    with the SQL purge engine: Synapse keeps data about rooms in many tables
+    and caches, which only it knows how to clean up.
+    """
+    if throttle is not None:
+        throttle.wait()
+    api.delete_room(info.room_id, deadline=timeout,
+                    params=dict(access_token=info.config.token))
+
+
 def resolve_room_ids(conf, api, replace=False):
     resolver = RoomIdsResolver(api)
+    # Patterns are all matched at once, in a single pass over the aliases.
+    resolver.resolve_patterns((r for r in conf.rooms if r.pattern), replace)
     for room_conf in conf.rooms:
-        resolver.resolve(room_conf, replace)
+        if not room_conf.pattern:
+            resolver.resolve(room_conf, replace)
     return resolver.get_purge_info()
 
 
-def find_event_id(room_id, upto, api, params=None):
+# Only the fields needed to find the reference event are requested. Servers
+# which do not support "event_fields" for room events ignore it, but
+# lazy-loading members still avoids sending their state events along.
+_MESSAGES_FILTER = dict(lazy_load_members=True,
+                        event_fields=["event_id", "origin_server_ts"])
+_MESSAGES_PAGE_SIZE = 250
+
+_ESTIMATE_FILTER = dict(lazy_load_members=True, event_fields=["event_id"])
+_ESTIMATE_PAGE_SIZE = 1000
+
+
+def epoch_ms():
+    """Current time, in milliseconds since the epoch (as ``origin_server_ts``)."""
+    return int(time.time() * 1000)
+
+
+def format_epoch_ms(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(timestamp // 1000))
+
+
+def find_event_id(room_id, timestamp, api, params=None):
+    """
+    Finds the last event of a room sent before ``timestamp``, given in
+    milliseconds since the epoch.
+    """
     log.debug("Finding event before %s for room %s",
-              upto.format_datetime(), room_id)
-    data = api.get_room_messages(room_id, limit=250, params=params)
+              format_epoch_ms(timestamp), room_id)
+    if api.supports_timestamp_to_event is not False:
+        try:
+            return _find_event_id_by_timestamp(room_id, timestamp, api, params)
+        except minimx.APIUnsupported:
+            log.info("Homeserver lacks timestamp_to_event, paginating room messages")
+    return _find_event_id_paginating(room_id, timestamp, api, params)
+
+
+def _find_event_id_by_timestamp(room_id, timestamp, api, params):
+    # The endpoint returns the closest event at or before the timestamp,
+    # while pagination looks for an event strictly older than it.
+    found = api.get_event_for_timestamp(room_id, timestamp - 1,
+                                        params=_copy_params(params))
+    if found is None:
+        log.debug("No event before %i in room %s", timestamp, room_id)
+        return None
+    event_id, event_ts = found
+    log.debug("Found event %s (ts=%i)", event_id, event_ts)
+    return event_id
+
+
+def _find_event_id_paginating(room_id, timestamp, api, params):
+    end = None
     while True:
-        start, end, chunk = data["start"], data["end"], data["chunk"]
+        data = api.get_room_messages(room_id, end,
+                                     limit=_MESSAGES_PAGE_SIZE,
+                                     room_filter=_MESSAGES_FILTER,
+                                     params=_copy_params(params))
+        start, end, chunk = data["start"], data.get("end"), data["chunk"]
         log.debug("Got %d messages from %s to %s", len(chunk), start, end)
         for event in chunk:
-            ts = datetime.fromtimestamp(event["origin_server_ts"] / 1000)
-            event_time = Delorean(ts, timezone="UTC")
-            if event_time < upto:
+            if event["origin_server_ts"] < timestamp:
                 event_id = event["event_id"]
-                log.debug("Found event %s (%s)", event_id,
-                          event_time.format_datetime())
+                log.debug("Found event %s (ts=%i)", event_id,
+                          event["origin_server_ts"])
                 return event_id
-        if start == end:
+        if not chunk or end is None or start == end:
             return None
-        data = api.get_room_messages(room_id, end, limit=250, params=params)
+
+
+_ESTIMATE_MAX_PAGES = 2
+
+
+def estimate_purge_size(room_id, event_id, api, params=None,
+                        max_pages=_ESTIMATE_MAX_PAGES):
+    """
+    Estimates how many events would be purged, by paginating back from the
+    reference event. Counting stops after ``max_pages`` pages of events, so
+    rooms with more history cannot be told apart.
+
+    Returns a ``(count, capped)`` tuple, where ``capped`` tells whether
+    counting stopped before reaching the start of the room, in which case
+    ``count`` is a lower bound.
+    """
+    context = api.get_event_context(room_id, event_id, limit=0,
+                                    params=_copy_params(params))
+    count, token = 0, context.get("start")
+    for _ in range(max_pages):
+        if token is None:
+            break
+        data = api.get_room_messages(room_id, token,
+                                     limit=_ESTIMATE_PAGE_SIZE,
+                                     room_filter=_ESTIMATE_FILTER,
+                                     params=_copy_params(params))
+        count += len(data["chunk"])
+        if not data["chunk"] or data.get("end") in (None, data["start"]):
+            token = None
+            break
+        token = data["end"]
+    capped = token is not None
+    log.debug("Estimated %s%i events to purge in room %s",
+              "at least " if capped else "", count, room_id)
+    return count, capped
+
+
+def _copy_params(params):
+    return {} if params is None else dict(params)
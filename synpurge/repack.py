@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Online compaction of tables, in the spirit of pg_repack.
+
+Live rows are copied into a shadow table while a trigger records the keys
+of the rows changed in the meantime. Once the indexes of the shadow table
+are built, the recorded changes are replayed into it in small batches, and
+the tables are finally swapped under an exclusive lock which is only held
+for the last, short replay. No extension is needed: the swap renames the
+tables instead of exchanging their files, which is why tables referenced
+by foreign keys, views, rules, publications or row security policies cannot
+be compacted this way.
+"""
+
+import attr
+import logging
+import re
+import time
+
+from .pg import _quote_ident
+from attr import validators as vv
+
+log = logging.getLogger(__name__)
+
+
+class CannotRepack(Exception):
+    pass
+
+
+# SQLSTATE of "lock_not_available", raised when "lock_timeout" expires.
+_LOCK_NOT_AVAILABLE = "55P03"
+
+_CREATE_INDEX_RE = re.compile(r"^CREATE (UNIQUE )?INDEX (\S+) ON (ONLY )?(\S+) USING ")
+
+
+@attr.s
+class Repack(object):
+    """
+    Compacts ``table`` using the connection ``db``, which needs the Synapse
+    query library loaded. Changes are replayed in batches of ``batch_size``
+    rows, and locks are waited for at most ``lock_timeout`` seconds; the
+    final swap is attempted up to ``swap_attempts`` times.
+    """
+    db = attr.ib()
+    table = attr.ib(validator=vv.instance_of(str))
+    batch_size = attr.ib(validator=vv.instance_of(int), default=10000, convert=int)
+    lock_timeout = attr.ib(validator=vv.instance_of(float), default=5.0, convert=float)
+    swap_attempts = attr.ib(validator=vv.instance_of(int), default=5, convert=int)
+    _oid = attr.ib(default=None, init=False, repr=False)
+    _schema = attr.ib(default=None, init=False, repr=False)
+    _key = attr.ib(default=None, init=False, repr=False)
+
+    def run(self):
+        """
+        Compacts the table. Returns the sizes of the table (including
+        indexes and TOAST) before and after. Raises :class:`CannotRepack`
+        if the table does not meet the requirements, in which case nothing
+        has been done.
+        """
+        self.__inspect()
+        size_before = self.__size()
+        self.__drop_leftovers()
+        try:
+            self.__install_trigger()
+            self.__copy()
+            self.__build_indexes()
+            replayed = self.__replay()
+            while replayed >= self.batch_size:
+                replayed = self.__replay()
+            self.__swap()
+        except BaseException:
+            self.__drop_leftovers()
+            raise
+        self.__execute("ANALYZE {}".format(self.__name(self.table)))
+        size_after = self.__size()
+        log.info("Repacked '%s', %i bytes reclaimed", self.table, size_before - size_after)
+        return size_before, size_after
+
+    def __name(self, name):
+        return "{}.{}".format(self._schema, _quote_ident(name))
+
+    @property
+    def __shadow(self):
+        return self.__name("synpurge_repack_{}".format(self._oid))
+
+    @property
+    def __log(self):
+        return self.__name("synpurge_repack_log_{}".format(self._oid))
+
+    def __execute(self, statement):
+        log.debug(statement)
+        self.db.execute(statement)
+
+    def __size(self):
+        return dict(self.db.synapse.relation_sizes([self.table])).get(self.table, 0)
+
+    def __set_lock_timeout(self):
+        self.__execute("SET LOCAL lock_timeout = '{}ms'".format(int(self.lock_timeout * 1000)))
+
+    def __inspect(self):
+        lib = self.db.synapse
+        self._oid = lib.table_oid(self.table)
+        if self._oid is None:
+            raise CannotRepack("no such table '{}'".format(self.table))
+        self._schema = lib.quoted_current_schema()
+        reasons = list(lib.repack_blockers(self._oid))
+        self._key = [(_quote_ident(name), type_name)
+                     for name, type_name in lib.repack_key_columns(self._oid)]
+        if not self._key:
+            reasons.append("no primary key or unique index on NOT NULL columns")
+        if reasons:
+            raise CannotRepack("table '{}': {}".format(self.table, ", ".join(reasons)))
+
+    def __key_match(self, left, right):
+        return "({}) = ({})".format(", ".join("{}.{}".format(left, k) for k, _ in self._key),
+                                    ", ".join("{}.{}".format(right, k) for k, _ in self._key))
+
+    def __install_trigger(self):
+        columns = ", ".join(k for k, _ in self._key)
+        function = "{}()".format(self.__log)
+        with self.db.xact():
+            self.__set_lock_timeout()
+            self.__execute("CREATE UNLOGGED TABLE {} (id BIGSERIAL PRIMARY KEY, {})".format(
+                self.__log, ", ".join("{} {}".format(k, t) for k, t in self._key)))
+            self.__execute("""CREATE FUNCTION {function} RETURNS trigger LANGUAGE plpgsql AS $repack$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        INSERT INTO {log} ({columns}) VALUES ({old});
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO {log} ({columns}) VALUES ({new});
+    END IF;
+    RETURN NULL;
+END
+$repack$""".format(function=function, log=self.__log, columns=columns,
+                   old=", ".join("OLD." + k for k, _ in self._key),
+                   new=", ".join("NEW." + k for k, _ in self._key)))
+            # Waits for the transactions writing to the table, so every
+            # change not recorded by the trigger is seen by the copy.
+            self.__execute("CREATE TRIGGER synpurge_repack AFTER INSERT OR UPDATE OR DELETE"
+                           " ON {} FOR EACH ROW EXECUTE PROCEDURE {}".format(
+                               self.__name(self.table), function))
+
+    def __copy(self):
+        lib = self.db.synapse
+        table = self.__name(self.table)
+        owner, options = lib.repack_table_options(self._oid)
+        started = time.monotonic()
+        with self.db.xact():
+            self.__execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS"
+                           " INCLUDING STORAGE INCLUDING COMMENTS)".format(self.__shadow, table))
+            self.__execute("ALTER TABLE {} OWNER TO {}".format(self.__shadow, owner))
+            if options:
+                self.__execute("ALTER TABLE {} SET ({})".format(self.__shadow, ", ".join(options)))
+            for privilege, grantee, grantable in lib.repack_grants(self._oid):
+                self.__execute("GRANT {} ON {} TO {}{}".format(privilege, self.__shadow, grantee,
+                                                               " WITH GRANT OPTION" if grantable else ""))
+            self.__execute("INSERT INTO {} SELECT * FROM ONLY {}".format(self.__shadow, table))
+        log.debug("Copied '%s' in %.2fs", self.table, time.monotonic() - started)
+
+    def __build_indexes(self):
+        for oid, name, definition, constraint_type, clustered in self.db.synapse.repack_indexes(self._oid):
+            self.__execute(_CREATE_INDEX_RE.sub(
+                lambda m: "CREATE {}INDEX {} ON {} USING ".format(
+                    m.group(1) or "", _quote_ident("synpurge_repack_index_{}".format(oid)),
+                    self.__shadow),
+                definition, count=1))
+
+    def __replay(self):
+        """Applies a batch of the recorded changes. Returns how many."""
+        # A single snapshot for all the statements, so exactly the recorded
+        # changes which are visible get applied and removed from the log.
+        with self.db.xact(isolation="REPEATABLE READ"):
+            upper = self.db.prepare("SELECT max(id) FROM (SELECT id FROM {} ORDER BY id LIMIT $1) b"
+                                    .format(self.__log)).first(self.batch_size)
+            if upper is None:
+                return 0
+            self.__apply_log(upper)
+            count = self.db.prepare("WITH d AS (DELETE FROM {} WHERE id <= $1 RETURNING 1)"
+                                    " SELECT count(*) FROM d".format(self.__log)).first(upper)
+        log.debug("Replayed %i changes into the copy of '%s'", count, self.table)
+        return count
+
+    def __apply_log(self, upper):
+        # Rows with a recorded key are replaced by their current version.
+        # Joining from the keys lets both tables be probed by their index.
+        keys = "(SELECT DISTINCT {} FROM {} WHERE id <= $1)".format(
+            ", ".join(k for k, _ in self._key), self.__log)
+        self.db.prepare("DELETE FROM {} s USING {} l WHERE {}"
+                        .format(self.__shadow, keys, self.__key_match("s", "l"))).first(upper)
+        self.db.prepare("INSERT INTO {} SELECT t.* FROM {} l JOIN ONLY {} t ON {}"
+                        .format(self.__shadow, keys, self.__name(self.table),
+                                self.__key_match("t", "l"))).first(upper)
+
+    def __swap(self):
+        lib = self.db.synapse
+        indexes = list(lib.repack_indexes(self._oid))
+        triggers = list(lib.repack_triggers(self._oid))
+        sequences = list(lib.repack_owned_sequences(self._oid))
+        for attempt in range(1, self.swap_attempts + 1):
+            try:
+                with self.db.xact():
+                    self.__set_lock_timeout()
+                    self.__execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(
+                        self.__name(self.table)))
+                    upper = self.db.prepare("SELECT max(id) FROM {}".format(self.__log)).first()
+                    if upper is not None:
+                        self.__apply_log(upper)
+                    self.__replace(indexes, triggers, sequences)
+                return
+            except Exception as e:
+                if getattr(e, "code", None) != _LOCK_NOT_AVAILABLE or attempt == self.swap_attempts:
+                    raise
+                log.info("Could not lock '%s' to swap it (attempt %i/%i), retrying",
+                         self.table, attempt, self.swap_attempts)
+                # Catch up with changes made while waiting for the lock.
+                self.__replay()
+
+    def __replace(self, indexes, triggers, sequences):
+        for sequence, column in sequences:
+            self.__execute("ALTER SEQUENCE {} OWNED BY {}.{}".format(sequence, self.__shadow,
+                                                                     _quote_ident(column)))
+        self.__execute("DROP TABLE {}".format(self.__name(self.table)))
+        self.__execute("ALTER TABLE {} RENAME TO {}".format(self.__shadow, _quote_ident(self.table)))
+        table = self.__name(self.table)
+        for oid, name, definition, constraint_type, clustered in indexes:
+            tmp_name = _quote_ident("synpurge_repack_index_{}".format(oid))
+            if constraint_type == "p":
+                self.__execute("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY USING INDEX {}"
+                               .format(table, _quote_ident(name), tmp_name))
+            elif constraint_type == "u":
+                self.__execute("ALTER TABLE {} ADD CONSTRAINT {} UNIQUE USING INDEX {}"
+                               .format(table, _quote_ident(name), tmp_name))
+            else:
+                self.__execute("ALTER INDEX {}.{} RENAME TO {}".format(self._schema, tmp_name,
+                                                                       _quote_ident(name)))
+            if clustered:
+                self.__execute("ALTER TABLE {} CLUSTER ON {}".format(table, _quote_ident(name)))
+        for definition in triggers:
+            self.__execute(definition)
+        self.__execute("DROP TABLE {}".format(self.__log))
+        self.__execute("DROP FUNCTION {}()".format(self.__log))
+
+    def __drop_leftovers(self):
+        # Also cleans up after a previous run which was interrupted.
+        for statement in ("DROP TRIGGER IF EXISTS synpurge_repack ON {}".format(self.__name(self.table)),
+                          "DROP TABLE IF EXISTS {}".format(self.__shadow),
+                          "DROP TABLE IF EXISTS {}".format(self.__log),
+                          "DROP FUNCTION IF EXISTS {}()".format(self.__log)):
+            try:
+                with self.db.xact():
+                    self.__set_lock_timeout()
+                    self.__execute(statement)
+            except Exception as e:
+                log.warning("Could not clean up after repacking '%s': %s", self.table, e)
+
+
+def repack_table(db, table, **kwargs):
+    return Repack(db, table, **kwargs).run()
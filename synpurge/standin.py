@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Minimal stand-in for a Synapse homeserver.
+
+Implements just enough of the client and admin HTTP APIs used by synpurge
+to exercise :class:`synpurge.minimx.API` locally, without touching a real
+homeserver. Room state is kept in memory, and purges can be configured to
+take a while to complete, like they do in Synapse. Latency and rate limits
+can be injected as well, and the server counts the requests it handles and
+the bytes transferred, for benchmarking.
+"""
+
+import attr
+import bisect
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+
+from attr import validators as vv
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlsplit
+
+log = logging.getLogger(__name__)
+
+
+@attr.s
+class Room(object):
+    room_id = attr.ib(validator=vv.instance_of(str))
+    aliases = attr.ib(default=attr.Factory(list))
+    public = attr.ib(validator=vv.instance_of(bool), default=True)
+    local_members = attr.ib(validator=vv.instance_of(int), default=1)
+    # List of (event_id, origin_server_ts) tuples, oldest first.
+    events = attr.ib(default=attr.Factory(list))
+
+
+@attr.s
+class Purge(object):
+    purge_id = attr.ib(validator=vv.instance_of(str))
+    room_id = attr.ib(validator=vv.instance_of(str))
+    event_id = attr.ib(validator=vv.instance_of(str))
+    finishes_at = attr.ib()
+    status = attr.ib(default="active")
+
+
+@attr.s
+class Stats(object):
+    requests = attr.ib(default=attr.Factory(dict))
+    rate_limited = attr.ib(default=0)
+    bytes_received = attr.ib(default=0)
+    bytes_sent = attr.ib(default=0)
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+
+@attr.s
+class Homeserver(object):
+    """
+    In-memory state of the stand-in homeserver.
+
+    Each purge stays ``active`` for ``purge_duration`` seconds, after which
+    the events older than the reference event are removed from the room.
+    With ``blocking_purges``, purge requests do not return until the purge
+    is complete, like in older versions of Synapse, and with
+    ``failing_purges`` purges end up ``failed``, leaving the room untouched. Events are padded with
+    ``event_size`` bytes of content, and old servers can be simulated by
+    disabling ``timestamp_to_event``.
+
+    Every request is delayed by ``latency`` seconds. If ``rate_limit`` is
+    non-zero, requests beyond that many per second (with bursts of up to
+    the same amount) are rejected with ``429 Too Many Requests``.
+    """
+    purge_duration = attr.ib(default=0.0, convert=float)
+    event_size = attr.ib(default=200, convert=int)
+    timestamp_to_event = attr.ib(default=True, convert=bool)
+    blocking_purges = attr.ib(default=False, convert=bool)
+    failing_purges = attr.ib(default=False, convert=bool)
+    admin_room_list = attr.ib(default=True, convert=bool)
+    latency = attr.ib(default=0.0, convert=float)
+    rate_limit = attr.ib(default=0.0, convert=float)
+    rooms = attr.ib(default=attr.Factory(dict), init=False)
+    purges = attr.ib(default=attr.Factory(dict), init=False)
+    deletions = attr.ib(default=attr.Factory(dict), init=False)
+    stats = attr.ib(default=attr.Factory(Stats), init=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False)
+    _ids = attr.ib(default=attr.Factory(itertools.count), init=False,
+                   repr=False)
+    _allowance = attr.ib(default=None, init=False, repr=False)
+    _last_request = attr.ib(default=None, init=False, repr=False)
+
+    def add_room(self, room_id, aliases=(), public=True, events=(), local_members=1):
+        room = Room(room_id, list(aliases), public, local_members,
+                    sorted(events, key=lambda e: e[1]))
+        self.rooms[room_id] = room
+        return room
+
+    def list_rooms(self, public_only=True, search_term=None):
+        if search_term is not None:
+            search_term = search_term.lower()
+
+        def listed(room):
+            if public_only and not room.public:
+                return False
+            # Like Synapse, only the canonical alias (the first one) is searched.
+            return search_term is None or \
+                any(search_term in alias.lower() for alias in room.aliases[:1])
+
+        with self._lock:
+            return [room for room_id, room in sorted(self.rooms.items()) if listed(room)]
+
+    def resolve_alias(self, room_alias):
+        with self._lock:
+            for room in self.rooms.values():
+                if room_alias in room.aliases:
+                    return room.room_id
+        return None
+
+    def admit(self):
+        """
+        Accounts for a request against the rate limit. Returns ``None`` if
+        the request is allowed, otherwise the amount of milliseconds after
+        which the client may retry.
+        """
+        if not self.rate_limit:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._last_request is None:
+                self._allowance = self.rate_limit
+            else:
+                refill = (now - self._last_request) * self.rate_limit
+                self._allowance = min(self.rate_limit, self._allowance + refill)
+            self._last_request = now
+            if self._allowance >= 1.0:
+                self._allowance -= 1.0
+                return None
+            self.stats.rate_limited += 1
+            return int(1000 * (1.0 - self._allowance) / self.rate_limit) + 1
+
+    def account(self, route, received, sent):
+        with self._lock:
+            self.stats.requests[route] = self.stats.requests.get(route, 0) + 1
+            self.stats.bytes_received += received
+            self.stats.bytes_sent += sent
+
+    def completed_purges(self):
+        with self._lock:
+            self.__complete_due()
+            return sum(1 for purge in self.purges.values()
+                       if purge.status == "complete")
+
+    def room_events(self, room_id):
+        with self._lock:
+            self.__complete_due()
+            room = self.rooms.get(room_id)
+            return None if room is None else list(room.events)
+
+    def event_json(self, room_id, event, fields=None):
+        event_id, origin_server_ts = event
+        data = dict(event_id=event_id,
+                    origin_server_ts=origin_server_ts,
+                    room_id=room_id,
+                    sender="@standin:localhost",
+                    type="m.room.message",
+                    content=dict(msgtype="m.text", body="x" * self.event_size))
+        if fields:
+            data = dict((k, v) for k, v in data.items() if k in fields)
+        return data
+
+    def start_purge(self, room_id, event_id):
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None or event_id not in (e[0] for e in room.events):
+                return None
+            purge = Purge("purge{}".format(next(self._ids)), room_id, event_id,
+                          time.monotonic() + self.purge_duration)
+            self.purges[purge.purge_id] = purge
+            return purge
+
+    def get_room(self, room_id):
+        with self._lock:
+            return self.rooms.get(room_id)
+
+    def delete_room(self, room_id):
+        """Deletes a room right away, returning the identifier of the deletion."""
+        with self._lock:
+            if self.rooms.pop(room_id, None) is None:
+                return None
+            delete_id = "delete{}".format(next(self._ids))
+            self.deletions[delete_id] = room_id
+            return delete_id
+
+    def delete_status(self, delete_id):
+        with self._lock:
+            return "complete" if delete_id in self.deletions else None
+
+    def purge_status(self, purge_id):
+        with self._lock:
+            purge = self.purges.get(purge_id)
+            if purge is None:
+                return None
+            if purge.status == "active" and time.monotonic() >= purge.finishes_at:
+                self.__complete(purge)
+            return purge.status
+
+    def __complete_due(self):
+        now = time.monotonic()
+        for purge in self.purges.values():
+            if purge.status == "active" and now >= purge.finishes_at:
+                self.__complete(purge)
+
+    def __complete(self, purge):
+        if self.failing_purges:
+            purge.status = "failed"
+            log.debug("Failed purge %s for room %s", purge.purge_id, purge.room_id)
+            return
+        room = self.rooms[purge.room_id]
+        timestamps = dict(room.events)
+        cutoff = timestamps.get(purge.event_id)
+        if cutoff is not None:
+            room.events = [e for e in room.events if e[1] >= cutoff]
+        purge.status = "complete"
+        log.debug("Completed purge %s for room %s", purge.purge_id, purge.room_id)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "synpurge-standin/1"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        log.debug("%s - %s", self.address_string(), fmt % args)
+
+    def do_GET(self):
+        self.__dispatch("GET")
+
+    def do_POST(self):
+        self.__dispatch("POST")
+
+    def do_DELETE(self):
+        self.__dispatch("DELETE")
+
+    def __dispatch(self, method):
+        hs = self.server.homeserver
+        url = urlsplit(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            # Parameters in the body of POST and DELETE requests are handled like those
+            # in the query string.
+            body = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+            if isinstance(body, dict):
+                query.update(body)
+        received = len(self.raw_requestline) + len(bytes(self.headers)) + length
+        if hs.latency:
+            time.sleep(hs.latency)
+        route, code, body = "unknown", 404, dict(errcode="M_UNRECOGNIZED",
+                                                 error="Unrecognized request")
+        for route_method, pattern, handler in _ROUTES:
+            if route_method != method:
+                continue
+            match = pattern.match(url.path)
+            if match:
+                route = handler.__name__.lstrip("_")
+                if not query.get("access_token"):
+                    code, body = 401, dict(errcode="M_MISSING_TOKEN",
+                                           error="Missing access token")
+                    break
+                retry_after_ms = hs.admit()
+                if retry_after_ms is not None:
+                    code, body = 429, dict(errcode="M_LIMIT_EXCEEDED",
+                                           error="Too Many Requests",
+                                           retry_after_ms=retry_after_ms)
+                    break
+                args = (unquote(a) for a in match.groups())
+                code, body = handler(hs, query, *args)
+                break
+        hs.account(route, received, self.__reply(code, body))
+
+    def __reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
+
+
+def _not_found(what):
+    return 404, dict(errcode="M_NOT_FOUND", error="{} not found".format(what))
+
+
+def _room_summary(room):
+    summary = dict(room_id=room.room_id,
+                   aliases=room.aliases,
+                   num_joined_members=1,
+                   world_readable=False,
+                   guest_can_join=False)
+    if room.aliases:
+        summary["canonical_alias"] = room.aliases[0]
+    return summary
+
+
+def _public_rooms(hs, query):
+    room_filter = query.get("filter") or {}
+    if not isinstance(room_filter, dict):
+        room_filter = json.loads(room_filter)
+    rooms = hs.list_rooms(search_term=room_filter.get("generic_search_term"))
+    limit = int(query.get("limit", 0)) or len(rooms)
+    token = query.get("since")
+    start = 0 if token is None else int(token[1:])
+    body = dict(chunk=[_room_summary(room) for room in rooms[start:start + limit]],
+                total_room_count_estimate=len(rooms))
+    if start > 0:
+        body["prev_batch"] = "p{}".format(start)
+    if start + limit < len(rooms):
+        body["next_batch"] = "p{}".format(start + limit)
+    return 200, body
+
+
+def _admin_rooms(hs, query):
+    if not hs.admin_room_list:
+        return 404, dict(errcode="M_UNRECOGNIZED", error="Unrecognized request")
+    rooms = hs.list_rooms(public_only=False, search_term=query.get("search_term"))
+    limit = int(query.get("limit", 100))
+    start = int(query.get("from", 0))
+    chunk = [_room_summary(room) for room in rooms[start:start + limit]]
+    for room in chunk:
+        # The admin API only includes the canonical alias.
+        del room["aliases"]
+    body = dict(rooms=chunk, offset=start, total_rooms=len(rooms))
+    if start + limit < len(rooms):
+        body["next_batch"] = start + limit
+    return 200, body
+
+
+def _admin_room(hs, query, room_id):
+    room = hs.get_room(room_id)
+    if room is None:
+        return _not_found("Room")
+    details = _room_summary(room)
+    del details["aliases"]
+    details["joined_local_members"] = room.local_members
+    return 200, details
+
+
+def _delete_room(hs, query, room_id):
+    delete_id = hs.delete_room(room_id)
+    if delete_id is None:
+        return _not_found("Room")
+    return 200, dict(delete_id=delete_id)
+
+
+def _delete_room_status(hs, query, delete_id):
+    status = hs.delete_status(delete_id)
+    if status is None:
+        return _not_found("Deletion")
+    return 200, dict(status=status)
+
+
+def _directory_room(hs, query, room_alias):
+    room_id = hs.resolve_alias(room_alias)
+    if room_id is None:
+        return _not_found("Room alias")
+    return 200, dict(room_id=room_id, servers=["localhost"])
+
+
+def _room_messages(hs, query, room_id):
+    events = hs.room_events(room_id)
+    if events is None:
+        return 403, dict(errcode="M_FORBIDDEN", error="Not in room")
+    room_filter = json.loads(query.get("filter", "{}"))
+    limit = min(int(query.get("limit", 10)), 1000)
+    token = query.get("from")
+    if query.get("dir", "b") == "b":
+        start = len(events) if token is None else int(token[1:])
+        chunk = events[max(0, start - limit):start][::-1]
+        end = start - len(chunk)
+    else:
+        start = 0 if token is None else int(token[1:])
+        chunk = events[start:start + limit]
+        end = start + len(chunk)
+    body = dict(start="t{}".format(start),
+                chunk=[hs.event_json(room_id, e, room_filter.get("event_fields"))
+                       for e in chunk])
+    if chunk:
+        body["end"] = "t{}".format(end)
+    return 200, body
+
+
+def _event_context(hs, query, room_id, event_id):
+    events = hs.room_events(room_id)
+    if events is None:
+        return 403, dict(errcode="M_FORBIDDEN", error="Not in room")
+    event_ids = [e[0] for e in events]
+    if event_id not in event_ids:
+        return _not_found("Event")
+    index = event_ids.index(event_id)
+    limit = int(query.get("limit", 10))
+    before, after = limit // 2, limit - limit // 2
+    return 200, dict(event=hs.event_json(room_id, events[index]),
+                     events_before=[hs.event_json(room_id, e)
+                                    for e in events[max(0, index - before):index][::-1]],
+                     events_after=[hs.event_json(room_id, e)
+                                   for e in events[index + 1:index + 1 + after]],
+                     start="t{}".format(max(0, index - before)),
+                     end="t{}".format(min(len(events), index + 1 + after)),
+                     state=[])
+
+
+def _timestamp_to_event(hs, query, room_id):
+    if not hs.timestamp_to_event:
+        return 404, dict(errcode="M_UNRECOGNIZED", error="Unrecognized request")
+    events = hs.room_events(room_id)
+    if events is None:
+        return 403, dict(errcode="M_FORBIDDEN", error="Not in room")
+    timestamps = [e[1] for e in events]
+    ts = int(query["ts"])
+    if query.get("dir", "f") == "b":
+        index = bisect.bisect_right(timestamps, ts) - 1
+    else:
+        index = bisect.bisect_left(timestamps, ts)
+    if index < 0 or index >= len(events):
+        return _not_found("Event")
+    event_id, origin_server_ts = events[index]
+    return 200, dict(event_id=event_id, origin_server_ts=origin_server_ts)
+
+
+def _purge_history(hs, query, room_id, event_id):
+    purge = hs.start_purge(room_id, event_id)
+    if purge is None:
+        return _not_found("Event")
+    if hs.blocking_purges:
+        while hs.purge_status(purge.purge_id) == "active":
+            time.sleep(max(0.0, min(1.0, purge.finishes_at - time.monotonic())))
+    return 200, dict(purge_id=purge.purge_id)
+
+
+def _purge_history_status(hs, query, purge_id):
+    status = hs.purge_status(purge_id)
+    if status is None:
+        return _not_found("Purge")
+    return 200, dict(status=status)
+
+
+_ROUTES = (
+    ("GET", re.compile(r"^/_matrix/client/r0/publicRooms$"),
+     _public_rooms),
+    ("POST", re.compile(r"^/_matrix/client/r0/publicRooms$"),
+     _public_rooms),
+    ("GET", re.compile(r"^/_matrix/client/r0/directory/room/([^/]+)$"),
+     _directory_room),
+    ("GET", re.compile(r"^/_synapse/admin/v1/rooms$"),
+     _admin_rooms),
+    ("GET", re.compile(r"^/_synapse/admin/v1/rooms/([^/]+)$"),
+     _admin_room),
+    ("DELETE", re.compile(r"^/_synapse/admin/v2/rooms/([^/]+)$"),
+     _delete_room),
+    ("GET", re.compile(r"^/_synapse/admin/v2/rooms/delete_status/([^/]+)$"),
+     _delete_room_status),
+    ("GET", re.compile(r"^/_matrix/client/r0/rooms/([^/]+)/messages$"),
+     _room_messages),
+    ("GET", re.compile(r"^/_matrix/client/r0/rooms/([^/]+)/context/([^/]+)$"),
+     _event_context),
+    ("GET", re.compile(r"^/_matrix/client/v1/rooms/([^/]+)/timestamp_to_event$"),
+     _timestamp_to_event),
+    ("POST", re.compile(r"^/_matrix/client/r0/admin/purge_history/([^/]+)/([^/]+)$"),
+     _purge_history),
+    ("GET", re.compile(r"^/_matrix/client/r0/admin/purge_history_status/([^/]+)$"),
+     _purge_history_status),
+)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, homeserver):
+        super().__init__(address, _Handler)
+        self.homeserver = homeserver
+
+
+@attr.s
+class StandinServer(object):
+    """
+    Serves a :class:`Homeserver` over HTTP from a background thread.
+
+    Usable as a context manager; the ``url`` attribute can be passed as
+    the ``homeserver`` of a :class:`synpurge.minimx.API`.
+    """
+    homeserver = attr.ib(validator=vv.instance_of(Homeserver),
+                         default=attr.Factory(Homeserver))
+    host = attr.ib(validator=vv.instance_of(str), default="127.0.0.1")
+    port = attr.ib(validator=vv.instance_of(int), default=0)
+    _server = attr.ib(default=None, init=False, repr=False)
+    _thread = attr.ib(default=None, init=False, repr=False)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._server = _Server((self.host, self.port), self.homeserver)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="synpurge-standin", daemon=True)
+        self._thread.start()
+        log.info("Stand-in homeserver listening on %s", self.url)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
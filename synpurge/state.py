@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import logging
+import sqlite3
+import threading
+import time
+
+from .metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS purged_rooms (
+    room_id TEXT PRIMARY KEY NOT NULL,
+    event_id TEXT NOT NULL,
+    cutoff_ts INTEGER NOT NULL,
+    purged_at INTEGER NOT NULL
+)
+"""
+
+
+class StateStore(object):
+    """
+    Remembers the last event up to which each room has been purged.
+
+    Each completed purge is committed immediately, so an interrupted run
+    can be resumed by skipping the rooms whose reference event has not
+    changed since they were last purged.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        # Purges are recorded from the worker threads of the executor.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(_SCHEMA)
+
+    def last_event_id(self, room_id):
+        with self._lock:
+            row = self._db.execute("SELECT event_id FROM purged_rooms WHERE room_id = ?",
+                                   (room_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def is_purged(self, info):
+        return info.event_id is not None and \
+            info.event_id == self.last_event_id(info.room_id)
+
+    def skip_purged(self, purges, labels=None):
+        """Filters out the purges which were already done in a previous run."""
+        for info in purges:
+            if self.is_purged(info):
+                log.info("Room %s (%s) already purged up to event %s, skipping",
+                         info.room_id, info.room_display_name, info.event_id)
+                registry.inc("synpurge_rooms_skipped_total", reason="already_purged",
+                             **(labels or {}))
+            else:
+                yield info
+
+    def record(self, info, cutoff_ts):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO purged_rooms"
+                             " (room_id, event_id, cutoff_ts, purged_at)"
+                             " VALUES (?, ?, ?, ?)",
+                             (info.room_id, info.event_id, cutoff_ts,
+                              int(time.time() * 1000)))
+        log.debug("Recorded purge of room %s up to event %s",
+                  info.room_id, info.event_id)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __repr__(self):
+        return "StateStore(path={!r})".format(self._path)
+
+
+def open(path):
+    return StateStore(path)
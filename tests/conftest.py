@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import functools
+import os
+import pytest
+
+TEST_SCHEMA = "synpurge_test"
+
+
+@pytest.fixture
+def connect():
+    """
+    Returns a function which opens connections to the PostgreSQL database
+    given as a ``pq://`` URL in ``SYNPURGE_TEST_DATABASE``, using an empty
+    schema which is dropped afterwards. Tests are skipped without it.
+    """
+    url = os.environ.get("SYNPURGE_TEST_DATABASE")
+    if not url:
+        pytest.skip("SYNPURGE_TEST_DATABASE is not set")
+    driver = pytest.importorskip("postgresql.driver")
+    from postgresql import iri
+
+    params = iri.parse(url)
+    admin = driver.connect(**params)
+    admin.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(TEST_SCHEMA))
+    try:
+        yield functools.partial(driver.connect, settings=dict(search_path=TEST_SCHEMA),
+                                **params)
+    finally:
+        admin.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(TEST_SCHEMA))
+        admin.close()
+
+
+@pytest.fixture
+def database(connect):
+    """A :class:`synpurge.pg.Database` with two rooms of 20 synthetic events."""
+    from synpurge import bench, pg
+    from synpurge.pglib import category
+
+    conn = connect(category=category)
+    bench.generate(conn, rooms=2, aliases=1, events=40, skew=0.0)
+    db = pg.Database(conn, TEST_SCHEMA, connect=connect)
+    try:
+        yield db
+    finally:
+        db.close()
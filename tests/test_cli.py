@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import pytest
+import time
+
+from synpurge import cli, standin
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+CONFIG = """\
+[synpurge]
+homeserver = {url}
+token = token
+keep = 3 days
+async_purge = true
+purge_request_timeout = 1 second
+
+[#room.*:example.com]
+pattern = true
+"""
+
+
+@pytest.fixture
+def homeserver(tmpdir):
+    # Purges take longer than the request timeout.
+    hs = standin.Homeserver(purge_duration=60)
+    now_ms = int(time.time() * 1000)
+    for i in range(3):
+        hs.add_room("!room{}:example.com".format(i), aliases=["#room{}:example.com".format(i)],
+                    events=[("$event{}_{}".format(i, n), now_ms - (10 - n) * DAY_MS)
+                            for n in range(10)])
+    with standin.StandinServer(hs) as server:
+        path = tmpdir.join("synpurge.conf")
+        path.write(CONFIG.format(url=server.url))
+        yield hs, str(path)
+
+
+def test_purge_async_timeout(homeserver):
+    hs, path = homeserver
+    with pytest.raises(SystemExit) as excinfo:
+        cli.purge(path)
+    assert "Timed out purging room" in str(excinfo.value)
+    assert hs.stats.requests["purge_history"] == 1
+
+
+def test_purge_async_timeout_keep_going(homeserver):
+    hs, path = homeserver
+    cli.purge(path, keep_going=True)
+    assert hs.stats.requests["purge_history"] == 3
+    # Timed out purges are not retried, and keep running in the homeserver.
+    assert sorted(purge.status for purge in hs.purges.values()) == ["active"] * 3
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import os
+import pytest
+
+from synpurge import config
+from synpurge.config import _required_literal
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    (r"#freenode_.*:matrix\.org", ":matrix.org"),
+    (r"#room\dfoo:example\.com", "foo:example.com"),
+    (r"#\w+-archive\:example\.com", "-archive:example.com"),
+    (r"\bhq-\s*room", "room"),
+    (r"#(dev|ops)-team:example\.com", "-team:example.com"),
+    (r"#dev|#ops", None),
+    (r"#chat(-old)?:example\.com", ":example.com"),
+    (r"#chat-?old:example\.org", "old:example.org"),
+    (r"#[a-z]+:example\.com", ":example.com"),
+    (r".*", None),
+])
+def test_required_literal(pattern, expected):
+    assert _required_literal(pattern) == expected
+
+
+def test_load_booleans(tmpdir):
+    path = tmpdir.join("synpurge.conf")
+    path.write("[synpurge]\n"
+               "homeserver = https://example.com\n"
+               "token = abc\n"
+               "keep = 1 week\n"
+               "[database]\n"
+               "user = synapse\n"
+               "clean_full = false\n"
+               "reindex_full = no\n"
+               "[#room:example.com]\n"
+               "pattern = false\n")
+    c = config.load(str(path))
+    assert c.database.clean_full is False
+    assert c.database.reindex_full is False
+    assert [room.pattern for room in c.rooms] == [False]
+
+
+def test_load_example():
+    example = os.path.join(os.path.dirname(__file__), os.pardir, "config.example.conf")
+    c = config.load(example)
+    assert c.database.clean_full is False
+    assert c.database.reindex_full is False
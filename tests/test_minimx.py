@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import pytest
+import requests
+
+from synpurge import minimx, standin
+
+ROOM_ID = "!room:example.com"
+
+
+@pytest.fixture
+def homeserver():
+    hs = standin.Homeserver(purge_duration=0.3)
+    hs.add_room(ROOM_ID, events=[("$event{}".format(n), 1000 * n) for n in range(10)])
+    with standin.StandinServer(hs) as server:
+        yield hs, minimx.API(homeserver=server.url, token="token")
+
+
+def test_wait_purge_history(homeserver):
+    hs, api = homeserver
+    purge_id = api.start_purge_history(ROOM_ID, "$event5")
+    api.wait_purge_history(purge_id, poll_interval=0.05)
+    assert [e[0] for e in hs.room_events(ROOM_ID)][0] == "$event5"
+    assert hs.stats.requests["purge_history"] == 1
+    assert hs.stats.requests["purge_history_status"] > 1
+
+
+def test_wait_purge_history_failed(homeserver):
+    hs, api = homeserver
+    hs.failing_purges = True
+    purge_id = api.start_purge_history(ROOM_ID, "$event5")
+    with pytest.raises(minimx.APIError) as excinfo:
+        api.wait_purge_history(purge_id, poll_interval=0.05)
+    assert "failed" in str(excinfo.value)
+    assert len(hs.room_events(ROOM_ID)) == 10
+
+
+def test_wait_purge_history_deadline(homeserver):
+    hs, api = homeserver
+    hs.purge_duration = 60
+    purge_id = api.start_purge_history(ROOM_ID, "$event5")
+    with pytest.raises(minimx.APITimeout):
+        api.wait_purge_history(purge_id, deadline=0.2, poll_interval=0.05)
+    # The purge keeps running in the homeserver, and is not started again.
+    assert hs.purge_status(purge_id) == "active"
+    assert hs.stats.requests["purge_history"] == 1
+
+
+def response(status_code, body, headers=None):
+    res = requests.Response()
+    res.status_code = status_code
+    res._content = body.encode("utf-8")
+    res.headers.update(headers or {})
+    return res
+
+
+@pytest.mark.parametrize("body, headers, expected", [
+    ('{"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 1500}', {"Retry-After": "5"}, 1.5),
+    ('{"errcode": "M_LIMIT_EXCEEDED"}', {"Retry-After": "5"}, 5.0),
+    ('{"retry_after_ms": "soon"}', {"Retry-After": "5"}, 5.0),
+    ('["not", "an", "object"]', {"Retry-After": "2"}, 2.0),
+    ("<html>Too Many Requests</html>", {"Retry-After": "3"}, 3.0),
+    ("<html>Too Many Requests</html>", {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, None),
+    ("", {}, None),
+])
+def test_retry_after(body, headers, expected):
+    assert minimx._retry_after(response(429, body, headers)) == expected
+
+
+def test_retry_policy_retries():
+    policy = minimx.RetryPolicy()
+    assert policy.retries("GET", 502)
+    assert policy.retries("GET")
+    assert policy.retries("POST", 429)
+    assert not policy.retries("POST", 502)
+    assert not policy.retries("POST")
+    # Reads which need POST, like searching the room directory.
+    assert policy.retries("POST", 502, idempotent=True)
+    assert policy.retries("POST", idempotent=True)
+    assert not policy.retries("POST", 500, idempotent=True)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+from synpurge.pg import TableStats, plan_vacuum
+
+
+def test_plan_vacuum():
+    tables = [
+        # Many dead tuples, little free space: plain vacuum.
+        TableStats("events", 600, 400, 9000, 8000, 800),
+        # Few dead tuples, mostly free space: VACUUM FULL.
+        TableStats("event_json", 990, 10, 5000, 4000, 3000),
+        TableStats("state_groups", 1000, 0, 3000, 2000, 1500),
+        # Nothing to do, or no statistics.
+        TableStats("rooms", 1000, 10, 1000, 800, 100),
+        TableStats("users", 0, 0, 0, 0, 0),
+    ]
+    plan = [(stats.name, full) for stats, full in plan_vacuum(tables, 0.1, 0.5)]
+    assert plan == [("events", False),
+                    ("state_groups", True),
+                    ("event_json", True)]
+
+
+def event_id(room, k):
+    return "$e{}_{}:bench".format(room, k)
+
+
+def test_purge_history(connect, database):
+    conn = connect()
+    # A state event in the middle of the purged history, kept as an outlier.
+    conn.execute("INSERT INTO state_events (event_id, room_id, type, state_key)"
+                 " VALUES ('{}', '!room1:bench', 'm.room.topic', '')".format(event_id(1, 7)))
+
+    # Batches smaller than the history exercise the per-batch extremities.
+    assert database.purge_history("!room1:bench", event_id(1, 10), batch_size=2) == 4
+
+    def room_events(table, room):
+        return set(conn.prepare("SELECT event_id FROM {} WHERE event_id LIKE $1"
+                                .format(table)).column("$e{}\\_%".format(room)))
+
+    # Like the purge API of Synapse: older events are deleted, except for
+    # state events, which are taken out of the timeline.
+    kept = set(event_id(1, k) for k in [1, 2, 3, 4, 7] + list(range(10, 21)))
+    assert room_events("events", 1) == kept
+    assert room_events("event_json", 1) == kept
+    assert room_events("event_to_state_groups", 1) == kept
+    assert room_events("event_edges", 1) == kept - {event_id(1, 1)}
+    assert set(conn.prepare("SELECT event_id FROM events WHERE outlier").column()) \
+        == set(event_id(1, k) for k in (1, 2, 3, 4, 7))
+
+    # Only the deleted event referenced by the timeline is an extremity, the
+    # outlier state event does not count.
+    assert set(conn.prepare("SELECT event_id FROM event_backward_extremities"
+                            " WHERE room_id = $1").column("!room1:bench")) == {event_id(1, 9)}
+    assert set(conn.prepare("SELECT event_id FROM event_forward_extremities").column()) \
+        == {event_id(1, 20), event_id(2, 20)}
+
+    assert room_events("events", 2) == set(event_id(2, k) for k in range(1, 21))
+    conn.close()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import pytest
+
+from synpurge import minimx, purger, standin
+
+DAY_MS = 24 * 60 * 60 * 1000
+START_MS = 1500000000000
+ROOM_ID = "!room:example.com"
+
+
+def event_ts(n):
+    return START_MS + n * DAY_MS
+
+
+@pytest.fixture(params=[True, False], ids=["timestamp_to_event", "paginating"])
+def homeserver(request):
+    hs = standin.Homeserver(timestamp_to_event=request.param)
+    # More events than fit in a page of messages, so pagination is needed.
+    hs.add_room(ROOM_ID, events=[("$event{}".format(n), event_ts(n)) for n in range(600)])
+    hs.add_room("!empty:example.com")
+    with standin.StandinServer(hs) as server:
+        yield hs, minimx.API(homeserver=server.url, token="token")
+
+
+def test_find_event_id(homeserver):
+    hs, api = homeserver
+    assert purger.find_event_id(ROOM_ID, event_ts(100) + 1, api) == "$event100"
+    assert purger.find_event_id(ROOM_ID, event_ts(599) + DAY_MS, api) == "$event599"
+
+
+def test_find_event_id_strictly_before(homeserver):
+    hs, api = homeserver
+    assert purger.find_event_id(ROOM_ID, event_ts(100), api) == "$event99"
+
+
+def test_find_event_id_none_before(homeserver):
+    hs, api = homeserver
+    assert purger.find_event_id(ROOM_ID, event_ts(0), api) is None
+    assert purger.find_event_id("!empty:example.com", event_ts(10), api) is None
+
+
+def test_find_event_id_endpoint(homeserver):
+    hs, api = homeserver
+    purger.find_event_id(ROOM_ID, event_ts(10) + 1, api)
+    assert api.supports_timestamp_to_event is hs.timestamp_to_event
+    if hs.timestamp_to_event:
+        assert "room_messages" not in hs.stats.requests
+    else:
+        assert hs.stats.requests["room_messages"] > 1
+        # Once known to be missing, the endpoint is not tried again.
+        requests = hs.stats.requests["timestamp_to_event"]
+        purger.find_event_id(ROOM_ID, event_ts(10) + 1, api)
+        assert hs.stats.requests["timestamp_to_event"] == requests
+
+
+def test_estimate_purge_size(homeserver):
+    hs, api = homeserver
+    assert purger.estimate_purge_size(ROOM_ID, "$event100", api) == (100, False)
+
+
+def test_estimate_purge_size_capped(homeserver, monkeypatch):
+    hs, api = homeserver
+    monkeypatch.setattr(purger, "_ESTIMATE_PAGE_SIZE", 100)
+    assert purger.estimate_purge_size(ROOM_ID, "$event599", api) == (200, True)
+    assert purger.estimate_purge_size(ROOM_ID, "$event50", api) == (50, False)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2017 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the GPLv3 license.
+
+import pytest
+
+from synpurge import repack
+
+
+def table_info(conn, table):
+    return dict(
+        rows=sorted(conn.prepare("SELECT event_id, json FROM {}".format(table))()),
+        indexes=sorted(conn.prepare("SELECT indexname, indexdef FROM pg_indexes"
+                                    " WHERE schemaname = current_schema()"
+                                    " AND tablename = $1")(table)),
+        acl=conn.prepare("SELECT relacl::text FROM pg_class"
+                         " WHERE oid = $1::regclass").first(table),
+        owner=conn.prepare("SELECT relowner FROM pg_class"
+                           " WHERE oid = $1::regclass").first(table),
+    )
+
+
+def test_repack_table(connect, database):
+    conn = connect()
+    conn.execute("GRANT SELECT ON event_json TO PUBLIC")
+    conn.execute("DELETE FROM event_json WHERE event_id LIKE '$e1\\_%'")
+    before = table_info(conn, "event_json")
+    assert database.repack_table("event_json") is not None
+    assert table_info(conn, "event_json") == before
+    conn.close()
+
+
+def test_repack_replays_changes(connect, database, monkeypatch):
+    conn = connect()
+    build_indexes = repack.Repack._Repack__build_indexes
+
+    # Changes made after the copy only reach the new table by being replayed.
+    def write_then_build_indexes(self):
+        conn.execute("INSERT INTO event_json (event_id, room_id, internal_metadata, json)"
+                     " VALUES ('$new:bench', '!room1:bench', '{}', '{}')")
+        conn.execute("UPDATE event_json SET json = 'updated' WHERE event_id = '$e1_10:bench'")
+        conn.execute("DELETE FROM event_json WHERE event_id = '$e1_11:bench'")
+        return build_indexes(self)
+
+    monkeypatch.setattr(repack.Repack, "_Repack__build_indexes", write_then_build_indexes)
+    assert database.repack_table("event_json") is not None
+    json = dict(conn.prepare("SELECT event_id, json FROM event_json")())
+    assert len(json) == 40
+    assert json["$new:bench"] == "{}"
+    assert json["$e1_10:bench"] == "updated"
+    assert "$e1_11:bench" not in json
+    conn.close()
+
+
+@pytest.mark.parametrize("statements, reason", [
+    (["CREATE TABLE t (id INTEGER PRIMARY KEY)",
+      "CREATE TABLE c (id INTEGER PRIMARY KEY, t INTEGER REFERENCES t (id))"],
+     "referenced by foreign keys"),
+    (["CREATE TABLE t (id INTEGER)"],
+     "no primary key"),
+    (["CREATE TABLE t (id INTEGER PRIMARY KEY)",
+      "CREATE POLICY p ON t USING (true)"],
+     "row level security policies"),
+])
+def test_repack_refused(connect, statements, reason):
+    from synpurge.pglib import category
+    conn = connect(category=category)
+    for statement in statements:
+        conn.execute(statement)
+    with pytest.raises(repack.CannotRepack, match=reason):
+        repack.repack_table(conn, "t")
+    conn.close()
+
+
+def test_repack_refused_publication(connect):
+    from synpurge.pglib import category
+    conn = connect(category=category)
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE PUBLICATION synpurge_test FOR TABLE t")
+    try:
+        with pytest.raises(repack.CannotRepack, match="publication"):
+            repack.repack_table(conn, "t")
+    finally:
+        conn.execute("DROP PUBLICATION synpurge_test")
+        conn.close()